@@ -0,0 +1,280 @@
+# vim: set fileencoding=utf-8 :
+
+# asyncio client: the DMM commands as coroutines, so that one event loop can drive many meters.
+# The port is read without blocking: through loop.add_reader when it has a file descriptor (POSIX serial ports),
+# by polling in_waiting otherwise (Windows, sim:// and other pyserial URLs).
+# Retries and adaptive timeouts are the same as DmmClient. Errors are raised instead of exiting:
+# asyncio.TimeoutError when the DMM does not give a complete reply before the deadline,
+# ValueError when it answers with an error status.
+# A cancelled command leaves the port usable, the rest of its reply is discarded before the next command.
+#
+#   async with AsyncDmmClient('/dev/ttyUSB0') as client:
+#       print((await client.qddb())['readings']['LIVE'])
+
+import asyncio
+import io
+import time
+
+import serial
+
+from fluke_28x_dmm_util import decode
+from fluke_28x_dmm_util.dmm_util import reply_missing, late_reply, rtt_update, min_rto, max_rto
+from fluke_28x_dmm_util.dmm_util import load_map_cache, save_map_cache
+
+
+class AsyncDmmClient:
+
+    def __init__(self, port, timeout=0.09, deadline=10.0, poll_interval=0.005, refresh_cache=False):
+        self.port = port
+        self.timeout = timeout
+        self.deadline = deadline
+        # Polling period when the port can not be watched by the event loop
+        self.poll_interval = poll_interval
+        self.refresh_cache = refresh_cache
+        self.ser = None
+        self.loop = None
+        self.reader_fd = None
+        self.buffer = bytearray()
+        self.data_ready = None
+        self.read_error = None
+        # Verb of a cancelled command that may still get its reply
+        self.reply_pending = None
+        # One command at a time on a port
+        self.lock = None
+        self.map_cache = {}
+        self.map_cache_loaded = False
+        self.tables = None
+        self.meter_info = None
+        self.rtt_estimates = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def open(self):
+        if self.ser is not None: return
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.serial_for_url(self.port, baudrate=115200, bytesize=8, parity='N', stopbits=1,
+                                         timeout=0, rtscts=False, dsrdtr=False)
+        self.data_ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        try:
+            fd = self.ser.fileno()
+            self.loop.add_reader(fd, self.on_readable)
+            self.reader_fd = fd
+        except (AttributeError, OSError, io.UnsupportedOperation, NotImplementedError):
+            # No file descriptor, or an event loop without add_reader (Windows proactor)
+            self.reader_fd = None
+
+    def close(self):
+        if self.ser is None: return
+        if self.reader_fd is not None:
+            self.loop.remove_reader(self.reader_fd)
+            self.reader_fd = None
+        self.ser.close()
+        self.ser = None
+
+    def on_readable(self):
+        try:
+            self.buffer += self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as err:
+            # Port gone: the waiting command gets the error
+            self.read_error = err
+            self.loop.remove_reader(self.reader_fd)
+            self.reader_fd = None
+        self.data_ready.set()
+
+    async def receive(self, timeout):
+        # Wait up to timeout for more bytes in the buffer, returns False if none came
+        if self.read_error is not None:
+            raise serial.SerialException('Serial port %s failed: %s' % (self.port, self.read_error))
+        if self.reader_fd is not None:
+            self.data_ready.clear()
+            size = len(self.buffer)
+            try:
+                await asyncio.wait_for(self.data_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if self.read_error is not None:
+                raise serial.SerialException('Serial port %s failed: %s' % (self.port, self.read_error))
+            return len(self.buffer) > size
+        end = self.loop.time() + timeout
+        while True:
+            waiting = self.ser.in_waiting
+            if waiting:
+                self.buffer += self.ser.read(waiting)
+                return True
+            remaining = end - self.loop.time()
+            if remaining <= 0: return False
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    async def read_reply(self, verb, timeout):
+        # Same as DmmClient.read_reply: until the reply is complete, or until nothing more arrives
+        stalls = 0
+        while stalls < 2:
+            missing = reply_missing(verb, bytes(self.buffer))
+            if missing == 0 and late_reply(verb, bytes(self.buffer)):
+                self.buffer.clear()
+                continue
+            if missing == 0:
+                data = bytes(self.buffer)
+                return data, data.endswith(b'\r')
+            if await self.receive(timeout):
+                stalls = 0
+            else:
+                stalls += 1
+        return bytes(self.buffer), False
+
+    async def drain(self):
+        # Wait for the rest of the reply of a cancelled command, it must not be taken for the next reply
+        await self.read_reply(self.reply_pending, self.rtt_estimate(self.reply_pending)['rto'])
+        self.reply_pending = None
+
+    def discard_input(self):
+        # Late replies, or the rest of a cancelled command
+        self.buffer.clear()
+        if self.reader_fd is None:
+            self.ser.reset_input_buffer()
+        else:
+            while self.ser.in_waiting:
+                self.ser.read(self.ser.in_waiting)
+
+    def rtt_estimate(self, verb):
+        if verb not in self.rtt_estimates:
+            self.rtt_estimates[verb] = {'count': 0, 'retries': 0, 'srtt': None, 'rttvar': None, 'rto': self.timeout}
+        return self.rtt_estimates[verb]
+
+    async def command(self, cmd, deadline=None):
+        # Raw reply of a command, status included. deadline: seconds, defaults to self.deadline
+        await self.open()
+        verb = cmd.split(' ', 1)[0]
+        estimate = self.rtt_estimate(verb)
+        async with self.lock:
+            end = self.loop.time() + (self.deadline if deadline is None else deadline)
+            data = b''
+            if self.reply_pending is not None:
+                await self.drain()
+            for retry_cmd_count in range(20):
+                self.discard_input()
+                start = self.loop.time()
+                self.ser.write(cmd.encode() + b'\r')
+                try:
+                    data, complete = await self.read_reply(verb, min(estimate['rto'], max(end - start, min_rto)))
+                except asyncio.CancelledError:
+                    self.reply_pending = verb
+                    raise
+                if complete:
+                    estimate['count'] += 1
+                    # Only replies to commands sent once give a valid round-trip time
+                    if retry_cmd_count == 0: rtt_update(estimate, self.loop.time() - start)
+                    return data
+                estimate['retries'] += 1
+                estimate['rto'] = min(estimate['rto'] * 2, max_rto)
+                if self.loop.time() >= end: break
+        if data == b'':
+            raise asyncio.TimeoutError('By app: Did not receive data from DMM for %s' % cmd)
+        raise asyncio.TimeoutError('By app: Did not receive complete reply from DMM for %s' % cmd)
+
+    async def meter_command(self, cmd, deadline=None):
+        # Same result as DmmClient.meter_command: bytes for binary replies, list of fields for text replies
+        data = await self.command(cmd, deadline)
+        if data[0:1] != b'0':
+            raise ValueError('By app: Invalid value, status %s for %s' % (data[0:1].decode(errors='replace'), cmd))
+        if data[2:4] == b'#0':
+            return data[4:-1]
+        return data[2:-1].decode().split(',')
+
+    async def qemap(self, map_name):
+        res = await self.meter_command('qemap ' + str(map_name))
+        entry_count = int(res.pop(0))
+        if len(res) != entry_count * 2:
+            raise ValueError('By app: Error parsing qemap')
+        return dict(zip(res[0::2], res[1::2]))
+
+    async def identity(self):
+        if self.meter_info is None:
+            self.meter_info = await self.meter_id()
+        return self.meter_info
+
+    async def enum_tables(self):
+        # Maps used by the decoders, from the disk cache shared with DmmClient, or from the DMM
+        if self.tables is None:
+            if not self.map_cache_loaded and not self.refresh_cache:
+                self.map_cache_loaded = True
+                load_map_cache(self.map_cache, await self.identity())
+            missing = [map_name for map_name in decode.map_names if map_name not in self.map_cache]
+            for map_name in missing:
+                self.map_cache[map_name] = await self.qemap(map_name)
+            # Written once, blocking but small
+            if missing:
+                save_map_cache(self.map_cache, await self.identity())
+            self.tables = decode.enum_tables(self.map_cache)
+        return self.tables
+
+    async def meter_id(self):
+        res = await self.meter_command('ID')
+        return {'model_number': res[0], 'software_version': res[1], 'serial_number': res[2]}
+
+    async def qsls(self):
+        res = await self.meter_command('qsls')
+        return {'nb_recordings': res[0], 'nb_min_max': res[1], 'nb_peak': res[2], 'nb_measurements': res[3]}
+
+    async def clock(self):
+        res = await self.meter_command('qmp clock')
+        return res[0]
+
+    async def qddb(self):
+        tables = await self.enum_tables()
+        return decode.decode_qddb(await self.meter_command('qddb'), tables)
+
+    async def qrsi(self, idx):
+        tables = await self.enum_tables()
+        return decode.decode_qrsi(await self.meter_command('qrsi ' + str(idx)), tables)
+
+    async def qsmr(self, idx):
+        tables = await self.enum_tables()
+        return decode.decode_qsmr(await self.meter_command('qsmr ' + str(idx)), tables)
+
+    async def min_max_peak(self, cmd, idx):
+        # cmd: qmmsi (min max) or qpsi (peak)
+        tables = await self.enum_tables()
+        return decode.decode_min_max(await self.meter_command(cmd + ' ' + str(idx)), tables)
+
+    async def qsrr_raw(self, reading_idx, sample_idx):
+        # Retries of a block of the wrong size share one deadline, as in DmmClient.qsrr_raw
+        await self.open()
+        res = b''
+        end = self.loop.time() + self.deadline
+        for retry_count in range(20):
+            if self.loop.time() >= end: break
+            res = await self.meter_command('qsrr ' + str(reading_idx) + ',' + str(sample_idx),
+                                           end - self.loop.time())
+            if len(res) == decode.QSRR_SIZE:
+                return res
+        raise ValueError('By app: Invalid block size: %d should be 146' % (len(res)))
+
+    async def qsrr(self, reading_idx, sample_idx):
+        tables = await self.enum_tables()
+        return decode.decode_qsrr(await self.qsrr_raw(reading_idx, sample_idx), tables)
+
+    async def qsrr_samples(self, reading_idx, num_samples, first=0):
+        # Decoded samples of a recording, one request at a time
+        tables = await self.enum_tables()
+        for k in range(first, num_samples):
+            yield decode.decode_qsrr(await self.qsrr_raw(reading_idx, k), tables)
+
+    async def set_property(self, name, value):
+        # name: company, site, operator or contact
+        await self.meter_command('mpq ' + name + ",'" + value + "'")
+
+    async def set_name(self, index, name):
+        # Name of the recordings at a 1-based index (1 to 8)
+        await self.meter_command('savname ' + str(index - 1) + ',"' + name + '"')
+
+    async def set_clock(self, ts=None):
+        # DMM clock, in seconds since the epoch, defaults to now
+        if ts is None: ts = time.time()
+        await self.meter_command('mp clock,' + str(int(ts)))
@@ -0,0 +1,100 @@
+# vim: set fileencoding=utf-8 :
+
+# Decoding of many qsrr blocks at once with NumPy (optional).
+# The blocks are stacked in one buffer and read through a structured dtype,
+# every field of every sample is then converted by a single vectorised operation.
+# NumPy is imported on first use (load), commands that do not decode in batch do not pay for its import.
+
+from fluke_28x_dmm_util import decode
+
+# NumPy module once loaded, None if it is not installed
+np = None
+loaded = False
+reading_dtype = None
+qsrr_dtype = None
+
+# Names of the readings of a qsrr block, when there is no block to read their ids from
+qsrr_readings = ['MAXIMUM', 'AVERAGE', 'MINIMUM']
+qsrr_readings2 = ['PRIMARY']
+
+
+def load():
+    # NumPy module, None if it is not installed
+    global np, loaded, reading_dtype, qsrr_dtype
+    if loaded: return np
+    loaded = True
+    try:
+        import numpy
+    except ImportError:
+        return None
+    # Doubles are two little-endian 32 bits words, most significant word first (see get_double)
+    dmm_double = ('<u4', (2,))
+    reading_dtype = numpy.dtype([('readingid', '<u2'), ('value', dmm_double), ('unit', '<u2'),
+                                 ('unit_multiplier', '<i2'), ('decimals', '<i2'), ('display_digits', '<i2'),
+                                 ('state', '<u2'), ('attribute', '<u2'), ('ts', dmm_double)])
+    qsrr_dtype = numpy.dtype([('start_ts', dmm_double), ('end_ts', dmm_double), ('readings', reading_dtype, (3,)),
+                              ('duration', '<u2'), ('un2', '<u2'), ('readings2', reading_dtype, (1,)),
+                              ('record_type', '<u2'), ('stable', '<u2'), ('transient_state', '<u2')])
+    assert reading_dtype.itemsize == decode.READING_SIZE and qsrr_dtype.itemsize == decode.QSRR_SIZE
+    np = numpy
+    return np
+
+
+def available():
+    return load() is not None
+
+
+def to_float(words):
+    # Swapping the two words gives a little-endian double
+    return np.ascontiguousarray(words[..., ::-1]).view('<f8')[..., 0]
+
+
+def decode_readings_columns(readings, tables, names):
+    # readings is a (samples, count) array of reading_dtype, all samples must have the same reading ids.
+    # names: names of the readings, used only without samples
+    columns = {}
+    for i in range(readings.shape[1]):
+        reading = readings[:, i]
+        ids = reading['readingid']
+        if len(ids) == 0:
+            name = names[i]
+        else:
+            if (ids != ids[0]).any():
+                raise ValueError('By app: readings are not in the same order in all the blocks')
+            rid = int(ids[0])
+            if rid not in tables['readingid']:
+                raise ValueError('By app: Can not find key %s in map readingid' % rid)
+            name = tables['readingid'][rid]
+        columns[name] = {
+            'value': np.round(to_float(reading['value']), 8),
+            'unit': reading['unit'],
+            'unit_multiplier': reading['unit_multiplier'],
+            'decimals': reading['decimals'],
+            'display_digits': reading['display_digits'],
+            'state': reading['state'],
+            'attribute': reading['attribute'],
+            'ts': to_float(reading['ts'])
+        }
+    return columns
+
+
+def decode_qsrr_blocks(blocks, tables):
+    # blocks: bytes-like made of N qsrr blocks of 146 bytes.
+    # Returns the same fields as decode_qsrr, as arrays of N values. Timestamps are epoch seconds,
+    # enumerated values are left as codes, to be looked up in tables.
+    if load() is None:
+        raise ValueError('By app: NumPy is needed for batch decoding')
+    if len(blocks) % decode.QSRR_SIZE:
+        raise ValueError('By app: Invalid blocks size: %d is not a multiple of 146' % len(blocks))
+    samples = np.frombuffer(blocks, dtype=qsrr_dtype)
+    return {
+        'start_ts': to_float(samples['start_ts']),
+        'end_ts': to_float(samples['end_ts']),
+        'readings': decode_readings_columns(samples['readings'], tables, qsrr_readings),
+        'duration': samples['duration'],
+        'un2': samples['un2'],
+        'readings2': decode_readings_columns(samples['readings2'], tables, qsrr_readings2),
+        'record_type': samples['record_type'],
+        'stable': samples['stable'],
+        'transient_state': samples['transient_state']
+    }
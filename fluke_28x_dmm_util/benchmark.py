@@ -0,0 +1,410 @@
+# vim: set fileencoding=utf-8 :
+
+# Benchmarks of the download, decode and export paths, against a simulated or replayed DMM (see simulator.py):
+# - decoders: the struct based decoders against the former get_u16/get_double functions,
+#   and a whole recording decoded block by block against NumPy batch decoding (same Recording columns, checked)
+# - commands: commands/s, bytes/s and p50/p99 latency of each kind of command
+# - download: samples/s and bytes/s of a recording, one request at a time and with a window
+# - format: cost of each output format per row, and a whole 'get recordings' (download, decode, format)
+# Usage: python -m fluke_28x_dmm_util.benchmark [iterations] [--port URL | --replay DUMP] [--samples N]
+#                                                [--window N] [--json FILE] [--baseline FILE] [--tolerance RATIO]
+# Results can be saved with --json, and compared with a saved file with --baseline:
+# the exit status is 1 if a result is worse than the baseline by more than the tolerance.
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+
+from fluke_28x_dmm_util import batch
+from fluke_28x_dmm_util import decode
+from fluke_28x_dmm_util import recording
+from fluke_28x_dmm_util import writers
+from fluke_28x_dmm_util.dmm_util import DmmClient, recording_rows, recording_fields
+from fluke_28x_dmm_util.dmm_util import get_u16, get_s16, get_double, get_time, parse_time
+from fluke_28x_dmm_util.simulator import sample_maps, sample_qsrr, sample_qrsi, sample_min_max, sample_qsmr, \
+    sample_qddb
+
+
+class LegacyDecoder:
+    # Decoders as they were before decode.py, kept as the reference for results and timings
+
+    def __init__(self, map_cache):
+        self.map_cache = map_cache
+
+    def parse_readings(self, reading_bytes):
+        readings = {}
+        chunks, chunk_size = len(reading_bytes), 30
+        list_readings = [reading_bytes[i:i + chunk_size] for i in range(0, chunks, chunk_size)]
+        for r in list_readings:
+            readings[self.get_map_value('readingid', r, 0)] = {
+                'value': get_double(r, 2),
+                'unit': self.get_map_value('unit', r, 10),
+                'unit_multiplier': get_s16(r, 12),
+                'decimals': get_s16(r, 14),
+                'display_digits': get_s16(r, 16),
+                'state': self.get_map_value('state', r, 18),
+                'attribute': self.get_map_value('attribute', r, 20),
+                'ts': get_time(r, 22)
+            }
+        return readings
+
+    def get_map_value(self, map_name, string, offset):
+        dmm_map = self.map_cache[map_name]
+        value = str(get_u16(string, offset))
+        if value not in dmm_map:
+            raise ValueError('By app: Can not find key %s in map %s' % (value, map_name))
+        return dmm_map[value]
+
+    def get_multimap_value(self, map_name, string, offset):
+        return [self.get_map_value(map_name, string, offset)]
+
+    def qsrr(self, res):
+        return {
+            'start_ts': parse_time(get_double(res, 0)),
+            'end_ts': parse_time(get_double(res, 8)),
+            'readings': self.parse_readings(res[16:16 + 30 * 3]),
+            'duration': round(get_u16(res, 106), 5),
+            'un2': get_u16(res, 108),
+            'readings2': self.parse_readings(res[110:110 + 30]),
+            'record_type': self.get_map_value('recordtype', res, 140),
+            'stable': self.get_map_value('isstableflag', res, 142),
+            'transient_state': self.get_map_value('transientstate', res, 144)
+        }
+
+    def qrsi(self, res):
+        reading_count = get_u16(res, 76)
+        return {
+            'seq_no': get_u16(res, 0),
+            'un2': get_u16(res, 2),
+            'start_ts': parse_time(get_double(res, 4)),
+            'end_ts': parse_time(get_double(res, 12)),
+            'sample_interval': get_double(res, 20),
+            'event_threshold': get_double(res, 28),
+            'reading_index': get_u16(res, 36),
+            'un3': get_u16(res, 38),
+            'num_samples': get_u16(res, 40),
+            'un4': get_u16(res, 42),
+            'prim_function': self.get_map_value('primfunction', res, 44),
+            'sec_function': self.get_map_value('secfunction', res, 46),
+            'auto_range': self.get_map_value('autorange', res, 48),
+            'unit': self.get_map_value('unit', res, 50),
+            'range_max ': get_double(res, 52),
+            'unit_multiplier': get_s16(res, 60),
+            'bolt': self.get_map_value('bolt', res, 62),
+            'un8': get_u16(res, 64),
+            'un9': get_u16(res, 66),
+            'un10': get_u16(res, 68),
+            'un11': get_u16(res, 70),
+            'mode': self.get_multimap_value('mode', res, 72),
+            'un12': get_u16(res, 74),
+            'readings': self.parse_readings(res[78:78 + reading_count * 30]),
+            'name': res[(78 + reading_count * 30):]
+        }
+
+    def qsmr(self, res):
+        reading_count = get_u16(res, 36)
+        return {'[seq_no': get_u16(res, 0),
+                'un1': get_u16(res, 2),
+                'prim_function': self.get_map_value('primfunction', res, 4),
+                'sec_function': self.get_map_value('secfunction', res, 6),
+                'auto_range': self.get_map_value('autorange', res, 8),
+                'unit': self.get_map_value('unit', res, 10),
+                'range_max': get_double(res, 12),
+                'unit_multiplier': get_s16(res, 20),
+                'bolt': self.get_map_value('bolt', res, 22),
+                'un4': get_u16(res, 24),
+                'un5': get_u16(res, 26),
+                'un6': get_u16(res, 28),
+                'un7': get_u16(res, 30),
+                'mode': self.get_multimap_value('mode', res, 32),
+                'un9': get_u16(res, 34),
+                'readings': self.parse_readings(res[38:38 + reading_count * 30]),
+                'name': res[(38 + reading_count * 30):]
+                }
+
+    def min_max(self, res):
+        reading_count = get_u16(res, 52)
+        return {'seq_no': get_u16(res, 0),
+                'un2': get_u16(res, 2),
+                'start_ts': parse_time(get_double(res, 4)),
+                'end_ts': parse_time(get_double(res, 12)),
+                'prim_function': self.get_map_value('primfunction', res, 20),
+                'sec_function': self.get_map_value('secfunction', res, 22),
+                'autorange': self.get_map_value('autorange', res, 24),
+                'unit': self.get_map_value('unit', res, 26),
+                'range_max ': get_double(res, 28),
+                'unit_multiplier': get_s16(res, 36),
+                'bolt': self.get_map_value('bolt', res, 38),
+                'ts3': parse_time(get_double(res, 40)),
+                'mode': self.get_multimap_value('mode', res, 48),
+                'un8': get_u16(res, 50),
+                'readings': self.parse_readings(res[54:54 + reading_count * 30]),
+                'name': res[(54 + reading_count * 30):]
+                }
+
+    def qddb(self, res):
+        return {
+            'prim_function': self.get_map_value('primfunction', res, 0),
+            'sec_function': self.get_map_value('secfunction', res, 2),
+            'auto_range': self.get_map_value('autorange', res, 4),
+            'unit': self.get_map_value('unit', res, 6),
+            'range_max': get_double(res, 8),
+            'unit_multiplier': get_s16(res, 16),
+            'bolt': self.get_map_value('bolt', res, 18),
+            'ts': get_time(res, 20),
+            'mode': self.get_multimap_value('mode', res, 28),
+            'un1': get_u16(res, 30),
+            'readings': self.parse_readings(res[34:])
+        }
+
+
+def str_map_cache():
+    return {map_name: {str(i): value for i, value in enumerate(values)} for map_name, values in sample_maps.items()}
+
+
+def time_per_call(function, blocks, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for block in blocks:
+            function(block)
+    return (time.perf_counter() - start) / (iterations * len(blocks))
+
+
+def decode_benchmark(iterations=200):
+    map_cache = str_map_cache()
+    legacy = LegacyDecoder(map_cache)
+    tables = decode.enum_tables(map_cache)
+    cases = [('qsrr', [sample_qsrr(k) for k in range(50)], legacy.qsrr, decode.decode_qsrr),
+             ('qrsi', [sample_qrsi(i) for i in range(10)], legacy.qrsi, decode.decode_qrsi),
+             ('qsmr', [sample_qsmr(i) for i in range(10)], legacy.qsmr, decode.decode_qsmr),
+             ('qmmsi', [sample_min_max(i) for i in range(10)], legacy.min_max, decode.decode_min_max),
+             ('qddb', [sample_qddb()], legacy.qddb, decode.decode_qddb)]
+    results = {}
+    for name, blocks, reference, decoder in cases:
+        for block in blocks:
+            if reference(block) != decoder(block, tables):
+                raise ValueError('By app: %s decoders do not give the same result' % name)
+        legacy_time = time_per_call(reference, blocks, iterations)
+        struct_time = time_per_call(lambda block: decoder(block, tables), blocks, iterations)
+        results[name] = {'legacy_us': legacy_time * 1e6, 'struct_us': struct_time * 1e6,
+                         'speedup': legacy_time / struct_time}
+    return results
+
+
+def batch_benchmark(num_samples=100000):
+    # A whole recording decoded block by block, then at once with NumPy
+    tables = decode.enum_tables(str_map_cache())
+    blocks = b''.join(sample_qsrr(k % 1000) for k in range(num_samples))
+    start = time.perf_counter()
+    for offset in range(0, len(blocks), decode.QSRR_SIZE):
+        decode.decode_qsrr(blocks[offset:offset + decode.QSRR_SIZE], tables)
+    struct_time = time.perf_counter() - start
+    result = {'samples': num_samples, 'struct_ms': struct_time * 1000}
+    if batch.available():
+        recording_check(tables)
+        start = time.perf_counter()
+        batch.decode_qsrr_blocks(blocks, tables)
+        result['numpy_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def recording_check(tables):
+    # Recordings decoded by NumPy and block by block have the same columns, also without samples
+    def values(column):
+        # NaN (average of a sample without duration) compares equal to NaN
+        return [None if value != value else value for value in column]
+    for num_samples in (0, 1, 50):
+        blocks = b''.join(sample_qsrr(k) for k in range(num_samples))
+        columns = recording.Recording.from_columns({}, blocks, tables)
+        samples = recording.Recording.from_samples({}, blocks, tables)
+        for name, typecode in recording.columns:
+            if values(columns[name]) != values(samples[name]):
+                raise ValueError('By app: recording column %s differs with %d samples' % (name, num_samples))
+
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def bench_client(port, window=1):
+    # A client that reads the maps from the DMM, without the disk cache
+    client = DmmClient(port, window=window)
+    client.open()
+    client.map_cache_loaded = True
+    for map_name in decode.map_names:
+        client.map_cache[map_name] = client.qemap(map_name)
+    return client
+
+
+def bytes_sent(client):
+    # Bytes sent by a simulated DMM, None for a real one
+    meter = getattr(client.ser, 'meter', None)
+    return meter.bytes_sent if meter is not None else None
+
+
+def rates(metrics, name, count, elapsed, sent):
+    metrics[name + '.per_s'] = count / elapsed if elapsed > 0 else 0.0
+    if sent is not None:
+        metrics[name + '.bytes_per_s'] = sent / elapsed if elapsed > 0 else 0.0
+
+
+def command_benchmark(port, count=200):
+    metrics = {}
+    with bench_client(port) as client:
+        recording = client.qrsi('0')
+        commands = [('ID', 'ID'), ('qsls', 'qsls'), ('qemap', 'qemap unit'), ('qrsi', 'qrsi 0'),
+                    ('qsrr', 'qsrr %d,%%d' % recording['reading_index']), ('qsmr', 'qsmr 0'), ('qmmsi', 'qmmsi 0'),
+                    ('qddb', 'qddb'), ('qmp', 'qmp clock')]
+        samples = recording['num_samples']
+        # A replayed dump only answers the commands it has recorded
+        replies = getattr(getattr(client.ser, 'meter', None), 'replies', None)
+        for verb, cmd in commands:
+            if replies is not None and (cmd % 0 if '%d' in cmd else cmd) not in replies: continue
+            latencies = []
+            sent = bytes_sent(client)
+            start = time.perf_counter()
+            for i in range(count):
+                begin = time.perf_counter()
+                client.meter_command(cmd % (i % samples) if '%d' in cmd else cmd)
+                latencies.append(time.perf_counter() - begin)
+            elapsed = time.perf_counter() - start
+            rates(metrics, 'commands.' + verb, count, elapsed, None if sent is None else bytes_sent(client) - sent)
+            metrics['commands.%s.p50_ms' % verb] = percentile(latencies, 50) * 1000
+            metrics['commands.%s.p99_ms' % verb] = percentile(latencies, 99) * 1000
+    return metrics
+
+
+def download_benchmark(port, window):
+    # Raw blocks of the first recording, as 'get recordings' downloads them
+    metrics = {}
+    for name, size in [('download.window_1', 1), ('download.window_%d' % window, window)]:
+        with bench_client(port, size) as client:
+            recording = client.qrsi('0')
+            sent = bytes_sent(client)
+            intervals = []
+            start = last = time.perf_counter()
+            for block in client.qsrr_blocks(str(recording['reading_index']), recording['num_samples']):
+                now = time.perf_counter()
+                intervals.append(now - last)
+                last = now
+            elapsed = time.perf_counter() - start
+            rates(metrics, name + '.samples', recording['num_samples'], elapsed,
+                  None if sent is None else bytes_sent(client) - sent)
+            metrics[name + '.p50_ms'] = percentile(intervals, 50) * 1000
+            metrics[name + '.p99_ms'] = percentile(intervals, 99) * 1000
+        if window == 1: break
+    return metrics
+
+
+def format_benchmark(rows_count=20000):
+    # Cost per row of each output format
+    tables = decode.enum_tables(str_map_cache())
+    samples = [decode.decode_qsrr(sample_qsrr(k), tables) for k in range(1000)]
+    rows = list(recording_rows(samples)) * (rows_count // len(samples))
+    metrics = {}
+    for output_format in writers.formats:
+        out = io.BytesIO() if output_format == 'binary' else io.StringIO()
+        writer = writers.make_writer(output_format, out=out)
+        start = time.perf_counter()
+        writer.begin('recording', recording_fields, {'index': 1, 'name': 'REC0'})
+        for row in rows:
+            writer.row(row)
+        writer.end()
+        metrics['format.%s.row_us' % output_format] = (time.perf_counter() - start) / len(rows) * 1e6
+    return metrics
+
+
+def export_benchmark(port, window):
+    # 'get recordings' of the first recording: download, decode and tab-separated output
+    with bench_client(port, window) as client:
+        recording = client.qrsi('0')
+        writer = writers.make_writer('tsv', out=io.StringIO())
+        start = time.perf_counter()
+        writer.begin('recording', recording_fields)
+        for row in recording_rows(client.qsrr_samples(str(recording['reading_index']), recording['num_samples'])):
+            writer.row(row)
+        writer.end()
+        elapsed = time.perf_counter() - start
+    return {'export.tsv.samples_per_s': recording['num_samples'] / elapsed if elapsed > 0 else 0.0}
+
+
+def decoder_metrics(iterations):
+    metrics = {}
+    for name, result in decode_benchmark(iterations).items():
+        metrics['decode.%s.legacy_us' % name] = result['legacy_us']
+        metrics['decode.%s.struct_us' % name] = result['struct_us']
+    result = batch_benchmark()
+    if 'numpy_ms' in result:
+        metrics['decode.qsrr.numpy_us'] = result['numpy_ms'] * 1000 / result['samples']
+    return metrics
+
+
+def higher_is_better(name):
+    return name.endswith('per_s')
+
+
+def compare(metrics, baseline, tolerance):
+    # (name, baseline, result, change) of the results worse than the baseline by more than tolerance
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        base = baseline.get(name)
+        if not base: continue
+        change = value / base - 1
+        if (change < -tolerance) if higher_is_better(name) else (change > tolerance):
+            regressions.append((name, base, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the download, decode and export paths')
+    parser.add_argument('iterations', nargs='?', type=int, default=200, help='iterations of the decoders')
+    parser.add_argument('--port', help='DMM port or URL, defaults to a simulated DMM')
+    parser.add_argument('--replay', help="simulated DMM answering with the replies of a file written by 'dump'")
+    parser.add_argument('--samples', type=int, default=2000, help='samples of the simulated recording')
+    parser.add_argument('--window', type=int, default=8, help='window used for the download benchmark')
+    parser.add_argument('--commands', type=int, default=200, help='calls of each command')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='change allowed against the baseline (0.1)')
+    args = parser.parse_args()
+
+    # Replies at once (instant=1): the results measure this utility, not the serial line
+    port = args.port or ('sim://?instant=1&replay=' + args.replay if args.replay
+                         else 'sim://?instant=1&recordings=%d' % args.samples)
+    metrics = decoder_metrics(args.iterations)
+    metrics.update(command_benchmark(port, args.commands))
+    metrics.update(download_benchmark(port, max(args.window, 1)))
+    metrics.update(format_benchmark())
+    metrics.update(export_benchmark(port, max(args.window, 1)))
+
+    print('Benchmark', 'Result', sep='\t')
+    for name, value in metrics.items():
+        print(name, '%.3f' % value, sep='\t')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(), 'port': port,
+                       'window': args.window, 'metrics': metrics}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['metrics']
+        regressions = compare(metrics, baseline, args.tolerance)
+        print()
+        if regressions:
+            print('Regressions (more than %d%% worse than %s)' % (args.tolerance * 100, args.baseline))
+            print('Benchmark', 'Baseline', 'Result', 'Change', sep='\t')
+            for name, base, value, change in regressions:
+                print(name, '%.3f' % base, '%.3f' % value, '%+.1f%%' % (change * 100), sep='\t')
+            sys.exit(1)
+        print('No regression against', args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# vim: set fileencoding=utf-8 :
+
+# 'capture': live readings (qddb) taken at a fixed rate, or as fast as the DMM answers.
+# At a fixed rate, readings are taken at fixed times (slots) t0 + k / rate, so that errors do not add up.
+# A reading that ends after the next slot has missed it: that slot is skipped, the capture does not try to
+# catch up with a burst of readings.
+# Readings go into a preallocated ring buffer, with the host and DMM timestamps. A background thread takes
+# them in batches and writes them through the output writer, the capture loop never waits for the output.
+# If the output is slower than the capture for long enough to fill the buffer, the oldest readings are lost.
+#
+# Triggers (--trigger): readings are still taken continuously, but only windows around the readings that fire
+# a trigger are written: the pre readings before it, the reading, and the post readings after it.
+# Windows that overlap are merged. Triggers are evaluated on each reading as it is taken.
+#   >LEVEL, <LEVEL   the LIVE value crosses LEVEL upwards, downwards
+#   slope>RATE       the LIVE value changes faster than RATE units per second, either way
+#   function, mode   the primary function, the mode changes
+#
+# Resampling (--resample): the flush thread folds the readings it takes into time buckets (resample.py) and writes
+# one row per bucket instead.
+
+import array
+import bisect
+import math
+import sys
+import threading
+import time
+
+from fluke_28x_dmm_util import decode
+from fluke_28x_dmm_util import resample
+from fluke_28x_dmm_util import stats
+from fluke_28x_dmm_util import writers
+
+# Readings held by the ring buffer
+RING_SIZE = 65536
+# Seconds between two writes of the output
+FLUSH_INTERVAL = 0.5
+# Default readings written before and after a trigger
+PRE_TRIGGER = 100
+POST_TRIGGER = 100
+
+capture_fields = [('time', writers.TIME), ('host_ts', writers.FLOAT), ('meter_ts', writers.FLOAT),
+                  ('primary', writers.FLOAT), ('primary_unit', writers.STR), ('secondary', writers.FLOAT),
+                  ('secondary_unit', writers.STR), ('function', writers.STR)]
+# Added with triggers: the trigger fired by the reading, empty for the others
+trigger_fields = [('trigger', writers.STR)]
+
+# Kinds of triggers
+ABOVE = 0
+BELOW = 1
+SLOPE = 2
+FUNCTION = 3
+MODE = 4
+
+
+def parse_trigger(expr):
+    # (kind, level) of a trigger expression
+    text = expr.replace(' ', '')
+    try:
+        if text.startswith('>'):
+            return ABOVE, float(text[1:])
+        if text.startswith('<'):
+            return BELOW, float(text[1:])
+        if text.startswith('slope>'):
+            return SLOPE, abs(float(text[6:]))
+    except ValueError:
+        pass
+    if text == 'function':
+        return FUNCTION, 0.0
+    if text == 'mode':
+        return MODE, 0.0
+    raise ValueError('By app: Invalid trigger %s' % expr)
+
+
+class Triggers:
+    # Trigger expressions and the readings written around them. check() keeps the previous reading to compare
+    # with, a capture uses its own copy().
+
+    def __init__(self, exprs, pre=PRE_TRIGGER, post=POST_TRIGGER):
+        if pre < 0 or post < 0 or pre + 1 > RING_SIZE:
+            raise ValueError('By app: Invalid pre or post-trigger depth')
+        self.exprs = list(exprs)
+        self.pre = pre
+        self.post = post
+        self.conditions = [parse_trigger(expr) + (expr,) for expr in self.exprs]
+        self.last_value = None
+        self.last_ts = None
+        self.last_function = None
+        self.last_mode = None
+
+    def copy(self):
+        return Triggers(self.exprs, self.pre, self.post)
+
+    def check(self, value, ts, function, mode):
+        # Expression of the first trigger fired by this reading, None if none
+        fired = None
+        last = self.last_value
+        if last is not None:
+            for kind, level, expr in self.conditions:
+                if kind == ABOVE:
+                    hit = last <= level < value
+                elif kind == BELOW:
+                    hit = last >= level > value
+                elif kind == SLOPE:
+                    hit = ts > self.last_ts and abs(value - last) > level * (ts - self.last_ts)
+                elif kind == FUNCTION:
+                    hit = function != self.last_function
+                else:
+                    hit = mode != self.last_mode
+                if hit:
+                    fired = expr
+                    break
+        self.last_value = value
+        self.last_ts = ts
+        self.last_function = function
+        self.last_mode = mode
+        return fired
+
+
+class RingBuffer:
+    # Columns of the last readings, preallocated. Written by the capture loop, read by the flush thread.
+    # pre: None to write every reading, or the readings kept before a trigger, the others are not written
+
+    def __init__(self, capacity=RING_SIZE, pre=None):
+        self.capacity = capacity
+        self.host_ts = array.array('d', bytes(8 * capacity))
+        self.meter_ts = array.array('d', bytes(8 * capacity))
+        self.primary = array.array('d', bytes(8 * capacity))
+        self.secondary = array.array('d', bytes(8 * capacity))
+        # Codes of the units, functions and triggers, in the tables of the strings
+        self.primary_unit = array.array('H', bytes(2 * capacity))
+        self.secondary_unit = array.array('H', bytes(2 * capacity))
+        self.function = array.array('H', bytes(2 * capacity))
+        self.trigger = array.array('H', bytes(2 * capacity))
+        self.strings = []
+        self.codes = {}
+        # Readings written, and taken by the reader
+        self.head = 0
+        self.tail = 0
+        self.lost = 0
+        self.pre = pre
+        # Readings before this one are in a window, and must be written
+        self.keep_until = 0
+        self.lock = threading.Lock()
+
+    def code(self, string):
+        try:
+            return self.codes[string]
+        except KeyError:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(string)
+            return code
+
+    def append(self, host_ts, meter_ts, primary, primary_unit, secondary, secondary_unit, function, trigger=''):
+        with self.lock:
+            i = self.head % self.capacity
+            self.host_ts[i] = host_ts
+            self.meter_ts[i] = meter_ts
+            self.primary[i] = primary
+            self.primary_unit[i] = self.code(primary_unit)
+            self.secondary[i] = secondary
+            self.secondary_unit[i] = self.code(secondary_unit)
+            self.function[i] = self.code(function)
+            self.trigger[i] = self.code(trigger)
+            self.head += 1
+            self.forget()
+            if self.head - self.tail > self.capacity:
+                # Oldest reading overwritten before it was taken
+                self.tail += 1
+                self.lost += 1
+            return self.head - self.tail
+
+    def forget(self):
+        # Outside of the windows, only the readings that can come before a trigger are kept
+        if self.pre is not None and self.tail >= self.keep_until:
+            self.tail = max(self.tail, self.head - self.pre - 1)
+
+    def fire(self, post):
+        # The last reading fired a trigger: it is written with the pre readings before it and post readings after it
+        with self.lock:
+            self.keep_until = max(self.keep_until, self.head + post)
+
+    def take(self):
+        # Readings to write since the previous call, as rows
+        with self.lock:
+            rows = []
+            strings = self.strings
+            end = self.head if self.pre is None else min(self.head, self.keep_until)
+            for k in range(self.tail, end):
+                i = k % self.capacity
+                row = (self.host_ts[i], self.host_ts[i], self.meter_ts[i], self.primary[i],
+                       strings[self.primary_unit[i]], self.secondary[i], strings[self.secondary_unit[i]],
+                       strings[self.function[i]])
+                rows.append(row if self.pre is None else row + (strings[self.trigger[i]],))
+            self.tail = max(self.tail, end)
+            self.forget()
+            return rows
+
+
+class Flusher(threading.Thread):
+    # Writes the readings of the ring buffer in batches, every FLUSH_INTERVAL or when the buffer is half full,
+    # or their buckets if buckets (resample.Buckets) are given
+
+    def __init__(self, ring, writer, buckets=None):
+        super().__init__(name='capture flush', daemon=True)
+        self.ring = ring
+        self.writer = writer
+        self.buckets = buckets
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.batches = 0
+        self.rows = 0
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                self.wakeup.wait(FLUSH_INTERVAL)
+                self.wakeup.clear()
+                stopping = self.stopping
+                rows = self.ring.take()
+                if self.buckets is not None:
+                    rows = self.resample(rows, stopping)
+                if rows:
+                    for row in rows:
+                        self.writer.row(row)
+                    self.writer.flush()
+                    self.batches += 1
+                    self.rows += len(rows)
+                if stopping: return
+        except Exception as error:
+            # Output closed (e.g. a pipe to a command that has exited): the capture stops
+            self.error = error
+
+    def resample(self, rows, last):
+        # Rows of the buckets ended by the readings of rows, and of the running one if last
+        buckets = self.buckets
+        finished = []
+        for row in rows:
+            value = row[3]
+            # Not displayed (NaN), or overload
+            if value != value or value == resample.OVERLOAD: continue
+            bucket = buckets.add(row[1], row[4], value, value, value, 1.0)
+            if bucket is not None: finished.append(resample.live_row(bucket))
+        bucket = buckets.finish() if last else None
+        if bucket is not None: finished.append(resample.live_row(bucket))
+        return finished
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+
+
+def reading(sample, name):
+    # value, unit of a reading of qddb, NaN if the DMM does not display it
+    value = sample['readings'].get(name)
+    if value is None: return math.nan, ''
+    return value['value'], value['unit']
+
+
+def capture(client, rate=None, duration=None, triggers=None, window=None):
+    # Readings at rate per second (None: as fast as possible) for duration seconds (None: until Ctrl-C),
+    # only around the readings that fire a trigger if triggers (Triggers) are given,
+    # resampled in buckets of window seconds if given
+    client.open()
+    info = client.identity()
+    if triggers is not None:
+        triggers = triggers.copy()
+    ring = RingBuffer(pre=triggers.pre if triggers is not None else None)
+    fields = capture_fields + trigger_fields if triggers is not None else capture_fields
+    if window:
+        fields = resample.live_fields
+    writer = client.output()
+    context = {'model': info['model_number'], 'serial': info['serial_number'], 'rate': rate if rate else 'max'}
+    if triggers is not None:
+        context.update(triggers=' '.join(triggers.exprs), pre=triggers.pre, post=triggers.post)
+    if window:
+        context['resample'] = window
+    writer.begin('capture', fields, context, header=[name for name, field_type in fields])
+    flusher = Flusher(ring, writer, resample.Buckets(window) if window else None)
+    flusher.start()
+
+    period = 1.0 / rate if rate else 0.0
+    histogram = [0] * (len(stats.latency_buckets) + 1)
+    readings = 0
+    missed = 0
+    fired_count = 0
+    start = time.perf_counter()
+    slot = start
+    # Index of the slot, slots are computed from it and not added up
+    k = 0
+    try:
+        while flusher.error is None:
+            if duration is not None and slot - start >= duration: break
+            delay = slot - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+            sent = time.perf_counter()
+            raw = client.meter_command('qddb')
+            host_ts = time.time()
+            done = time.perf_counter()
+            sample = client.decode_reply('qddb', decode.decode_qddb, raw)
+            th, tl = decode.words[1].unpack_from(raw, 20)
+            meter_ts, = decode.doubles[1].unpack(decode.words[1].pack(tl, th))
+            primary, primary_unit = reading(sample, 'PRIMARY' if 'PRIMARY' in sample['readings'] else 'LIVE')
+            secondary, secondary_unit = reading(sample, 'SECONDARY')
+            fired = None
+            if triggers is not None:
+                live = sample['readings'].get('LIVE')
+                fired = triggers.check(live['value'] if live is not None else primary, host_ts,
+                                       sample['prim_function'], sample['mode'])
+            if ring.append(host_ts, meter_ts, primary, primary_unit, secondary, secondary_unit,
+                           sample['prim_function'], fired or '') >= ring.capacity // 2:
+                flusher.wakeup.set()
+            if fired is not None:
+                ring.fire(triggers.post)
+                fired_count += 1
+                if client.trace is not None:
+                    client.trace.instant('trigger', args={'trigger': fired})
+            readings += 1
+            histogram[bisect.bisect_left(stats.latency_buckets, done - sent)] += 1
+            if rate:
+                # Slots that went by during this reading are missed
+                late = int((done - slot) / period)
+                if late:
+                    missed += late
+                    if client.trace is not None:
+                        client.trace.instant('missed deadline', args={'slots': late})
+                k += late + 1
+                slot = start + k * period
+            else:
+                slot = done
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Up to the end of the slot of the last reading
+        elapsed = max(time.perf_counter(), slot) - start
+        flusher.stop()
+    if flusher.error is None:
+        try:
+            writer.end()
+        except OSError as error:
+            flusher.error = error
+    if flusher.error is not None:
+        try:
+            writer.close()
+        except OSError:
+            pass
+
+    report = ['Readings', readings, 'Elapsed (s)', '%.3f' % elapsed,
+              'Rate (/s)', '%.2f' % (readings / elapsed if elapsed > 0 else 0.0),
+              'Target (/s)', '%g' % rate if rate else 'max', 'Missed deadlines', missed, 'Lost', ring.lost,
+              'Latency p50 (ms)', stats.histogram_percentile(histogram, 50),
+              'Latency p99 (ms)', stats.histogram_percentile(histogram, 99), 'Batches', flusher.batches]
+    if triggers is not None:
+        report += ['Triggers', fired_count, 'Written', flusher.rows]
+    print(*report, sep=client.sep, file=sys.stderr)
+    if flusher.error is not None:
+        print('Capture output failed:', flusher.error, file=sys.stderr)
+        sys.exit(13)
@@ -0,0 +1,243 @@
+# vim: set fileencoding=utf-8 :
+
+# Decoders for the DMM binary replies.
+# Each layout is declared once as a precompiled struct.Struct.
+# Doubles are sent as two little-endian 32 bits words, most significant word first (see get_double),
+# so they are unpacked as words, then converted together by a second pack/unpack.
+
+import struct
+import time
+
+# Maps used by the decoders, they are turned into tables keyed by integers
+map_names = ['primfunction', 'secfunction', 'autorange', 'unit', 'bolt', 'mode', 'readingid', 'state', 'attribute',
+             'recordtype', 'isstableflag', 'transientstate']
+
+READING_SIZE = 30
+QSRR_SIZE = 146
+
+# readingid, value, unit, unit_multiplier, decimals, display_digits, state, attribute, ts
+reading_struct = struct.Struct('<HIIHhhhHHII')
+# start_ts, end_ts, 3 readings, duration, un2, 1 reading, record_type, stable, transient_state
+qsrr_struct = struct.Struct('<IIII90xHH30xHHH')
+# seq_no, un2, start_ts, end_ts, sample_interval, event_threshold, reading_index, un3, num_samples, un4,
+# prim_function, sec_function, auto_range, unit, range_max, unit_multiplier, bolt, un8, un9, un10, un11,
+# mode, un12, reading count
+qrsi_struct = struct.Struct('<HHIIIIIIIIHHHHHHHHIIhHHHHHHHH')
+# seq_no, un1, prim_function, sec_function, auto_range, unit, range_max, unit_multiplier, bolt,
+# un4, un5, un6, un7, mode, un9, reading count
+qsmr_struct = struct.Struct('<HHHHHHIIhHHHHHHHH')
+# seq_no, un2, start_ts, end_ts, prim_function, sec_function, autorange, unit, range_max, unit_multiplier, bolt,
+# ts3, mode, un8, reading count
+min_max_struct = struct.Struct('<HHIIIIHHHHIIhHIIHHH')
+# prim_function, sec_function, auto_range, unit, range_max, unit_multiplier, bolt, ts, mode, un1, reading count
+qddb_struct = struct.Struct('<HHHHIIhHIIHHH')
+
+words = [struct.Struct('<%dI' % (2 * n)) for n in range(6)]
+doubles = [struct.Struct('<%dd' % n) for n in range(6)]
+
+# Above 2**27, doubles are less precise than 8 decimals, round(ts, 8) would return ts unchanged
+ROUND_LIMIT = 2.0 ** 27
+gmtime_cache = {}
+
+
+def gmtime(ts):
+    # time.gmtime(round(ts, 8)), the readings of a block often share the same timestamps
+    try:
+        return gmtime_cache[ts]
+    except KeyError:
+        if len(gmtime_cache) > 4096:
+            gmtime_cache.clear()
+        value = gmtime_cache[ts] = time.gmtime(ts if ts >= ROUND_LIMIT else round(ts, 8))
+        return value
+
+
+def enum_tables(map_cache):
+    # Maps returned by qemap are keyed by strings
+    return {map_name: {int(key): value for key, value in dmm_map.items()} for map_name, dmm_map in map_cache.items()}
+
+
+def enum_error(tables, *pairs):
+    for map_name, value in pairs:
+        if value not in tables[map_name]:
+            return ValueError('By app: Can not find key %s in map %s' % (value, map_name))
+    return ValueError('By app: Can not decode enumerated values')
+
+
+def decode_readings(buf, offset, count, tables):
+    readings = {}
+    reading_ids = tables['readingid']
+    units = tables['unit']
+    states = tables['state']
+    attributes = tables['attribute']
+    for pos in range(offset, offset + count * READING_SIZE, READING_SIZE):
+        rid, vh, vl, unit, multiplier, decimals, digits, state, attribute, th, tl = reading_struct.unpack_from(buf, pos)
+        value, ts = doubles[2].unpack(words[2].pack(vl, vh, tl, th))
+        try:
+            readings[reading_ids[rid]] = {
+                'value': round(value, 8),
+                'unit': units[unit],
+                'unit_multiplier': multiplier,
+                'decimals': decimals,
+                'display_digits': digits,
+                'state': states[state],
+                'attribute': attributes[attribute],
+                'ts': gmtime(ts)
+            }
+        except KeyError:
+            raise enum_error(tables, ('readingid', rid), ('unit', unit), ('state', state),
+                             ('attribute', attribute)) from None
+    return readings
+
+
+def decode_qsrr(buf, tables):
+    sh, sl, eh, el, duration, un2, record_type, stable, transient_state = qsrr_struct.unpack_from(buf)
+    start_ts, end_ts = doubles[2].unpack(words[2].pack(sl, sh, el, eh))
+    try:
+        return {
+            'start_ts': gmtime(start_ts),
+            'end_ts': gmtime(end_ts),
+            'readings': decode_readings(buf, 16, 3, tables),
+            'duration': duration,
+            'un2': un2,
+            'readings2': decode_readings(buf, 110, 1, tables),
+            'record_type': tables['recordtype'][record_type],
+            'stable': tables['isstableflag'][stable],
+            'transient_state': tables['transientstate'][transient_state]
+        }
+    except KeyError:
+        raise enum_error(tables, ('recordtype', record_type), ('isstableflag', stable),
+                         ('transientstate', transient_state)) from None
+
+
+def decode_qrsi(buf, tables):
+    (seq_no, un2, sh, sl, eh, el, ih, il, th, tl, reading_index, un3, num_samples, un4,
+     prim_function, sec_function, auto_range, unit, rh, rl, unit_multiplier, bolt, un8, un9, un10, un11,
+     mode, un12, reading_count) = qrsi_struct.unpack_from(buf)
+    if len(buf) < reading_count * READING_SIZE + qrsi_struct.size:
+        raise ValueError('By app: qrsi parse error, expected at least %d bytes, got %d'
+                         % (reading_count * READING_SIZE + qrsi_struct.size, len(buf)))
+    start_ts, end_ts, sample_interval, event_threshold, range_max = \
+        doubles[5].unpack(words[5].pack(sl, sh, el, eh, il, ih, tl, th, rl, rh))
+    end = qrsi_struct.size + reading_count * READING_SIZE
+    try:
+        return {
+            'seq_no': seq_no,
+            'un2': un2,
+            'start_ts': gmtime(start_ts),
+            'end_ts': gmtime(end_ts),
+            'sample_interval': round(sample_interval, 8),
+            'event_threshold': round(event_threshold, 8),
+            'reading_index': reading_index,
+            'un3': un3,
+            'num_samples': num_samples,
+            'un4': un4,
+            'prim_function': tables['primfunction'][prim_function],
+            'sec_function': tables['secfunction'][sec_function],
+            'auto_range': tables['autorange'][auto_range],
+            'unit': tables['unit'][unit],
+            'range_max ': round(range_max, 8),
+            'unit_multiplier': unit_multiplier,
+            'bolt': tables['bolt'][bolt],
+            'un8': un8,
+            'un9': un9,
+            'un10': un10,
+            'un11': un11,
+            'mode': [tables['mode'][mode]],
+            'un12': un12,
+            'readings': decode_readings(buf, qrsi_struct.size, reading_count, tables),
+            'name': bytes(buf[end:])
+        }
+    except KeyError:
+        raise enum_error(tables, ('primfunction', prim_function), ('secfunction', sec_function),
+                         ('autorange', auto_range), ('unit', unit), ('bolt', bolt), ('mode', mode)) from None
+
+
+def decode_qsmr(buf, tables):
+    (seq_no, un1, prim_function, sec_function, auto_range, unit, rh, rl, unit_multiplier, bolt,
+     un4, un5, un6, un7, mode, un9, reading_count) = qsmr_struct.unpack_from(buf)
+    if len(buf) < reading_count * READING_SIZE + qsmr_struct.size:
+        raise ValueError('By app: qsmr parse error, expected at least %d bytes, got %d'
+                         % (reading_count * READING_SIZE + qsmr_struct.size, len(buf)))
+    range_max, = doubles[1].unpack(words[1].pack(rl, rh))
+    end = qsmr_struct.size + reading_count * READING_SIZE
+    try:
+        return {
+            '[seq_no': seq_no,
+            'un1': un1,
+            'prim_function': tables['primfunction'][prim_function],
+            'sec_function': tables['secfunction'][sec_function],
+            'auto_range': tables['autorange'][auto_range],
+            'unit': tables['unit'][unit],
+            'range_max': round(range_max, 8),
+            'unit_multiplier': unit_multiplier,
+            'bolt': tables['bolt'][bolt],
+            'un4': un4,
+            'un5': un5,
+            'un6': un6,
+            'un7': un7,
+            'mode': [tables['mode'][mode]],
+            'un9': un9,
+            'readings': decode_readings(buf, qsmr_struct.size, reading_count, tables),
+            'name': bytes(buf[end:])
+        }
+    except KeyError:
+        raise enum_error(tables, ('primfunction', prim_function), ('secfunction', sec_function),
+                         ('autorange', auto_range), ('unit', unit), ('bolt', bolt), ('mode', mode)) from None
+
+
+def decode_min_max(buf, tables):
+    (seq_no, un2, sh, sl, eh, el, prim_function, sec_function, autorange, unit, rh, rl, unit_multiplier, bolt,
+     th, tl, mode, un8, reading_count) = min_max_struct.unpack_from(buf)
+    if len(buf) < reading_count * READING_SIZE + min_max_struct.size:
+        raise ValueError('By app: qsmr parse error, expected at least %d bytes, got %d'
+                         % (reading_count * READING_SIZE + min_max_struct.size, len(buf)))
+    start_ts, end_ts, range_max, ts3 = doubles[4].unpack(words[4].pack(sl, sh, el, eh, rl, rh, tl, th))
+    end = min_max_struct.size + reading_count * READING_SIZE
+    try:
+        return {
+            'seq_no': seq_no,
+            'un2': un2,
+            'start_ts': gmtime(start_ts),
+            'end_ts': gmtime(end_ts),
+            'prim_function': tables['primfunction'][prim_function],
+            'sec_function': tables['secfunction'][sec_function],
+            'autorange': tables['autorange'][autorange],
+            'unit': tables['unit'][unit],
+            'range_max ': round(range_max, 8),
+            'unit_multiplier': unit_multiplier,
+            'bolt': tables['bolt'][bolt],
+            'ts3': gmtime(ts3),
+            'mode': [tables['mode'][mode]],
+            'un8': un8,
+            'readings': decode_readings(buf, min_max_struct.size, reading_count, tables),
+            'name': bytes(buf[end:])
+        }
+    except KeyError:
+        raise enum_error(tables, ('primfunction', prim_function), ('secfunction', sec_function),
+                         ('autorange', autorange), ('unit', unit), ('bolt', bolt), ('mode', mode)) from None
+
+
+def decode_qddb(buf, tables):
+    (prim_function, sec_function, auto_range, unit, rh, rl, unit_multiplier, bolt, th, tl,
+     mode, un1, reading_count) = qddb_struct.unpack_from(buf)
+    if len(buf) != reading_count * READING_SIZE + qddb_struct.size:
+        raise ValueError('By app: qddb parse error, expected %d bytes, got %d'
+                         % ((reading_count * READING_SIZE + qddb_struct.size), len(buf)))
+    range_max, ts = doubles[2].unpack(words[2].pack(rl, rh, tl, th))
+    try:
+        return {
+            'prim_function': tables['primfunction'][prim_function],
+            'sec_function': tables['secfunction'][sec_function],
+            'auto_range': tables['autorange'][auto_range],
+            'unit': tables['unit'][unit],
+            'range_max': round(range_max, 8),
+            'unit_multiplier': unit_multiplier,
+            'bolt': tables['bolt'][bolt],
+            'ts': gmtime(ts),
+            'mode': [tables['mode'][mode]],
+            'un1': un1,
+            'readings': decode_readings(buf, qddb_struct.size, reading_count, tables)
+        }
+    except KeyError:
+        raise enum_error(tables, ('primfunction', prim_function), ('secfunction', sec_function),
+                         ('autorange', auto_range), ('unit', unit), ('bolt', bolt), ('mode', mode)) from None
@@ -8,8 +8,30 @@ import sys
 import datetime
 import calendar
 import argparse
+import atexit
+import concurrent.futures
+import itertools
+import math
 import fluke_28x_dmm_util
+from fluke_28x_dmm_util import decode
+from fluke_28x_dmm_util import batch
+from fluke_28x_dmm_util import recording
+from fluke_28x_dmm_util import writers
+from fluke_28x_dmm_util import store
+from fluke_28x_dmm_util import dump
+from fluke_28x_dmm_util import stats
+from fluke_28x_dmm_util import trace
+from fluke_28x_dmm_util import fleet
+from fluke_28x_dmm_util import capture
+from fluke_28x_dmm_util import resample
 import binascii
+import json
+import os
+import tempfile
+
+# sim:// ports (protocol_sim.py)
+if 'fluke_28x_dmm_util' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('fluke_28x_dmm_util')
 
 
 def version():
@@ -21,12 +43,44 @@ def usage():
     print("Usage: python -m [OPTIONS] fluke_28x_dmm_util] command")
     print("Options:")
     print("  -p|--port <serial port>    Mandatory port name (e.g.: COM3)")
+    print("                             Several ports (repeated -p, comma separated list, or pattern such as")
+    print("                             /dev/ttyUSB*) run the command on all the DMMs at once, output lines are")
+    print("                             tagged with the DMM serial number")
+    print("  --fleet <file>             File listing the ports of the DMMs, one port or pattern per line")
+    print("  --split <directory>        With several DMMs, write the output of each one to its own file")
+    print("  --socket <socket>          Socket of the daemon started by 'serve', if not the default one")
+    print("  --direct                   Use the port directly even if a daemon serves it")
+    print("  --live-rate <rate>         serve: poll the live reading this many times per second, with priority")
+    print("                             over downloads")
+    print("  --trigger <expression>     capture, get current: only write the readings around a trigger:")
+    print("                             '>level', '<level' (crossing), 'slope>rate', 'function' or 'mode' (change)")
+    print("                             Can be repeated")
+    print("  --pre-trigger <count>      Readings written before a trigger, defaults to 100")
+    print("  --post-trigger <count>     Readings written after a trigger, defaults to 100")
     print("  -s|--separator <separator> Separator for lists and recorded values, defaults to tab '\\t',")
     print("  -o|--overloads             Don't display recordings lines containing overloads (lines with values "
           "9.99999999e+37) or invalid values")
     print("                             Applies to 'get recordings' only")
-    print("  -t|--timeout <timeout>     Read timeout. Defaults to 0.09s. Be careful changing this value,")
-    print("                             the effect on the total time is important.")
+    print("  --from <time>              Only the recording samples starting at or after time, UTC as displayed")
+    print("                             (2024-05-01 12:00:00, 2024-05-01) or epoch seconds")
+    print("  --to <time>                Only the recording samples starting before time")
+    print("                             The samples in range are found by bisection, only they are downloaded")
+    print("  --resample <window>        get recordings, capture: one line per window (90, 90s, 15m, 1h, 1d) with")
+    print("                             the minimum, maximum and average, overloads skipped")
+    print("  -t|--timeout <timeout>     Initial read timeout. Defaults to 0.09s. It is then adapted to the")
+    print("                             measured DMM response time of each command.")
+    print("  -d|--deadline <seconds>    Maximum time spent on a command, retries included. Defaults to 10s.")
+    print("  --timing                   Display response times, timeouts and retries of each command on exit")
+    print("  --stats                    Display calls, latency histogram, bytes read, retries and port reopens")
+    print("                             of each command, and the time spent decoding, on exit")
+    print("  --stats-file <file>        Write the same statistics to file on exit, in Prometheus text format")
+    print("  --trace <file>             Write a timeline of commands, retries, decoding and output to file,")
+    print("                             in Chrome Trace Event format (Perfetto, chrome://tracing)")
+    print("  -w|--window <count>        Number of samples requested in advance when downloading recordings.")
+    print("                             Defaults to 1 (one request at a time). Applies to 'get recordings' only")
+    print("  --refresh-cache            Ignore the maps cached on disk for this DMM and download them again")
+    print("  -f|--format <format>       Output format of lists, saved items and recordings: tsv (default),")
+    print("                             csv, ndjson or binary")
     print("")
     print("Command:")
     print("")
@@ -35,7 +89,7 @@ def usage():
     print("  get minmax {name | index} [,{name | index}...]")
     print("  get peak {name | index} [,{name | index}...]")
     print("  get measurements {name | index} [,{name | index}...]")
-    print("  get current: get current measured values")
+    print("  get current: get current measured values, with --trigger or --resample: as 'capture max'")
     print("  get config: get DMM configuration")
     print("  get names: get DMM names prefix used for storing data")
     print("")
@@ -64,45 +118,41 @@ def usage():
     print("  list measurements: list all the measurements")
     print("  list all: list all the memory stored values")
     print("")
+    print("dump <file>")
+    print("  Store the raw replies of the DMM for all the saved items in file, with the maps needed to decode them")
+    print("")
+    print("decode <file>")
+    print("  Display the content of a file written by 'dump'. Recordings are decoded in parallel")
+    print("")
+    print("capture [rate] [seconds]")
+    print("  Take rate live readings per second ('max' or no rate: as fast as possible) for seconds, or until")
+    print("  Ctrl-C. Missed deadlines and the achieved rate are displayed at the end")
+    print("")
+    print("serve [socket]")
+    print("  Keep the port open and serve the commands of other calls of this utility on a Unix domain socket,")
+    print("  which defaults to one per port. Calls with the same port (or --socket) use it automatically")
+    print("  Live readings go before other commands, downloads use the remaining capacity")
+    print("")
+    print("sync [directory]")
+    print("  Download the recordings that are not stored yet in directory, and the new samples of the")
+    print("  recordings that have grown. Defaults to ~/.local/share/fluke_28x_dmm_util")
+    print("")
     sys.exit()
 
 
-def do_get_names():
-    start_serial()
+def do_get_names(client):
+    client.open()
     for i in range(1, 9):
         cmd = 'qsavname ' + str(i - 1) + '\r'
-        res = meter_command(cmd)
-        print(i, res[0].split('\r')[0], sep=sep)
+        res = client.meter_command(cmd)
+        print(i, res[0].split('\r')[0], sep=client.sep)
 
 
-def start_serial():
-    global ser
-    global port
-    # serial port settings
-    try:
-        ser = serial.Serial(port=port,
-                            baudrate=115200, bytesize=8, parity='N', stopbits=1,
-                            timeout=timeout, rtscts=False, dsrdtr=False)
-    except serial.serialutil.SerialException as err:
-        print('Serial port ' + port + ' does not respond')
-        print(err)
-        sys.exit(1)
-
-
-def do_sync_time():
-    lt = calendar.timegm(datetime.datetime.now().utctimetuple())
-    cmd = 'mp clock,' + str(lt)
-    ser.write(cmd.encode() + b'\r')
-    time.sleep(0.1)
-    res = ser.read(2)
-    if res == b'0\r': print("Successfully synced the clock of the DMM")
-
-
-def do_current():
-    start_serial()
+def do_current(client):
+    client.open()
     while True:
         try:
-            res = qddb()
+            res = client.qddb()
             print(time.strftime('%Y-%m-%d %H:%M:%S', res['readings']['LIVE']['ts']),
                   ":",
                   res['readings']['LIVE']['value'],
@@ -113,6 +163,20 @@ def do_current():
             sys.exit(2)
 
 
+def do_capture(client, args):
+    rate = None
+    duration = None
+    try:
+        if args and args[0] != 'max':
+            rate = float(args[0])
+            if not 0 < rate < math.inf: usage()
+        if len(args) > 1:
+            duration = float(args[1])
+    except ValueError:
+        usage()
+    capture.capture(client, rate, duration, client.triggers, client.resample)
+
+
 def format_duration(start_time, end_time):
     seconds = time.mktime(end_time) - time.mktime(start_time)
     m, s = divmod(int(seconds), 60)
@@ -121,98 +185,76 @@ def format_duration(start_time, end_time):
     return f'{d:02d}:{h:02d}:{m:02d}:{s:02d}'
 
 
-def do_list(kind_rec):
-    start_serial()
-    nb = qsls()
-    nbr = int(nb['nb_recordings'])
-    nbmm = int(nb['nb_min_max'])
-    nbp = int(nb['nb_peak'])
+def do_list(client, kind_rec):
+    client.open()
+    catalog = client.catalog()
 
     items = {}
     if kind_rec == 'recordings':
-        items[kind_rec] = {'cmd': 'qrsi', 'nb': nbr, 'lib': 'Recording'}
+        items[kind_rec] = {'lib': 'Recording'}
     elif kind_rec == 'minmax':
-        items[kind_rec] = {'cmd': 'qmmsi', 'nb': nbmm, 'lib': 'MinMax'}
+        items[kind_rec] = {'lib': 'MinMax'}
     elif kind_rec == 'peak':
-        items[kind_rec] = {'cmd': 'qpsi', 'nb': nbp, 'lib': 'Peak'}
+        items[kind_rec] = {'lib': 'Peak'}
     else:
-        items = {'minmax': {'cmd': 'qmmsi', 'nb': nbmm, 'lib': 'MinMax'},
-                 'peak': {'cmd': 'qpsi', 'nb': nbp, 'lib': 'Peak'},
-                 'recordings': {'cmd': 'qrsi', 'nb': nbr, 'lib': 'Recording'}}
+        items = {'minmax': {'lib': 'MinMax'},
+                 'peak': {'lib': 'Peak'},
+                 'recordings': {'lib': 'Recording'}}
 
+    writer = client.output()
     for item in items:
-        cmd = items[item]['cmd']
-        nb = items[item]['nb']
         lib = items[item]['lib']
         if item in ['minmax', 'peak']:
-            print('Index', 'Name', 'Type', 'Start', 'End', 'Duration', sep=sep)
-            for i in range(1, nb + 1):
-                mm = do_min_max_cmd(cmd, str(i - 1))
-                duration = format_duration(mm['start_ts'], mm['end_ts'])
-                name = mm['name'].decode()
-                debut_d = time.strftime('%Y-%m-%d %H:%M:%S', mm['start_ts'])
-                fin_d = time.strftime('%Y-%m-%d %H:%M:%S', mm['end_ts'])
-                print(f'{i:d}', name, lib, debut_d, fin_d,
-                      duration, sep=sep)
-            print('')
+            writer.begin('list', list_fields, header=['Index', 'Name', 'Type', 'Start', 'End', 'Duration'], footer='')
+            for entry in catalog[item]:
+                duration = format_duration(time.gmtime(entry['start']), time.gmtime(entry['end']))
+                writer.row((entry['index'], entry['name'], lib, entry['start'], entry['end'], duration))
+            writer.end()
 
         if item == 'recordings':
-            print('Index', 'Name', 'Type', 'Start', 'End', 'Duration', 'Measurements', sep=sep)
-            for i in range(1, nb + 1):
-                recording = qrsi(str(i - 1))
-                duration = format_duration(recording['start_ts'], recording['end_ts'])
-                name = recording['name'].decode()
-                # sample_interval = recording['sample_interval']
-                num_samples = recording['num_samples']
-                debut_d = time.strftime('%Y-%m-%d %H:%M:%S', recording['start_ts'])
-                fin_d = time.strftime('%Y-%m-%d %H:%M:%S', recording['end_ts'])
-                print(f'{i:d}', name, lib, debut_d, fin_d,
-                      duration, num_samples, sep=sep)
-            print('')
+            writer.begin('list', list_fields + [('measurements', writers.INT)],
+                         header=['Index', 'Name', 'Type', 'Start', 'End', 'Duration', 'Measurements'], footer='')
+            for entry in catalog[item]:
+                duration = format_duration(time.gmtime(entry['start']), time.gmtime(entry['end']))
+                writer.row((entry['index'], entry['name'], lib, entry['start'], entry['end'], duration,
+                            entry['num_samples']))
+            writer.end()
 
     if kind_rec == 'all':
-        do_saved_measurements()
-        print('')
-
-
-def qddb():
-    current_bytes = meter_command("qddb")
-
-    reading_count = get_u16(current_bytes, 32)
-    if len(current_bytes) != reading_count * 30 + 34:
-        raise ValueError(
-            'By app: qddb parse error, expected %d bytes, got %d' % ((reading_count * 30 + 34), len(current_bytes)))
-    # tsval = get_double(bytes, 20)
-    # all bytes parsed
-    return {
-        'prim_function': get_map_value('primfunction', current_bytes, 0),
-        'sec_function': get_map_value('secfunction', current_bytes, 2),
-        'auto_range': get_map_value('autorange', current_bytes, 4),
-        'unit': get_map_value('unit', current_bytes, 6),
-        'range_max': get_double(current_bytes, 8),
-        'unit_multiplier': get_s16(current_bytes, 16),
-        'bolt': get_map_value('bolt', current_bytes, 18),
-        #    'ts' : (tsval < 0.1) ? nil : parse_time(tsval), # 20
-        'ts': 0,
-        'mode': get_multimap_value('mode', current_bytes, 28),
-        'un1': get_u16(current_bytes, 30),
-        # 32 is reading count
-        'readings': parse_readings(current_bytes[34:])
-    }
-
-
-def do_set(parameter):
-    start_serial()
+        do_saved_measurements(client, footer='')
+
+
+def find_saved(client, kind, name):
+    # Index (from 1) of the saved item with this name, None if there is none
+    for entry in client.catalog()[kind]:
+        if entry['name'] == name: return entry['index']
+    return None
+
+
+def do_sync(client, directory=None):
+    client.open()
+    start_time = time.time()
+    sample_store = store.SampleStore(directory or store.store_dir(), client.identity())
+    synced = store.sync(client, sample_store)
+    for entry, first, count in synced:
+        print(entry['index'], entry['name'], 'new recording' if first == 0 else 'samples from %d' % (first + 1),
+              count, sep=client.sep)
+    print('Synced %d recordings, %d samples in %.2fs to %s'
+          % (len(synced), sum(count for entry, first, count in synced), time.time() - start_time, sample_store.path))
+
+
+def do_set(client, parameter):
+    client.open()
     property_name = parameter[0]
     match property_name:
         case 'company' | 'site' | 'operator' | 'contact':
             if len(parameter) != 2: usage()
             value = parameter[1]
             cmd = 'mpq ' + property_name + ",'" + value + "'\r"
-            meter_command(cmd)
+            client.meter_command(cmd)
         case 'datetime':
             if len(parameter) != 1: usage()
-            do_sync_time()
+            if client.sync_time(): print("Successfully synced the clock of the DMM")
         # case 'autohold_threshold':
         #     if len(parameter) != 2: usage()
         #     value = parameter[1]
@@ -222,143 +264,854 @@ def do_set(parameter):
             index = int(parameter[1])
             name = parameter[2]
             cmd = 'savname ' + str(index - 1) + ',"' + name + '"\r'
-            meter_command(cmd)
+            client.meter_command(cmd)
         case _:
             usage()
     print("Successfully set", property_name, "value")
 
 
-def do_get_config():
-    start_serial()
-    info = meter_id()
+def do_get_config(client):
+    client.open()
+    info = client.meter_id()
     print("Model:", info['model_number'])
     print("Software Version:", info['software_version'])
     print("Serial Number:", info['serial_number'])
-    print("Current meter time:", time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(clock()))))
-    print("Company:", meter_command("qmpq company")[0].lstrip("'").rstrip("'"))
-    print("Contact:", meter_command("qmpq contact")[0].lstrip("'").rstrip("'"))
-    print("Operator:", meter_command("qmpq operator")[0].lstrip("'").rstrip("'"))
-    print("Site:", meter_command("qmpq site")[0].lstrip("'").rstrip("'"))
-    print("Autohold Threshold:", meter_command("qmp aheventTh")[0].lstrip("'").rstrip("'"))
-    print("Language:", meter_command("qmp lang")[0].lstrip("'").rstrip("'"))
-    print("Date Format:", meter_command("qmp dateFmt")[0].lstrip("'").rstrip("'"))
-    print("Time Format:", meter_command("qmp timeFmt")[0].lstrip("'").rstrip("'"))
-    print("Digits:", meter_command("qmp digits")[0].lstrip("'").rstrip("'"))
-    print("Beeper:", meter_command("qmp beeper")[0].lstrip("'").rstrip("'"))
-    print("Temperature Offset Shift:", meter_command("qmp tempOS")[0].lstrip("'").rstrip("'"))
-    print("Numeric Format:", meter_command("qmp numFmt")[0].lstrip("'").rstrip("'"))
-    print("Auto Backlight Timeout:", meter_command("qmp ablto")[0].lstrip("'").rstrip("'"))
-    print("Auto Power Off:", meter_command("qmp apoffto")[0].lstrip("'").rstrip("'"))
-
-
-def meter_id():
-    res = meter_command("ID")
-    return {'model_number': res[0], 'software_version': res[1], 'serial_number': res[2]}
-
-
-def qsls():
-    res = meter_command("qsls")
-    return {'nb_recordings': res[0], 'nb_min_max': res[1], 'nb_peak': res[2], 'nb_measurements': res[3]}
-
-
-def clock():
-    res = meter_command("qmp clock")
-    return res[0]
-
-
-def qsrr(reading_idx, sample_idx):
-    retry_count = 0
-    res = ''
-    while retry_count < 20:
-        #    print ("in qsrr reading_idx=",reading_idx,",sample_idx",sample_idx)
-        res = meter_command("qsrr " + reading_idx + "," + sample_idx)
-        #    print('qsrr',binascii.hexlify(res))
-        if len(res) == 146:
-            return {
-                'start_ts': parse_time(get_double(res, 0)),
-                'end_ts': parse_time(get_double(res, 8)),
-                'readings': parse_readings(res[16:16 + 30 * 3]),
-                'duration': round(get_u16(res, 106), 5),
-                'un2': get_u16(res, 108),
-                'readings2': parse_readings(res[110:110 + 30]),
-                'record_type': get_map_value('recordtype', res, 140),
-                'stable': get_map_value('isstableflag', res, 142),
-                'transient_state': get_map_value('transientstate', res, 144)
-            }
-        else:
-            #      print ('============== RETRY ===============')
-            retry_count += 1
+    print("Current meter time:", time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(client.clock()))))
+    print("Company:", client.meter_command("qmpq company")[0].lstrip("'").rstrip("'"))
+    print("Contact:", client.meter_command("qmpq contact")[0].lstrip("'").rstrip("'"))
+    print("Operator:", client.meter_command("qmpq operator")[0].lstrip("'").rstrip("'"))
+    print("Site:", client.meter_command("qmpq site")[0].lstrip("'").rstrip("'"))
+    print("Autohold Threshold:", client.meter_command("qmp aheventTh")[0].lstrip("'").rstrip("'"))
+    print("Language:", client.meter_command("qmp lang")[0].lstrip("'").rstrip("'"))
+    print("Date Format:", client.meter_command("qmp dateFmt")[0].lstrip("'").rstrip("'"))
+    print("Time Format:", client.meter_command("qmp timeFmt")[0].lstrip("'").rstrip("'"))
+    print("Digits:", client.meter_command("qmp digits")[0].lstrip("'").rstrip("'"))
+    print("Beeper:", client.meter_command("qmp beeper")[0].lstrip("'").rstrip("'"))
+    print("Temperature Offset Shift:", client.meter_command("qmp tempOS")[0].lstrip("'").rstrip("'"))
+    print("Numeric Format:", client.meter_command("qmp numFmt")[0].lstrip("'").rstrip("'"))
+    print("Auto Backlight Timeout:", client.meter_command("qmp ablto")[0].lstrip("'").rstrip("'"))
+    print("Auto Power Off:", client.meter_command("qmp apoffto")[0].lstrip("'").rstrip("'"))
+
+
+def do_saved_peak(client, records):
+    do_saved_min_max_peak(client, records, 'peak', 'qpsi')
+
+
+def do_saved_min_max(client, records):
+    do_saved_min_max_peak(client, records, 'minmax', 'qmmsi')
+
+
+def do_saved_min_max_peak(client, records, kind, cmd):
+    client.open()
+    if len(records) == 0:
+        series = [str(entry['index']) for entry in client.catalog()[kind]]
+    else:
+        series = records
+    found = False
+
+    for i in series:
+        index = int(i) if i.isdigit() else find_saved(client, kind, i)
+        if index is not None:
+            measurement = client.min_max_peak(cmd, str(index - 1))
+            print_min_max_peak(client, measurement, kind)
+            found = True
+    if not found:
+        print("Saved names not found")
+        sys.exit(3)
+
+
+def print_min_max_peak(client, measurement, kind='minmax'):
+    writer = client.output()
+    name = (measurement['name']).decode('utf-8')
+    title = ' '.join([name, 'start', writer.format_time(measurement['start_ts']), measurement['autorange'],
+                      'Range', str(int(measurement['range_max '])), measurement['unit']])
+    footer = ' '.join([name, 'end', writer.format_time(measurement['end_ts'])])
+    context = {'name': name, 'start': measurement['start_ts'], 'end': measurement['end_ts'],
+               'autorange': measurement['autorange'], 'range': int(measurement['range_max ']),
+               'range_unit': measurement['unit']}
+    writer.begin(kind, min_max_fields, context, title=title, footer=footer, indent=2)
+    print_min_max_peak_detail(client, measurement, 'PRIMARY')
+    print_min_max_peak_detail(client, measurement, 'MAXIMUM')
+    print_min_max_peak_detail(client, measurement, 'AVERAGE')
+    print_min_max_peak_detail(client, measurement, 'MINIMUM')
+    writer.end()
+
+
+def print_min_max_peak_detail(client, measurement, detail):
+    client.output().row((detail,
+                         measurement['readings'][detail]['value'],
+                         measurement['readings'][detail]['unit'],
+                         measurement['readings'][detail]['ts']))
+
+
+def do_saved_measurements(client, records=None, footer=None):
+    client.open()
+    writer = client.output()
+    found = False
+
+    writer.begin('measurement', measurement_fields,
+                 header=['Index', 'Name', 'Type', 'Datetime', 'Measurement', 'Unit'], footer=footer)
+
+    if records is None:
+        # Whole list, from the catalog
+        for entry in client.catalog()['measurements']:
+            writer.row((entry['index'], entry['name'], 'Measurement', entry['start'], entry['value'], entry['unit']))
+            found = True
+        records = []
+
+    for i in records:
+        index = int(i) if i.isdigit() else find_saved(client, 'measurements', i)
+        if index is not None:
+            measurement = client.qsmr(str(index - 1))
+            writer.row((i if i.isdigit() else index, (measurement['name']).decode('utf-8'),
+                        'Measurement',
+                        measurement['readings']['PRIMARY']['ts'],
+                        measurement['readings']['PRIMARY']['value'],
+                        measurement['readings']['PRIMARY']['unit']))
+            found = True
+    writer.end()
+    if not found:
+        print("Saved names not found")
+        sys.exit(4)
 
-    raise ValueError('By app: Invalid block size: %d should be 146' % (len(res)))
-
-
-def parse_readings(reading_bytes):
-    # print ("in parse_readings,reading_bytes=",reading_bytes,"lgr:",len(reading_bytes))
-    readings = {}
-    chunks, chunk_size = len(reading_bytes), 30
-    list_readings = [reading_bytes[i:i + chunk_size] for i in range(0, chunks, chunk_size)]
-    for r in list_readings:
-        readings[get_map_value('readingid', r, 0)] = {
-            'value': get_double(r, 2),
-            'unit': get_map_value('unit', r, 10),
-            'unit_multiplier': get_s16(r, 12),
-            'decimals': get_s16(r, 14),
-            'display_digits': get_s16(r, 16),
-            'state': get_map_value('state', r, 18),
-            'attribute': get_map_value('attribute', r, 20),
-            'ts': get_time(r, 22)
-        }
-    # print('------', readings, type(readings))
-    return readings
-
-
-def get_map_value(map_name, string, offset):
-    #  print "map_name",map_name,"in map_cache",map_name in map_cache
-    if map_name in map_cache:
-        dmm_map = map_cache[map_name]
+
+def do_recordings(client, records):
+    client.open()
+    if len(records) == 0:
+        series = [str(entry['index']) for entry in client.catalog()['recordings']]
     else:
-        dmm_map = qemap(map_name)
-        map_cache[map_name] = dmm_map
-    value = str(get_u16(string, offset))
-    if value not in dmm_map:
-        raise ValueError('By app: Can not find key %s in map %s' % (value, map_name))
-    # print("--->", map_name, value, dmm_map[value], type(dmm_map[value]))
-    return dmm_map[value]
-
-
-def get_multimap_value(map_name, string, offset):
-    #  print "in get_multimap_value,map_name=",map_name
-    #  print "map_name",map_name,"in map_cache",map_name in map_cache
-    if map_name in map_cache:
-        dmm_map = map_cache[map_name]
+        series = records
+    found = False
+
+    for i in series:
+        index = int(i) if i.isdigit() else find_saved(client, 'recordings', i)
+        if index is not None:
+            recording = client.qrsi(str(index - 1))
+            print_recording(client, i if i.isdigit() else index, recording)
+            found = True
+    if not found:
+        print("Saved names not found")
+        sys.exit(5)
+
+
+def print_recording(client, index, recording):
+    writer = client.output()
+    begin_recording(writer, index, recording, client.resample)
+    start_time = time.time()
+    first, last = 0, recording['num_samples']
+    if client.time_range is not None:
+        first, last = client.qsrr_range(str(recording['reading_index']), recording, *client.time_range)
+    samples = client.qsrr_samples(str(recording['reading_index']), last, first)
+    if client.resample:
+        rows = resample.recording_rows(samples, client.resample)
     else:
-        dmm_map = qemap(map_name)
-        map_cache[map_name] = dmm_map
-    #  print "in get_multimap_value,map=",map
-    value = str(get_u16(string, offset))
-    #  print "in get_multimap_value,value=",value
-    if value not in dmm_map:
-        raise ValueError('By app: Can not find key %s in map %s' % (value, map_name))
-    ret = [dmm_map[value]]
-    #  print "in get_multimap_value,ret=",ret
-    #  print "+++>",value,map[value],"ret",ret
-    return ret
-
-
-def qemap(map_name):
-    res = meter_command("qemap " + str(map_name))
-    # print("Traitement de la map: ", map_name)
-    # print("res dans qemap=",res)
-    # print("in qemap. Longueur=",len(res))
-    entry_count = int(res.pop(0))
-    # print("in qemap. entry_count=",entry_count)
-    if len(res) != entry_count * 2:
-        raise ValueError('By app: Error parsing qemap')
-    dmm_map = {}
-    for i in range(0, len(res), 2):
-        dmm_map[res[i]] = res[i + 1]
-    #  print "map dans qemap:",map
-    return dmm_map
+        rows = recording_rows(samples, client.overloads)
+    for row in rows:
+        writer.row(row)
+    writer.end()
+    if client.window > 1:
+        elapsed = time.time() - start_time
+        rate = (last - first) / elapsed if elapsed > 0 else 0
+        print('Downloaded %d samples in %.2fs (%.1f samples/s)' % (last - first, elapsed, rate), file=sys.stderr)
+
+
+def begin_recording(writer, index, recording, window=None):
+    # window: seconds of the buckets of resampled rows
+    duration = format_duration(recording['start_ts'], recording['end_ts'])
+    title = 'Index %s, Name %s, Start %s, End %s, Duration %s, Measurements %s' \
+            % (str(index), (recording['name']).decode(), writer.format_time(recording['start_ts']),
+               writer.format_time(recording['end_ts']), duration, recording['num_samples'])
+    context = {'index': int(index), 'name': (recording['name']).decode()}
+    if window:
+        context['resample'] = window
+        writer.begin('recording', resample.recording_fields, context, title=title, header=resample.recording_header,
+                     footer='')
+        return
+    writer.begin('recording', recording_fields, context, title=title,
+                 header=['Start Time', 'Primary', '', 'Maximum', '', 'Average', '', 'Minimum', '', '#Samples', 'Type'],
+                 footer='')
+
+
+def recording_rows(samples, overloads=False):
+    # Output rows of decoded qsrr samples
+    for measurement in samples:
+        # print ('measurement',measurement)
+        if overloads and resample.overloaded(measurement):
+            continue
+        duration = round(measurement['readings']['AVERAGE']['value']
+                         / measurement['duration'], measurement['readings']['AVERAGE']['decimals']) \
+            if measurement['duration'] != 0 else 0
+        yield (measurement['start_ts'],
+               measurement['readings2']['PRIMARY']['value'],
+               measurement['readings2']['PRIMARY']['unit'],
+               measurement['readings']['MAXIMUM']['value'],
+               measurement['readings']['MAXIMUM']['unit'],
+               duration,
+               measurement['readings']['AVERAGE']['unit'],
+               measurement['readings']['MINIMUM']['value'],
+               measurement['readings']['MINIMUM']['unit'],
+               measurement['duration'],
+               'INTERVAL' if measurement['record_type'] == 'INTERVAL' else measurement['stable'])
+
+
+def decode_blocks_rows(blocks, tables, overloads):
+    # Run in the worker processes of 'decode': rows of a chunk of qsrr blocks stacked in one bytes
+    samples = (decode.decode_qsrr(blocks[offset:offset + decode.QSRR_SIZE], tables)
+               for offset in range(0, len(blocks), decode.QSRR_SIZE))
+    return list(recording_rows(samples, overloads))
+
+
+def do_dump(client, path):
+    # Raw replies of all the saved items, with the maps needed to decode them
+    client.open()
+    start_time = time.time()
+    client.dump = dump.DumpWriter(path)
+    client.meter_id()
+    for map_name in decode.map_names:
+        client.map_cache[map_name] = client.qemap(map_name)
+    counts = client.qsls()
+    for kind, (field, cmd) in catalog_kinds.items():
+        for i in range(int(counts[field])):
+            res = client.meter_command(cmd + ' ' + str(i))
+            if cmd == 'qrsi':
+                header = decode.qrsi_struct.unpack_from(res)
+                reading_index, num_samples = header[10], header[12]
+                # Blocks go to the dump as they arrive, nothing else is done with them
+                for block in client.qsrr_blocks(str(reading_index), num_samples):
+                    pass
+    client.dump.close()
+    print('Dumped %d replies, %d bytes in %.2fs to %s'
+          % (client.dump.frames, client.dump.size, time.time() - start_time, path), file=sys.stderr)
+    client.dump = None
+
+
+def do_decode(client, path):
+    # Output of a dump: recordings, min/max, peak and measurements. Recordings are decoded by a pool of processes
+    content = dump.Dump(path)
+    tables = decode.enum_tables(content.maps)
+    writer = client.output()
+    recordings = []
+    tasks = []
+    for i, res in sorted(content.items['qrsi'].items()):
+        recording = decode.decode_qrsi(res, tables)
+        blocks = content.recording_blocks(recording['reading_index'], recording['num_samples'])
+        chunks = [b''.join(blocks[k:k + decode_chunk]) for k in range(0, len(blocks), decode_chunk)]
+        recordings.append((i, recording, len(chunks)))
+        tasks.extend(chunks)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(decode_blocks_rows, tasks, itertools.repeat(tables), itertools.repeat(client.overloads))
+        for i, recording, chunk_count in recordings:
+            begin_recording(writer, i + 1, recording)
+            for k in range(chunk_count):
+                for row in next(results):
+                    writer.row(row)
+            writer.end()
+    for kind, cmd in [('minmax', 'qmmsi'), ('peak', 'qpsi')]:
+        for i, res in sorted(content.items[cmd].items()):
+            print_min_max_peak(client, decode.decode_min_max(res, tables), kind)
+    if content.items['qsmr']:
+        writer.begin('measurement', measurement_fields,
+                     header=['Index', 'Name', 'Type', 'Datetime', 'Measurement', 'Unit'])
+        for i, res in sorted(content.items['qsmr'].items()):
+            measurement = decode.decode_qsmr(res, tables)
+            primary = measurement['readings']['PRIMARY']
+            writer.row((i + 1, (measurement['name']).decode('utf-8'), 'Measurement', primary['ts'], primary['value'],
+                        primary['unit']))
+        writer.end()
+
+
+class DmmClient:
+    # A connection to one DMM, with its maps cache, settings and response time estimates.
+    # It can be used for any number of commands, the port is opened once.
+
+    def __init__(self, port, timeout=0.09, sep='\t', overloads=False, window=1, deadline=10.0,
+                 refresh_cache=False, output_format='tsv'):
+        self.port = port
+        self.timeout = timeout
+        self.sep = sep
+        self.output_format = output_format
+        self.writer = None
+        # Stream of the writer (defaults to stdout), and context added to all its tables
+        self.out = None
+        self.tags = {}
+        # writers.SharedHeaders of the DMMs of a fleet writing to the same stream
+        self.headers = None
+        # DumpWriter receiving the raw replies, for 'dump'
+        self.dump = None
+        # stats.Stats counting the commands, for --stats
+        self.stats = None
+        # trace.Tracer receiving the timeline, for --trace
+        self.trace = None
+        # Live readings per second polled by 'serve'
+        self.live_rate = None
+        # capture.Triggers of 'capture' and 'get current', for --trigger
+        self.triggers = None
+        # (start, end) epoch seconds of the samples of 'get recordings', for --from and --to, None items: no limit
+        self.time_range = None
+        # Seconds of the buckets of 'get recordings' and 'capture', for --resample
+        self.resample = None
+        self.overloads = overloads
+        self.window = window
+        self.deadline = deadline
+        self.refresh_cache = refresh_cache
+        self.ser = None
+        self.map_cache = {}
+        self.map_cache_loaded = False
+        self.tables = None
+        self.meter_info = None
+        self.catalog_items = None
+        # Adaptive timeouts, per command
+        self.rtt_estimates = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def copy(self, port):
+        # A client for another DMM, with the same settings
+        client = DmmClient(port, self.timeout, self.sep, self.overloads, self.window, self.deadline, self.refresh_cache,
+                           self.output_format)
+        client.trace = self.trace
+        client.triggers = self.triggers
+        client.time_range = self.time_range
+        client.resample = self.resample
+        return client
+
+    def output(self):
+        # Writer of the command results, on stdout
+        if self.writer is None:
+            self.writer = writers.make_writer(self.output_format, self.sep, self.out)
+            self.writer.tags = self.tags
+            self.writer.headers = self.headers
+            self.writer.trace = self.trace
+            atexit.register(self.writer.close)
+        return self.writer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.ser is not None and self.ser.is_open: return
+        # serial port settings
+        try:
+            self.ser = serial.serial_for_url(self.port,
+                                             baudrate=115200, bytesize=8, parity='N', stopbits=1,
+                                             timeout=self.timeout, rtscts=False, dsrdtr=False)
+        except (serial.serialutil.SerialException, ValueError) as err:
+            print('Serial port ' + self.port + ' does not respond')
+            print(err)
+            sys.exit(1)
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+
+    def sync_time(self):
+        lt = calendar.timegm(datetime.datetime.now().utctimetuple())
+        cmd = 'mp clock,' + str(lt)
+        self.ser.write(cmd.encode() + b'\r')
+        time.sleep(0.1)
+        res = self.ser.read(2)
+        return res == b'0\r'
+
+    def qddb(self):
+        return self.decode_reply('qddb', decode.decode_qddb, self.meter_command("qddb"))
+
+    def meter_id(self):
+        res = self.meter_command("ID")
+        return {'model_number': res[0], 'software_version': res[1], 'serial_number': res[2]}
+
+    def qsls(self):
+        res = self.meter_command("qsls")
+        return {'nb_recordings': res[0], 'nb_min_max': res[1], 'nb_peak': res[2], 'nb_measurements': res[3]}
+
+    def clock(self):
+        res = self.meter_command("qmp clock")
+        return res[0]
+
+    def qsrr(self, reading_idx, sample_idx):
+        return self.decode_qsrr(self.qsrr_raw(reading_idx, sample_idx))
+
+    def qsrr_raw(self, reading_idx, sample_idx):
+        # Retries of a block of the wrong size share one deadline, a bad block does not stall a download
+        retry_count = 0
+        res = ''
+        end = time.time() + self.deadline
+        while retry_count < 20 and time.time() < end:
+            #    print ("in qsrr reading_idx=",reading_idx,",sample_idx",sample_idx)
+            res = self.meter_command("qsrr " + reading_idx + "," + sample_idx, end - time.time())
+            #    print('qsrr',binascii.hexlify(res))
+            if len(res) == decode.QSRR_SIZE:
+                return res
+            else:
+                #      print ('============== RETRY ===============')
+                retry_count += 1
+                if self.stats is not None: self.stats.retry('qsrr')
+
+        raise ValueError('By app: Invalid block size: %d should be 146' % (len(res)))
+
+    def decode_qsrr(self, res):
+        return self.decode_reply('qsrr', decode.decode_qsrr, res)
+
+    def decode_reply(self, verb, decoder, res):
+        tables = self.enum_tables()
+        if self.trace is None:
+            return decoder(res, tables)
+        start = self.trace.now()
+        result = decoder(res, tables)
+        self.trace.span('decode ' + verb, start, cat='decode')
+        return result
+
+    def qsrr_samples(self, reading_idx, num_samples, first=0):
+        tables = self.enum_tables()
+        if self.stats is None and self.trace is None:
+            for block in self.qsrr_blocks(reading_idx, num_samples, first):
+                yield decode.decode_qsrr(block, tables)
+            return
+        for block in self.qsrr_blocks(reading_idx, num_samples, first):
+            start = time.perf_counter()
+            sample = decode.decode_qsrr(block, tables)
+            end = time.perf_counter()
+            if self.stats is not None: self.stats.decoded(end - start)
+            if self.trace is not None: self.trace.span('decode qsrr', start, end, 'decode')
+            yield sample
+
+    def qsrr_blocks(self, reading_idx, num_samples, first=0):
+        # Yields the raw qsrr blocks of a recording, keeping up to window qsrr requests in flight.
+        # Replies come back in the order of the requests, a missing or out of order reply
+        # switches back to one request at a time for the remaining samples.
+        k = first
+        if self.window > 1:
+            sent = first
+            last_start = None
+            estimate = self.rtt_estimate('qsrr')
+            while k < num_samples:
+                self.set_read_timeout(estimate['rto'])
+                while sent < num_samples and sent - k < self.window:
+                    write_start = time.perf_counter()
+                    self.ser.write(('qsrr ' + reading_idx + ',' + str(sent) + '\r').encode())
+                    if self.trace is not None:
+                        self.trace.span('write', write_start, args={'cmd': 'qsrr ' + reading_idx + ',' + str(sent)})
+                    sent += 1
+                read_start = time.perf_counter()
+                data, complete = self.read_reply('qsrr')
+                if self.stats is not None:
+                    self.stats.read('qsrr', len(data))
+                    if complete: self.stats.command('qsrr', time.perf_counter() - read_start)
+                if complete and data.startswith(b'0\r#0') and len(data) == decode.QSRR_SIZE + 5:
+                    start = get_double(data, 4)
+                    if last_start is None or start >= last_start:
+                        last_start = start
+                        estimate['count'] += 1
+                        if self.dump is not None:
+                            self.dump.frame('qsrr ' + reading_idx + ',' + str(k), data)
+                        yield data[4:-1]
+                        k += 1
+                        continue
+                # Wait for the replies still in flight before going on one by one
+                estimate['retries'] += 1
+                if self.stats is not None: self.stats.pipeline_fallbacks += 1
+                if self.trace is not None: self.trace.instant('pipeline fallback', args={'sample': k})
+                while self.ser.read(max(self.ser.in_waiting, 1)):
+                    pass
+                self.ser.reset_input_buffer()
+                break
+        for k in range(k, num_samples):
+            yield self.qsrr_raw(reading_idx, str(k))
+
+    def qsrr_columns(self, reading_idx, num_samples, first=0):
+        # Samples of a recording decoded at once by NumPy, as column arrays
+        blocks = b''.join(self.qsrr_blocks(reading_idx, num_samples, first))
+        return batch.decode_qsrr_blocks(blocks, self.enum_tables())
+
+    def qsrr_range(self, reading_idx, recording, start=None, end=None):
+        # (first, last) indexes of the samples of a recording (qrsi) with start <= start_ts < end, end excluded.
+        # Each bound is searched from the index estimated with the sample interval: by steps doubling from
+        # there, then by bisection, a few qsrr when the samples are regular
+        num_samples = recording['num_samples']
+        rec_start = calendar.timegm(recording['start_ts'])
+        if num_samples == 0 or start is not None and calendar.timegm(recording['end_ts']) < start \
+                or end is not None and rec_start >= end:
+            return 0, 0
+        # start_ts of the samples read, by index
+        starts = {}
+
+        def sample_start(k):
+            if k not in starts:
+                starts[k] = store.block_start(self.qsrr_raw(reading_idx, str(k)))
+            return starts[k]
+
+        def first_at(ts):
+            # Index of the first sample with start_ts >= ts, num_samples if none
+            interval = recording['sample_interval']
+            guess = math.ceil((ts - rec_start) / interval) if interval > 0 else 0
+            guess = min(max(guess, 0), num_samples - 1)
+            # start_ts(lo) < ts <= start_ts(hi), lo -1 and hi num_samples out of the recording
+            step = 1
+            if sample_start(guess) >= ts:
+                lo, hi = guess - 1, guess
+                while lo >= 0 and sample_start(lo) >= ts:
+                    hi, lo, step = lo, lo - step, step * 2
+                lo = max(lo, -1)
+            else:
+                lo, hi = guess, guess + 1
+                while hi < num_samples and sample_start(hi) < ts:
+                    lo, hi, step = hi, hi + step, step * 2
+                hi = min(hi, num_samples)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if sample_start(mid) >= ts:
+                    hi = mid
+                else:
+                    lo = mid
+            return hi
+
+        first = 0 if start is None else first_at(start)
+        last = num_samples if end is None else max(first_at(end), first)
+        if self.trace is not None:
+            self.trace.instant('time range', args={'first': first, 'last': last, 'qsrr': len(starts)})
+        return first, last
+
+    def recording(self, index):
+        # Recording at a 1-based index, with all its samples in a columnar Recording
+        info = recording.recording_info(index, self.qrsi(str(index - 1)))
+        blocks = b''.join(self.qsrr_blocks(str(info['reading_index']), info['num_samples']))
+        return recording.Recording.from_blocks(info, blocks, self.enum_tables())
+
+    def enum_tables(self):
+        # Maps used by the decoders, keyed by integers.
+        # The disk cache is written once, after all the missing maps are read from the DMM
+        if self.tables is None:
+            if not self.map_cache_loaded:
+                self.map_cache_loaded = True
+                self.load_map_cache()
+            missing = [map_name for map_name in decode.map_names if map_name not in self.map_cache]
+            for map_name in missing:
+                self.map_cache[map_name] = self.qemap(map_name)
+            if missing:
+                self.save_map_cache()
+            self.tables = decode.enum_tables(self.map_cache)
+        return self.tables
+
+    def get_map(self, map_name):
+        if map_name not in self.map_cache and not self.map_cache_loaded:
+            self.map_cache_loaded = True
+            self.load_map_cache()
+        if map_name not in self.map_cache:
+            self.map_cache[map_name] = self.qemap(map_name)
+        return self.map_cache[map_name]
+
+    def identity(self):
+        if self.meter_info is None:
+            self.meter_info = self.meter_id()
+        return self.meter_info
+
+    def load_cache(self, kind):
+        # Data cached on disk for this meter, None if missing, refreshed or if firmware has changed
+        if self.refresh_cache: return None
+        return load_cache(kind, self.identity())
+
+    def save_cache(self, kind, cached):
+        save_cache(kind, self.identity(), cached)
+
+    def load_map_cache(self):
+        # Maps are read from disk once, keyed by the meter identity
+        if self.refresh_cache: return
+        load_map_cache(self.map_cache, self.identity())
+
+    def save_map_cache(self):
+        if self.meter_info is None: return
+        save_map_cache(self.map_cache, self.meter_info)
+
+    def catalog(self):
+        # Index, seq_no, name, start, end (and samples or value) of every saved item.
+        # It is built in one pass and kept on disk. A kind of items is read again from the DMM
+        # only if its count has changed, or if its first or last seq_no do not match.
+        if self.catalog_items is not None: return self.catalog_items
+        counts = self.qsls()
+        cached = self.load_cache('catalog') or {}
+        cached_items = cached.get('items', {})
+        items = {}
+        for kind, (field, cmd) in catalog_kinds.items():
+            nb = int(counts[field])
+            entries = cached_items.get(kind)
+            if entries is None or len(entries) != nb or not self.catalog_is_current(kind, entries):
+                entries = [self.catalog_entry(kind, i) for i in range(nb)]
+            items[kind] = entries
+        self.catalog_items = items
+        self.save_cache('catalog', {'items': items})
+        return items
+
+    def catalog_is_current(self, kind, entries):
+        # seq_no restarts when the memory is cleared: the first and last items read again must have the
+        # same seq_no, start (as store.recording_key) and name as the cached ones
+        if len(entries) == 0: return True
+        first = self.catalog_entry(kind, 0)
+        last = self.catalog_entry(kind, len(entries) - 1) if len(entries) > 1 else first
+        if catalog_key(first) != catalog_key(entries[0]) or catalog_key(last) != catalog_key(entries[-1]):
+            return False
+        # Items read again are kept, the last recording may still be running
+        entries[0] = first
+        entries[-1] = last
+        return True
+
+    def catalog_entry(self, kind, idx):
+        entry = {'index': idx + 1, 'kind': kind}
+        if kind == 'recordings':
+            recording = self.qrsi(str(idx))
+            entry.update(seq_no=recording['seq_no'], name=recording['name'].decode(),
+                         start=calendar.timegm(recording['start_ts']), end=calendar.timegm(recording['end_ts']),
+                         num_samples=recording['num_samples'], reading_index=recording['reading_index'])
+        elif kind == 'measurements':
+            measurement = self.qsmr(str(idx))
+            primary = measurement['readings']['PRIMARY']
+            entry.update(seq_no=measurement['[seq_no'], name=measurement['name'].decode(),
+                         start=calendar.timegm(primary['ts']), end=calendar.timegm(primary['ts']),
+                         value=primary['value'], unit=primary['unit'])
+        else:
+            mm = self.min_max_peak(catalog_kinds[kind][1], str(idx))
+            entry.update(seq_no=mm['seq_no'], name=mm['name'].decode(),
+                         start=calendar.timegm(mm['start_ts']), end=calendar.timegm(mm['end_ts']))
+        return entry
+
+    def qemap(self, map_name):
+        res = self.meter_command("qemap " + str(map_name))
+        # print("Traitement de la map: ", map_name)
+        # print("res dans qemap=",res)
+        # print("in qemap. Longueur=",len(res))
+        entry_count = int(res.pop(0))
+        # print("in qemap. entry_count=",entry_count)
+        if len(res) != entry_count * 2:
+            raise ValueError('By app: Error parsing qemap')
+        dmm_map = {}
+        for i in range(0, len(res), 2):
+            dmm_map[res[i]] = res[i + 1]
+        #  print "map dans qemap:",map
+        return dmm_map
+
+    def qrsi(self, idx):
+        return self.decode_reply('qrsi', decode.decode_qrsi, self.meter_command('qrsi ' + idx))
+
+    def qsmr(self, idx):
+        # Get saved measurement
+        return self.decode_reply('qsmr', decode.decode_qsmr, self.meter_command('qsmr ' + idx))
+
+    def min_max_peak(self, cmd, idx):
+        return self.decode_reply(cmd, decode.decode_min_max, self.meter_command(cmd + " " + idx))
+
+    def read_reply(self, verb):
+        # Read until the reply is complete, or until nothing more arrives
+        if self.trace is not None: return self.traced_read_reply(verb)
+        data = b''
+        stalls = 0
+        while stalls < 2:
+            missing = reply_missing(verb, data)
+            if missing == 0 and late_reply(verb, data):
+                data = b''
+                continue
+            # A binary reply of the expected size without its final '\r' has lost bytes
+            if missing == 0: return data, data.endswith(b'\r')
+            chunk = self.ser.read_until(b'\r') if missing < 0 else self.ser.read(missing)
+            if chunk:
+                data += chunk
+                stalls = 0
+            else:
+                stalls += 1
+        return data, False
+
+    def traced_read_reply(self, verb):
+        # read_reply, with a 'wait' span until the first bytes and a 'read' span for the rest of the reply
+        start = self.trace.now()
+        first = None
+        data = b''
+        stalls = 0
+        complete = False
+        while stalls < 2:
+            missing = reply_missing(verb, data)
+            if missing == 0 and late_reply(verb, data):
+                data = b''
+                continue
+            if missing == 0:
+                complete = data.endswith(b'\r')
+                break
+            chunk = self.ser.read_until(b'\r') if missing < 0 else self.ser.read(missing)
+            if chunk:
+                if first is None: first = self.trace.now()
+                data += chunk
+                stalls = 0
+            else:
+                stalls += 1
+        self.trace.span('wait', start, first, args=None if first is not None else {'timeout': True})
+        if first is not None:
+            self.trace.span('read', first, args={'bytes': len(data), 'complete': complete})
+        return data, complete
+
+    def rtt_estimate(self, verb):
+        if verb not in self.rtt_estimates:
+            self.rtt_estimates[verb] = {'count': 0, 'retries': 0, 'srtt': None, 'rttvar': None, 'rto': self.timeout}
+        return self.rtt_estimates[verb]
+
+    def set_read_timeout(self, value):
+        # Changing the timeout reconfigures the port, only do it when it really changes
+        value = round(value, 3)
+        if self.ser.timeout != value:
+            self.ser.timeout = value
+
+    def read_retry(self, cmd, deadline):
+        # Some callers terminate the command themselves
+        cmd = cmd.rstrip('\r')
+        verb = cmd.split(' ', 1)[0]
+        estimate = self.rtt_estimate(verb)
+        data = b''
+
+        for retry_cmd_count in range(20):
+            self.set_read_timeout(min(estimate['rto'], max(deadline - time.time(), min_rto)))
+            start = time.time()
+            if self.trace is not None: write_start = self.trace.now()
+            self.ser.write(cmd.encode() + b'\r')
+            if self.trace is not None: self.trace.span('write', write_start, args={'cmd': cmd})
+            data, complete = self.read_reply(verb)
+            if self.stats is not None: self.stats.read(verb, len(data))
+            if complete:
+                estimate['count'] += 1
+                # Only replies to commands sent once give a valid round-trip time
+                if retry_cmd_count == 0: rtt_update(estimate, time.time() - start)
+                return data, True
+            #    print ("========== read_retry ===========")
+            estimate['retries'] += 1
+            estimate['rto'] = min(estimate['rto'] * 2, max_rto)
+            if time.time() >= deadline: break
+            if self.stats is not None: self.stats.retry(verb)
+            if self.trace is not None:
+                self.trace.instant('retry', args={'cmd': cmd, 'attempt': retry_cmd_count + 1, 'bytes': len(data)})
+            self.ser.reset_input_buffer()
+            self.ser.reset_output_buffer()
+            if retry_cmd_count > 0:
+                # Port is only reopened if clearing the buffers was not enough
+                if self.stats is not None: self.stats.reopen(verb)
+                if self.trace is not None: reopen_start = self.trace.now()
+                self.ser.close()
+                self.ser.open()
+                if self.trace is not None: self.trace.span('reopen', reopen_start, args={'cmd': cmd})
+
+        return data, False
+
+    def print_timing(self):
+        print('Command', 'Count', 'Retries', 'SRTT (ms)', 'RTTVAR (ms)', 'Timeout (ms)', sep=self.sep,
+              file=sys.stderr)
+        for verb, estimate in sorted(self.rtt_estimates.items()):
+            srtt = '%.1f' % (estimate['srtt'] * 1000) if estimate['srtt'] is not None else '-'
+            rttvar = '%.1f' % (estimate['rttvar'] * 1000) if estimate['rttvar'] is not None else '-'
+            print(verb, estimate['count'], estimate['retries'], srtt, rttvar, '%.1f' % (estimate['rto'] * 1000),
+                  sep=self.sep, file=sys.stderr)
+
+    def meter_command(self, cmd, deadline=None):
+        data = self.command_reply(cmd, deadline)
+
+        if self.dump is not None:
+            self.dump.frame(cmd.rstrip('\r'), data)
+
+        binary = data[2:4] == b'#0'
+
+        if binary:
+            return data[4:-1]
+        else:
+            data = [i for i in data[2:-1].decode().split(',')]
+            return data
+
+    def command_reply(self, cmd, deadline=None):
+        # Reply of a command as received, status included. Exits if the DMM does not give a valid reply.
+        # deadline: seconds, defaults to self.deadline
+        #  print ("cmd=",cmd)
+        retry_count = 0
+        status = 0
+        data = ''
+        deadline = time.time() + (self.deadline if deadline is None else deadline)
+        if self.trace is not None: command_start = self.trace.now()
+        if self.stats is not None:
+            verb = cmd.split(' ', 1)[0].rstrip('\r')
+            start = time.perf_counter()
+        while retry_count < 20:
+            data, result_ok = self.read_retry(cmd, deadline)
+            if data == b'':
+                print('Did not receive data from DMM')
+                sys.exit(6)
+            status = chr(data[0])
+            if status == '0' and chr(data[1]) == '\r': break
+            if result_ok or time.time() >= deadline: break
+            retry_count += 1
+            if self.stats is not None: self.stats.retry(verb)
+        if self.stats is not None: self.stats.command(verb, time.perf_counter() - start)
+        if self.trace is not None: self.trace.span('meter_command', command_start, args={'cmd': cmd.rstrip('\r')})
+        #    print ("========== meter_command ===========")
+
+        if status != '0':
+            #    print ("Command: %s failed. Status=%c" % (cmd, status))
+            print("Invalid value")
+            sys.exit(7)
+        if chr(data[1]) != '\r':
+            print('Did not receive complete reply from DMM')
+            sys.exit(8)
+        return data
+
+
+def map_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'fluke_28x_dmm_util')
+
+
+def catalog_key(entry):
+    # Identity of a catalog item across reads
+    return store.recording_key(entry), entry['name']
+
+
+def cache_path(kind, info):
+    # One file per meter, firmware version is checked when loading
+    name = (info['model_number'] + '_' + info['serial_number']).replace(' ', '_')
+    name = ''.join(c for c in name if c.isalnum() or c in '_-.')
+    return os.path.join(map_cache_dir(), kind + '_' + name + '.json')
+
+
+# Disk cache shared by DmmClient and AsyncDmmClient
+
+def load_cache(kind, info):
+    # Data cached for the meter info (meter_id), None if missing or if firmware has changed
+    try:
+        with open(cache_path(kind, info)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('id') != info:
+        return None
+    return cached
+
+
+def save_cache(kind, info, cached):
+    path = cache_path(kind, info)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own, then renamed: readers, and other clients of the same DMM,
+        # never see a partial file
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+            json.dump(dict(cached, id=info), f)
+        os.replace(f.name, path)
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def load_map_cache(map_cache, info):
+    # Adds the cached maps of the meter to map_cache, maps already there are kept
+    cached = load_cache('maps', info)
+    if cached is None: return
+    for map_name, dmm_map in cached.get('maps', {}).items():
+        map_cache.setdefault(map_name, dmm_map)
+
+
+def save_map_cache(map_cache, info):
+    save_cache('maps', info, {'maps': map_cache})
 
 
 def get_s16(string, offset):  # Il faut valider le portage de cette fonction
@@ -391,358 +1144,69 @@ def parse_time(t):
     return time.gmtime(t)
 
 
-def qrsi(idx):
-    #  print ('IDX',idx)
-    res = meter_command('qrsi ' + idx)
-    #  print('res',binascii.hexlify(res))
-    reading_count = get_u16(res, 76)
-    #  print ("reading_count",reading_count)
-    if len(res) < reading_count * 30 + 78:
-        raise ValueError(
-            'By app: qrsi parse error, expected at least %d bytes, got %d' % (reading_count * 30 + 78, len(res)))
-    return {
-        'seq_no': get_u16(res, 0),
-        'un2': get_u16(res, 2),
-        'start_ts': parse_time(get_double(res, 4)),
-        'end_ts': parse_time(get_double(res, 12)),
-        'sample_interval': get_double(res, 20),
-        'event_threshold': get_double(res, 28),
-        'reading_index': get_u16(res, 36),  # 32 bits?
-        'un3': get_u16(res, 38),
-        'num_samples': get_u16(res, 40),  # Is this 32 bits? What's in 42
-        'un4': get_u16(res, 42),
-        'prim_function': get_map_value('primfunction', res, 44),
-        'sec_function': get_map_value('secfunction', res, 46),  # sec?
-        'auto_range': get_map_value('autorange', res, 48),
-        'unit': get_map_value('unit', res, 50),
-        'range_max ': get_double(res, 52),
-        'unit_multiplier': get_s16(res, 60),
-        'bolt': get_map_value('bolt', res, 62),  # bolt?
-        'un8': get_u16(res, 64),  # ts3?
-        'un9': get_u16(res, 66),  # ts3?
-        'un10': get_u16(res, 68),  # ts3?
-        'un11': get_u16(res, 70),  # ts3?
-        'mode': get_multimap_value('mode', res, 72),
-        'un12': get_u16(res, 74),
-        # 76 is reading count
-        'readings': parse_readings(res[78:78 + reading_count * 30]),
-        'name': res[(78 + reading_count * 30):]
-    }
-
-
-def qsmr(idx):
-    # Get saved measurement
-    res = meter_command('qsmr ' + idx)
-    reading_count = get_u16(res, 36)
-
-    if len(res) < reading_count * 30 + 38:
-        raise ValueError(
-            'By app: qsmr parse error, expected at least %d bytes, got %d' % (reading_count * 30 + 78, len(res)))
-
-    return {'[seq_no': get_u16(res, 0),
-            'un1': get_u16(res, 2),  # 32 bit?
-            'prim_function': get_map_value('primfunction', res, 4),  # prim?
-            'sec_function': get_map_value('secfunction', res, 6),  # sec?
-            'auto_range': get_map_value('autorange', res, 8),
-            'unit': get_map_value('unit', res, 10),
-            'range_max': get_double(res, 12),
-            'unit_multiplier': get_s16(res, 20),
-            'bolt': get_map_value('bolt', res, 22),
-            'un4': get_u16(res, 24),  # ts?
-            'un5': get_u16(res, 26),
-            'un6': get_u16(res, 28),
-            'un7': get_u16(res, 30),
-            'mode': get_multimap_value('mode', res, 32),
-            'un9': get_u16(res, 34),
-            # 36 is reading count
-            'readings': parse_readings(res[38:38 + reading_count * 30]),
-            'name': res[(38 + reading_count * 30):]
-            }
-
-
-def do_min_max_cmd(cmd, idx):
-    res = meter_command(cmd + " " + idx)
-    # un8 = 0, un2 = 0, always bolt
-    reading_count = get_u16(res, 52)
-    if len(res) < reading_count * 30 + 54:
-        raise ValueError(
-            'By app: qsmr parse error, expected at least %d bytes, got %d' % (reading_count * 30 + 54, len(res)))
-
-    # All bytes parsed
-    return {'seq_no': get_u16(res, 0),
-            'un2': get_u16(res, 2),  # High byte of seq no?
-            'start_ts': parse_time(get_double(res, 4)),
-            'end_ts': parse_time(get_double(res, 12)),
-            'prim_function': get_map_value('primfunction', res, 20),
-            'sec_function': get_map_value('secfunction', res, 22),
-            'autorange': get_map_value('autorange', res, 24),
-            'unit': get_map_value('unit', res, 26),
-            'range_max ': get_double(res, 28),
-            'unit_multiplier': get_s16(res, 36),
-            'bolt': get_map_value('bolt', res, 38),
-            'ts3': parse_time(get_double(res, 40)),
-            'mode': get_multimap_value('mode', res, 48),
-            'un8': get_u16(res, 50),
-            # 52 is reading_count
-            'readings': parse_readings(res[54:54 + reading_count * 30]),
-            'name': res[(54 + reading_count * 30):]
-            }
-
-
-def do_saved_peak(records):
-    do_saved_min_max_peak(records, 'nb_peak', 'qpsi')
-
-
-def do_saved_min_max(records):
-    do_saved_min_max_peak(records, 'nb_min_max', 'qmmsi')
-
-
-def do_saved_min_max_peak(records, field, cmd):
-    start_serial()
-    nb_min_max = int(qsls()[field])
-    interval = []
-    for i in range(1, nb_min_max + 1):
-        interval.append(str(i))
-    found = False
-    if len(records) == 0:
-        series = interval
-    else:
-        series = records
-
-    for i in series:
-        if i.isdigit():
-            measurement = do_min_max_cmd(cmd, str(int(i) - 1))
-            print_min_max_peak(measurement)
-            found = True
-        else:
-            for j in interval:
-                measurement = do_min_max_cmd(cmd, str(int(j) - 1))
-                if measurement['name'] == i.encode():
-                    found = True
-                    print_min_max_peak(measurement)
-                    break
-    if not found:
-        print("Saved names not found")
-        sys.exit(3)
-
-
-def print_min_max_peak(measurement):
-    print((measurement['name']).decode('utf-8'), 'start', time.strftime('%Y-%m-%d %H:%M:%S', measurement['start_ts']),
-          measurement['autorange'], 'Range', int(measurement['range_max ']), measurement['unit'])
-    print_min_max_peak_detail(measurement, 'PRIMARY')
-    print_min_max_peak_detail(measurement, 'MAXIMUM')
-    print_min_max_peak_detail(measurement, 'AVERAGE')
-    print_min_max_peak_detail(measurement, 'MINIMUM')
-    print((measurement['name']).decode('utf-8'), 'end', time.strftime('%Y-%m-%d %H:%M:%S', measurement['end_ts']))
-
-
-def print_min_max_peak_detail(measurement, detail):
-    print(sep, detail,
-          measurement['readings'][detail]['value'],
-          measurement['readings'][detail]['unit'],
-          time.strftime('%Y-%m-%d %H:%M:%S', measurement['readings'][detail]['ts']), sep=sep)
-
-
-def do_saved_measurements(records=None):
-    start_serial()
-    nb_measurements = int(qsls()['nb_measurements'])
-    interval = []
-    for i in range(1, nb_measurements + 1):
-        interval.append(str(i))
-    found = False
-    if records is None:
-        series = interval
-    else:
-        series = records
+def parse_time_arg(text):
+    # Epoch seconds of a time given on the command line: UTC, in the format displayed, or epoch seconds
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return float(calendar.timegm(time.strptime(text, time_format)))
+        except ValueError:
+            pass
+    raise ValueError('By app: Invalid time %s' % text)
 
-    print('Index', 'Name', 'Type', 'Datetime', 'Measurement', 'Unit', sep=sep)
 
-    for i in series:
-        if i.isdigit():
-            measurement = qsmr(str(int(i) - 1))
-            print(i, (measurement['name']).decode('utf-8'),
-                  'Measurement',
-                  time.strftime('%Y-%m-%d %H:%M:%S', measurement['readings']['PRIMARY']['ts']),
-                  measurement['readings']['PRIMARY']['value'],
-                  measurement['readings']['PRIMARY']['unit'], sep=sep)
-            found = True
-        else:
-            for j in interval:
-                measurement = qsmr(str(int(j) - 1))
-                if measurement['name'] == i.encode():
-                    found = True
-                    print(j, (measurement['name']).decode('utf-8'),
-                          'Measurement',
-                          time.strftime('%Y-%m-%d %H:%M:%S', measurement['readings']['PRIMARY']['ts']),
-                          measurement['readings']['PRIMARY']['value'],
-                          measurement['readings']['PRIMARY']['unit'], sep=sep)
-                    break
-    if not found:
-        print("Saved names not found")
-        sys.exit(4)
+def reply_missing(verb, data):
+    # Number of bytes still expected for the reply to verb,
+    # 0 when the reply is complete, -1 when it ends at the next '\r'
 
+    # Status code
+    if len(data) < 2 or data[1:2] != b'\r': return -1
 
-def do_recordings(records):
-    start_serial()
-    nb_recordings = int(qsls()['nb_recordings'])
-    interval = []
-    for i in range(1, nb_recordings + 1):
-        interval.append(str(i))
-    found = False
-    if len(records) == 0:
-        series = interval
-    else:
-        series = records
-
-    for i in series:
-        if i.isdigit():
-            recording = qrsi(str(int(i) - 1))
-            # print ('recording digit',recording)
-            duration = format_duration(recording['start_ts'], recording['end_ts'])
-            print('Index %s, Name %s, Start %s, End %s, Duration %s, Measurements %s'
-                  % (str(i), (recording['name']).decode(), time.strftime('%Y-%m-%d %H:%M:%S', recording['start_ts']),
-                     time.strftime('%Y-%m-%d %H:%M:%S', recording['end_ts']), duration, recording['num_samples']))
-            print('Start Time', 'Primary', '', 'Maximum', '', 'Average', '', 'Minimum', '', '#Samples', 'Type', sep=sep)
-
-            for k in range(0, recording['num_samples']):
-                measurement = qsrr(str(recording['reading_index']), str(k))
-                # print ('measurement',measurement)
-                if overloads and \
-                        (measurement['readings2']['PRIMARY']['value'] == 9.99999999e+37 or
-                         measurement['readings']['MAXIMUM']['value'] == 9.99999999e+37 or
-                         measurement['readings']['MINIMUM']['value'] == 9.99999999e+37):
-                    continue
-                duration = str(round(measurement['readings']['AVERAGE']['value']
-                                     / measurement['duration'], measurement['readings']['AVERAGE']['decimals'])) \
-                    if measurement['duration'] != 0 else 0
-                print(time.strftime('%Y-%m-%d %H:%M:%S', measurement['start_ts']),
-                      str(measurement['readings2']['PRIMARY']['value']),
-                      measurement['readings2']['PRIMARY']['unit'],
-                      str(measurement['readings']['MAXIMUM']['value']),
-                      measurement['readings']['MAXIMUM']['unit'],
-                      duration,
-                      measurement['readings']['AVERAGE']['unit'],
-                      str(measurement['readings']['MINIMUM']['value']),
-                      measurement['readings']['MINIMUM']['unit'],
-                      str(measurement['duration']), sep=sep, end=sep)
-                print('INTERVAL' if measurement['record_type'] == 'INTERVAL' else measurement['stable'])
-            print()
-            found = True
-        else:
-            for j in interval:
-                recording = qrsi(str(int(j) - 1))
-                # print ('recording non digit',recording)
-                if recording['name'] == i.encode():
-                    found = True
-                    duration = format_duration(recording['start_ts'], recording['end_ts'])
-                    print('Index %s, Name %s, Start %s, End %s, Duration %s, Measurements %s'
-                          % (str(j), (recording['name']).decode(),
-                             time.strftime('%Y-%m-%d %H:%M:%S', recording['start_ts']),
-                             time.strftime('%Y-%m-%d %H:%M:%S', recording['end_ts']), duration,
-                             recording['num_samples']))
-                    print('Start Time', 'Primary', '', 'Maximum', '', 'Average', '', 'Minimum', '', '#Samples', 'Type',
-                          sep=sep)
-                    for k in range(0, recording['num_samples']):
-                        measurement = qsrr(str(recording['reading_index']), str(k))
-                        #            print ('measurement',measurement)
-                        if overloads and \
-                                (measurement['readings2']['PRIMARY']['value'] == 9.99999999e+37 or
-                                 measurement['readings']['MAXIMUM']['value'] == 9.99999999e+37 or
-                                 measurement['readings']['MINIMUM']['value'] == 9.99999999e+37):
-                            continue
-                        duration = str(round(measurement['readings']['AVERAGE']['value']
-                                             / measurement['duration'],
-                                             measurement['readings']['AVERAGE']['decimals'])) \
-                            if measurement['duration'] != 0 else 0
-                        print(time.strftime('%Y-%m-%d %H:%M:%S', measurement['start_ts']),
-                              str(measurement['readings2']['PRIMARY']['value']),
-                              measurement['readings2']['PRIMARY']['unit'],
-                              str(measurement['readings']['MAXIMUM']['value']),
-                              measurement['readings']['MAXIMUM']['unit'],
-                              duration,
-                              measurement['readings']['AVERAGE']['unit'],
-                              str(measurement['readings']['MINIMUM']['value']),
-                              measurement['readings']['MINIMUM']['unit'],
-                              str(measurement['duration']), sep=sep, end=sep)
-                        print('INTERVAL' if measurement['record_type'] == 'INTERVAL' else measurement['stable'])
-                    print()
-                    break
-    if not found:
-        print("Saved names not found")
-        sys.exit(5)
+    # Non-OK status, or command without data (mp, mpq, savname...)
+    if data[0:1] != b'0' or not (verb.startswith('q') or verb == 'ID'): return 0
 
+    if len(data) < 3: return 1
 
-def data_is_ok(data):
-    # No status code yet
-    if len(data) < 2: return False
+    # Text reply
+    if data[2:3] != b'#': return 0 if data.endswith(b'\r') else -1
 
-    # Non-OK status
-    if len(data) == 2 and chr(data[0]) == '0' and chr(data[1]) == "\r": return True
+    if len(data) < 4: return 1
 
-    # Non-OK status with extra data on end
-    if len(data) > 2 and chr(data[0]) != '0': return False
+    # Binary reply, its size is known from the command and the reading count
+    payload = len(data) - 4
+    size = binary_sizes.get(verb)
+    if size is None: return 0 if payload > 0 and data.endswith(b'\r') else -1
+    if isinstance(size, int): return max(size + 1 - payload, 0)
+    count_offset, fixed_size = size
+    if payload < count_offset + 2: return count_offset + 2 - payload
+    minimum = fixed_size + get_u16(data, 4 + count_offset) * 30
+    if verb in binary_exact_sizes or payload <= minimum: return max(minimum + 1 - payload, 0)
 
-    # We should now be in OK state
-    if not data.startswith(b"0\r"): return False
+    # Name follows the readings
+    return 0 if data.endswith(b'\r') else -1
 
-    return len(data) >= 4 and chr(data[-1]) == '\r'
 
+def late_reply(verb, data):
+    # A reply of the wrong kind, text for a binary command or binary for a text command, belongs to a previous
+    # command that was sent again after a timeout: its second reply arrives late, the real reply follows
+    if data[0:1] != b'0' or not data.endswith(b'\r'): return False
+    binary = data[2:3] == b'#'
+    return verb in binary_sizes and not binary or verb in text_verbs and binary
 
-def read_retry(cmd):
-    retry_cmd_count = 0
-    retry_read_count = 0
-    data = b''
 
-    while retry_cmd_count < 20 and not data_is_ok(data):
-        ser.write(cmd.encode() + b'\r')
-        while retry_read_count < 20 and not data_is_ok(data):
-            bytes_read = ser.read(ser.in_waiting)
-            data += bytes_read
-            if data_is_ok(data): return data, True
-            time.sleep(0.01)
-            retry_read_count += 1
-        retry_cmd_count += 1
-        #    print ("========== read_retry ===========")
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        ser.close()
-        ser.open()
-        time.sleep(0.01)
-
-        return data, False
-
-
-def meter_command(cmd):
-    #  print ("cmd=",cmd)
-    retry_count = 0
-    status = 0
-    data = ''
-    while retry_count < 20:
-        data, result_ok = read_retry(cmd)
-        if data == b'':
-            print('Did not receive data from DMM')
-            sys.exit(6)
-        status = chr(data[0])
-        if status == '0' and chr(data[1]) == '\r': break
-        if result_ok: break
-        retry_count += 1
-    #    print ("========== meter_command ===========")
-
-    if status != '0':
-        #    print ("Command: %s failed. Status=%c" % (cmd, status))
-        print("Invalid value")
-        sys.exit(7)
-    if chr(data[1]) != '\r':
-        print('Did not receive complete reply from DMM')
-        sys.exit(8)
-
-    binary = data[2:4] == b'#0'
-
-    if binary:
-        return data[4:-1]
+def rtt_update(estimate, rtt):
+    # Same smoothing as TCP retransmission timer (RFC 6298)
+    if estimate['srtt'] is None:
+        estimate['srtt'] = rtt
+        estimate['rttvar'] = rtt / 2
     else:
-        data = [i for i in data[2:-1].decode().split(',')]
-        return data
+        estimate['rttvar'] = 0.75 * estimate['rttvar'] + 0.25 * abs(estimate['srtt'] - rtt)
+        estimate['srtt'] = 0.875 * estimate['srtt'] + 0.125 * rtt
+    rto = estimate['srtt'] + max(rto_granularity, 4 * estimate['rttvar'])
+    estimate['rto'] = min(max(rto, min_rto), max_rto)
 
 
 def main():
@@ -751,84 +1215,221 @@ def main():
         usage()
         sys.exit(9)
 
-    global sep
-    global timeout
-    global port
-    global overloads
-
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--port", help="usb port used (Mandatory)")
+    parser.add_argument("-p", "--port", help="usb port used (Mandatory). Several ports, a comma separated list "
+                        "or a pattern such as /dev/ttyUSB* run the command on all the DMMs at once", action="append")
+    parser.add_argument("--fleet", help="file listing the ports of the DMMs, one per line")
+    parser.add_argument("--split", help="fleet: write the output of each DMM to its own file in this directory")
+    parser.add_argument("--socket", help="socket of the daemon started by 'serve' (defaults to one per port)")
+    parser.add_argument("--direct", help="use the port even if a daemon serves it", action="store_true")
+    parser.add_argument("--live-rate", help="serve: live readings polled per second", type=float)
+    parser.add_argument("--trigger", help="capture: write the readings around this trigger only "
+                        "(>level, <level, slope>rate, function or mode)", action="append")
+    parser.add_argument("--pre-trigger", help="capture: readings written before a trigger (defaults to 100)",
+                        type=int, default=capture.PRE_TRIGGER)
+    parser.add_argument("--post-trigger", help="capture: readings written after a trigger (defaults to 100)",
+                        type=int, default=capture.POST_TRIGGER)
     parser.add_argument("-s", "--separator", help="custom separator (defaults to \\t")
-    parser.add_argument("-t", "--timeout", help="custom timeout (defaults to 0.09s)")
+    parser.add_argument("-t", "--timeout", help="initial timeout (defaults to 0.09s)")
+    parser.add_argument("-d", "--deadline", help="maximum time for a command (defaults to 10s)", type=float)
+    parser.add_argument("--timing", help="display commands response times on exit", action="store_true")
+    parser.add_argument("--stats", help="display commands statistics on exit", action="store_true")
+    parser.add_argument("--stats-file", help="write commands statistics to this file on exit (Prometheus text format)")
+    parser.add_argument("--trace", help="write a timeline of the session to this file (Chrome Trace Event format)")
     parser.add_argument("-o", "--overloads", help="don't display lines containing overloads", action="store_true")
+    parser.add_argument("--from", help="get recordings: samples starting at or after this time (UTC)",
+                        dest="time_from")
+    parser.add_argument("--to", help="get recordings: samples starting before this time (UTC)", dest="time_to")
+    parser.add_argument("--resample", help="get recordings, capture: one row per window (90, 90s, 15m, 1h, 1d) "
+                        "with the minimum, maximum and average")
+    parser.add_argument("-w", "--window", help="samples requested in advance for recordings (defaults to 1)",
+                        type=int)
+    parser.add_argument("--refresh-cache", help="download the DMM maps again instead of using the disk cache",
+                        action="store_true")
+    parser.add_argument("-f", "--format", help="output format: tsv (default), csv, ndjson or binary",
+                        choices=writers.formats)
     parser.add_argument("-v", "--version", help="show version and exit", action="store_true")
     parser.add_argument("command", nargs="*", help="command used")
     args = parser.parse_args()
 
-    port = args.port
+    if args.version:
+        version()
+        sys.exit()
+
+    ports = fleet.expand_ports(args.port or [])
+    if args.fleet:
+        ports += fleet.read_fleet_file(args.fleet)
+    fleet_mode = args.fleet is not None or len(ports) > 1 or any(fleet.is_pattern(port) for port in args.port or [])
+    port = ports[0] if len(ports) == 1 else None
+    # Commands go through the daemon of the port when one is running
+    daemon_socket = None
+    if not fleet_mode and not args.direct and args.command and args.command[0] not in ('serve', 'decode') \
+            and (port or args.socket):
+        from fluke_28x_dmm_util import serve  # serve.RemoteClient derives from DmmClient
+        daemon_socket = args.socket or serve.socket_path(port)
+        if not serve.daemon_running(daemon_socket): daemon_socket = None
+    client = DmmClient(port) if daemon_socket is None else serve.RemoteClient(port, daemon_socket)
 
     if args.separator:
-        sep = args.separator
+        client.sep = args.separator
 
     if args.timeout:
-        timeout = float(args.timeout)
-
-    if args.version:
-        version()
-        sys.exit()
+        client.timeout = float(args.timeout)
 
     if args.overloads:
-        overloads = True
+        client.overloads = True
+
+    if args.timing and not fleet_mode:
+        atexit.register(client.print_timing)
+
+    if args.trace:
+        client.trace = trace.Tracer(args.trace)
+        atexit.register(client.trace.close)
+
+    if (args.stats or args.stats_file) and not fleet_mode:
+        client.stats = stats.Stats()
+        if args.stats:
+            atexit.register(client.stats.summary, client.sep, sys.stderr)
+        if args.stats_file:
+            atexit.register(client.stats.write_prometheus, args.stats_file)
+
+    if args.deadline:
+        client.deadline = args.deadline
+
+    if args.window:
+        client.window = max(args.window, 1)
+
+    if args.refresh_cache:
+        client.refresh_cache = True
+
+    if args.live_rate:
+        client.live_rate = args.live_rate
+
+    if args.trigger:
+        try:
+            client.triggers = capture.Triggers(args.trigger, args.pre_trigger, args.post_trigger)
+        except ValueError as err:
+            print(err)
+            usage()
+
+    if args.time_from or args.time_to:
+        try:
+            client.time_range = (parse_time_arg(args.time_from) if args.time_from else None,
+                                 parse_time_arg(args.time_to) if args.time_to else None)
+        except ValueError as err:
+            print(err)
+            usage()
+
+    if args.resample:
+        try:
+            client.resample = resample.parse_window(args.resample)
+        except ValueError as err:
+            print(err)
+            usage()
+
+    if args.format:
+        client.output_format = args.format
 
     if len(args.command) == 0:
         usage()
 
+    if fleet_mode:
+        # Checked once, not by every DMM
+        if args.command[0] == 'decode' or not command_valid(args.command): usage()
+        fleet.run(client, ports, args.command, run_command, args.split, args.timing, args.stats, args.stats_file)
+    else:
+        run_command(client, args.command)
+
+
+def command_valid(command):
+    # Checks the command and the number of its arguments, before running it (on every DMM of a fleet)
+    if not command: return False
+    args = command[1:]
+    match command[0]:
+        case "get":
+            return len(args) >= 1 and len(args) - 1 == get_arguments.get(args[0], -1)
+        case "list":
+            return len(args) == 1 and args[0] in list_kinds
+        case verb if verb in command_arguments:
+            low, high = command_arguments[verb]
+            return low <= len(args) <= high
+    return False
+
+
+def run_command(client, command):
+    if not command_valid(command): usage()
     series = ''
-    match args.command[0]:
+    match command[0]:
         case "get":
-            if len(args.command[1:]) == 2:
-                series = args.command[2].split(",")
-            match args.command[1]:
+            if len(command[1:]) == 2:
+                series = command[2].split(",")
+            match command[1]:
                 case "recordings":
-                    if len(args.command[1:]) != 2: usage()
-                    do_recordings(series)
+                    do_recordings(client, series)
                 case "measurements":
-                    if len(args.command[1:]) != 2: usage()
-                    do_saved_measurements(series)
+                    do_saved_measurements(client, series)
                 case "minmax":
-                    if len(args.command[1:]) != 2: usage()
-                    do_saved_min_max(series)
+                    do_saved_min_max(client, series)
                 case "peak":
-                    if len(args.command[1:]) != 2: usage()
-                    do_saved_peak(series)
+                    do_saved_peak(client, series)
                 case "current":
-                    if len(args.command[1:]) != 1: usage()
-                    do_current()
+                    if client.triggers is not None or client.resample:
+                        do_capture(client, [])
+                        return
+                    do_current(client)
                 case "config":
-                    if len(args.command[1:]) != 1: usage()
-                    do_get_config()
+                    do_get_config(client)
                 case "names":
-                    if len(args.command[1:]) != 1: usage()
-                    do_get_names()
-                case _:
-                    usage()
+                    do_get_names(client)
         case "set":
-            if len(args.command[1:]) not in [1, 2, 3]: usage()
-            do_set(args.command[1:])
+            do_set(client, command[1:])
         case "list":
-            if len(args.command[1:]) != 1: usage()
-            if args.command[1] not in ['recordings', 'minmax', 'peak', 'all', 'measurements']: usage()
-            if args.command[1] == 'measurements':
-                do_saved_measurements()
-                sys.exit()
-            do_list(args.command[1])
-        case _:
-            usage()
-
-
-sep = '\t'
-timeout = 0.09
-map_cache = {}
-ser = serial.Serial()
-port = ''
-overloads = False
+            if command[1] == 'measurements':
+                do_saved_measurements(client)
+                return
+            do_list(client, command[1])
+        case "dump":
+            do_dump(client, command[1])
+        case "decode":
+            do_decode(client, command[1])
+        case "sync":
+            do_sync(client, command[1] if len(command) > 1 else None)
+        case "capture":
+            do_capture(client, command[1:])
+        case "serve":
+            from fluke_28x_dmm_util import serve  # serve.RemoteClient derives from DmmClient
+            serve.serve(client, command[1] if len(command) > 1 else None, client.live_rate)
+
+
+# Binary replies size: a fixed size,
+# or the offset of the reading count and the size of the data before the readings
+binary_sizes = {'qsrr': 146, 'qddb': (32, 34), 'qrsi': (76, 78), 'qsmr': (36, 38), 'qmmsi': (52, 54),
+                'qpsi': (52, 54)}
+binary_exact_sizes = ['qddb']
+# Commands with a text reply
+text_verbs = ['ID', 'qemap', 'qsls', 'qmp']
+# Arguments of the commands: (least, most), and of the get commands
+command_arguments = {'set': (1, 3), 'dump': (1, 1), 'decode': (1, 1), 'sync': (0, 1), 'capture': (0, 2),
+                     'serve': (0, 1)}
+get_arguments = {'recordings': 1, 'measurements': 1, 'minmax': 1, 'peak': 1, 'current': 0, 'config': 0, 'names': 0}
+list_kinds = ['recordings', 'minmax', 'peak', 'all', 'measurements']
+# Saved items kinds: qsls field, command
+catalog_kinds = {'recordings': ('nb_recordings', 'qrsi'), 'minmax': ('nb_min_max', 'qmmsi'),
+                 'peak': ('nb_peak', 'qpsi'), 'measurements': ('nb_measurements', 'qsmr')}
+# Adaptive timeouts limits
+min_rto = 0.02
+max_rto = 2.0
+rto_granularity = 0.01
+# Samples decoded by one task of 'decode'
+decode_chunk = 5000
+# Output fields: name, type
+list_fields = [('index', writers.INT), ('name', writers.STR), ('type', writers.STR), ('start', writers.TIME),
+               ('end', writers.TIME), ('duration', writers.STR)]
+measurement_fields = [('index', writers.INT), ('name', writers.STR), ('type', writers.STR),
+                      ('datetime', writers.TIME), ('value', writers.FLOAT), ('unit', writers.STR)]
+min_max_fields = [('reading', writers.STR), ('value', writers.FLOAT), ('unit', writers.STR), ('ts', writers.TIME)]
+recording_fields = [('start_time', writers.TIME), ('primary', writers.FLOAT), ('primary_unit', writers.STR),
+                    ('maximum', writers.FLOAT), ('maximum_unit', writers.STR),
+                    ('average', writers.FLOAT), ('average_unit', writers.STR),
+                    ('minimum', writers.FLOAT), ('minimum_unit', writers.STR),
+                    ('samples', writers.INT), ('type', writers.STR)]
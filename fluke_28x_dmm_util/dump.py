@@ -0,0 +1,89 @@
+# vim: set fileencoding=utf-8 :
+
+# Raw dumps of DMM replies, written by 'dump' and read back by 'decode'.
+# File format: 'FDMMDUMP1\n', then one frame per reply:
+#   16 bits command length, 32 bits reply length (little-endian), command, reply
+# The reply is stored as received, status line included.
+
+import struct
+
+MAGIC = b'FDMMDUMP1\n'
+frame_header = struct.Struct('<HI')
+
+
+class DumpWriter:
+
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(MAGIC)
+        self.frames = 0
+        self.size = len(MAGIC)
+
+    def frame(self, cmd, reply):
+        cmd = cmd.encode()
+        self.file.write(frame_header.pack(len(cmd), len(reply)) + cmd)
+        self.file.write(reply)
+        self.frames += 1
+        self.size += frame_header.size + len(cmd) + len(reply)
+
+    def close(self):
+        self.file.close()
+
+
+def read_frames(path):
+    # (command, reply) of each frame of a dump
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('By app: %s is not a dump file' % path)
+    pos = len(MAGIC)
+    while pos + frame_header.size <= len(data):
+        cmd_length, reply_length = frame_header.unpack_from(data, pos)
+        pos += frame_header.size
+        cmd = data[pos:pos + cmd_length].decode()
+        pos += cmd_length
+        if pos + reply_length > len(data):
+            raise ValueError('By app: %s is truncated' % path)
+        yield cmd, data[pos:pos + reply_length]
+        pos += reply_length
+
+
+def reply_payload(reply):
+    # Same result as DmmClient.meter_command: bytes for binary replies, list of fields for text replies
+    if reply[2:4] == b'#0':
+        return reply[4:-1]
+    return reply[2:-1].decode().split(',')
+
+
+class Dump:
+    # Replies of a dump, by command
+
+    def __init__(self, path):
+        self.maps = {}
+        self.identity = None
+        # verb -> {index: payload}
+        self.items = {'qrsi': {}, 'qsmr': {}, 'qmmsi': {}, 'qpsi': {}}
+        # (reading_index, sample) -> qsrr block
+        self.blocks = {}
+        for cmd, reply in read_frames(path):
+            verb, _, args = cmd.partition(' ')
+            payload = reply_payload(reply)
+            if verb == 'qemap':
+                entry_count = int(payload[0])
+                self.maps[args] = dict(zip(payload[1:1 + entry_count * 2:2], payload[2:2 + entry_count * 2:2]))
+            elif verb == 'ID':
+                self.identity = payload
+            elif verb == 'qsrr':
+                reading_index, sample = args.split(',')
+                self.blocks[(int(reading_index), int(sample))] = payload
+            elif verb in self.items:
+                self.items[verb][int(args)] = payload
+
+    def recording_blocks(self, reading_index, num_samples):
+        # Blocks of a recording, up to the first missing one
+        blocks = []
+        for sample in range(num_samples):
+            block = self.blocks.get((reading_index, sample))
+            if block is None: break
+            blocks.append(block)
+        return blocks
@@ -0,0 +1,235 @@
+# vim: set fileencoding=utf-8 :
+
+# Fleet mode: the same command on many DMMs at once, one thread per port.
+# Ports come from -p (repeated, comma separated, or patterns such as /dev/ttyUSB*) and from a --fleet file.
+# The output of each DMM is tagged with its serial number:
+#   tsv: each line starts with the serial number
+#   csv, ndjson: rows have a 'meter' column; other lines start with the serial number
+#   --split DIR: one file per DMM instead, DIR/<model>_<serial>.<format>
+# Without --split, in csv, the header of each kind of table is written once for all the DMMs: the rows of all
+# the DMMs make one table per kind. In tsv, each line keeps its serial number, titles and headers included.
+# Messages on stderr are tagged too. A DMM that fails does not stop the others, a summary is displayed at the end.
+
+import glob
+import os
+import sys
+import threading
+import time
+
+from fluke_28x_dmm_util import stats
+from fluke_28x_dmm_util import writers
+
+extensions = {'tsv': 'tsv', 'csv': 'csv', 'ndjson': 'ndjson', 'binary': 'bin'}
+
+
+def is_pattern(port):
+    # pyserial URLs (sim://?a=1) are never patterns
+    return '://' not in port and any(c in port for c in '*?[')
+
+
+def expand_ports(specs):
+    ports = []
+    for spec in specs:
+        for port in [spec] if '://' in spec else spec.split(','):
+            port = port.strip()
+            if not port: continue
+            ports += sorted(glob.glob(port)) if is_pattern(port) else [port]
+    # Each port once, in the order given
+    return list(dict.fromkeys(ports))
+
+
+def read_fleet_file(path):
+    # One port or pattern per line, '#' starts a comment
+    try:
+        with open(path) as f:
+            lines = [line.split('#', 1)[0].strip() for line in f]
+    except OSError as err:
+        print('Fleet file ' + path + ' can not be read')
+        print(err)
+        sys.exit(10)
+    return expand_ports([line for line in lines if line])
+
+
+class ThreadStream:
+    # Replaces sys.stdout or sys.stderr: writes go to the stream of the current thread, if it has one
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def current(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def write(self, data):
+        return self.current().write(data)
+
+    def flush(self):
+        self.current().flush()
+
+    @property
+    def buffer(self):
+        return self.current().buffer
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class TaggedStream:
+    # Lines of one DMM on a stream shared by all of them, each line starting with tag.
+    # Only whole lines are written, lines of different DMMs are not mixed.
+
+    def __init__(self, out, lock, tag=''):
+        self.out = out
+        self.lock = lock
+        self.tag = tag
+        self.partial = ''
+
+    def write(self, data):
+        self.partial += data
+        if '\n' in self.partial:
+            lines, _, self.partial = self.partial.rpartition('\n')
+            text = ''.join(self.tag + line + '\n' for line in lines.split('\n')) if self.tag else lines + '\n'
+            with self.lock:
+                self.out.write(text)
+        return len(data)
+
+    def flush(self):
+        with self.lock:
+            self.out.flush()
+
+    def close(self):
+        if self.partial:
+            self.write('\n')
+
+
+class Member:
+    # One DMM of the fleet and the result of its command
+
+    def __init__(self, port):
+        self.port = port
+        self.serial = None
+        self.client = None
+        # Exit status of the command (0 when it succeeded), or the exception that stopped it
+        self.status = None
+        self.seconds = 0.0
+
+    def failed(self):
+        return self.status not in (0, None)
+
+
+def member_path(directory, info, output_format):
+    name = (info['model_number'] + '_' + info['serial_number']).replace(' ', '_')
+    name = ''.join(c for c in name if c.isalnum() or c in '_-.')
+    return os.path.join(directory, name + '.' + extensions[output_format])
+
+
+def run_member(member, template, command, run_command, split, streams, lock, headers, timing, stats_summary,
+               stats_file):
+    stdout, stderr = streams
+    start = time.time()
+    out = TaggedStream(stdout.default, lock, member.port + template.sep)
+    err = TaggedStream(stderr.default, lock, member.port + template.sep)
+    stdout.set(out)
+    stderr.set(err)
+    client = member.client = template.copy(member.port)
+    output_file = None
+    try:
+        client.open()
+        info = client.identity()
+        member.serial = info['serial_number']
+        out.tag = err.tag = member.serial + client.sep
+        if stats_summary or stats_file:
+            client.stats = stats.Stats([('meter', member.serial)])
+        if split:
+            os.makedirs(split, exist_ok=True)
+            path = member_path(split, info, client.output_format)
+            if client.output_format == 'binary':
+                output_file = client.out = open(path, 'wb')
+            else:
+                output_file = open(path, 'w')
+                stdout.set(output_file)
+        elif client.output_format in ('csv', 'ndjson'):
+            # Rows carry the serial number, they are not prefixed
+            client.out = TaggedStream(stdout.default, lock)
+            client.tags = {'meter': member.serial}
+            # One header for the tables of each kind of all the DMMs
+            client.headers = headers
+        if command[0] == 'dump':
+            root, ext = os.path.splitext(command[1])
+            command = ['dump', root + '_' + member.serial + ext]
+        run_command(client, command)
+        member.status = 0
+    except SystemExit as status:
+        # usage() exits without a status: invalid arguments, a failure
+        member.status = 1 if status.code is None else status.code
+    except Exception as error:
+        print(type(error).__name__ + ':', error, file=sys.stderr)
+        member.status = error
+    finally:
+        try:
+            if client.writer is not None: client.writer.close()
+            if timing: client.print_timing()
+            if stats_summary and client.stats is not None: client.stats.summary(client.sep, sys.stderr)
+        except Exception as error:
+            if not member.failed(): member.status = error
+        finally:
+            client.close()
+            if isinstance(client.out, TaggedStream): client.out.close()
+            out.close()
+            err.close()
+            if output_file is not None: output_file.close()
+            stdout.set(None)
+            stderr.set(None)
+            member.seconds = time.time() - start
+
+
+def run(template, ports, command, run_command, split=None, timing=False, stats_summary=False, stats_file=None):
+    # Runs command on all the ports at once, with the settings of the template client
+    if not ports:
+        print('No DMM port found')
+        sys.exit(10)
+    if template.output_format == 'binary' and not split:
+        print('Binary output of several DMMs needs --split')
+        sys.exit(10)
+    members = [Member(port) for port in ports]
+    streams = (ThreadStream(sys.stdout), ThreadStream(sys.stderr))
+    lock = threading.Lock()
+    headers = writers.SharedHeaders(streams[0].default, lock)
+    start = time.time()
+    sys.stdout, sys.stderr = streams
+    try:
+        threads = [threading.Thread(target=run_member, name=member.port, daemon=True,
+                                    args=(member, template, command, run_command, split, streams, lock, headers,
+                                          timing, stats_summary, stats_file))
+                   for member in members]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join() with a timeout, Ctrl-C is not delivered during a plain join()
+            while thread.is_alive():
+                thread.join(0.5)
+    finally:
+        sys.stdout, sys.stderr = streams[0].default, streams[1].default
+    sys.stdout.flush()
+    elapsed = time.time() - start
+
+    if stats_file:
+        stats.write_prometheus([member.client.stats for member in members
+                                if member.client is not None and member.client.stats is not None], stats_file)
+
+    print('Port', 'Serial', 'Status', 'Time (s)', sep=template.sep, file=sys.stderr)
+    for member in members:
+        if not member.failed():
+            status = 'ok'
+        elif isinstance(member.status, BaseException):
+            status = 'failed: %s' % member.status
+        else:
+            status = 'failed (exit %s)' % member.status
+        print(member.port, member.serial or '-', status, '%.2f' % member.seconds, sep=template.sep, file=sys.stderr)
+    failed = [member for member in members if member.failed()]
+    print('%d DMMs, %d failed, %.2fs' % (len(members), len(failed), elapsed), file=sys.stderr)
+    if failed:
+        sys.exit(11)
@@ -0,0 +1,179 @@
+# vim: set fileencoding=utf-8 :
+
+# pyserial URL handler for sim://, a simulated DMM in the same process (see simulator.py).
+# Options are given in the query string, e.g.
+#   sim://?recordings=5000,20&min_max=1&peak=1&measurements=3&latency=0.005&latency=qsrr=0.01
+#   &jitter=0.001&drop=0.01&truncate=0.01&seed=1&serial=12345678&instant=1
+# or sim://?replay=file.dump to answer with the replies of a file written by 'dump'.
+# Replies come out at the speed of the serial line (baudrate), unless instant=1.
+
+import time
+import urllib.parse
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+from fluke_28x_dmm_util import simulator
+
+
+class Serial(SerialBase):
+
+    def __init__(self, *args, **kwargs):
+        self.meter = None
+        self.instant = False
+        self.input = b''
+        self.request = b''
+        # Replies not received yet: [time of the first byte, bytes]
+        self.pending = []
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException('Port is already open.')
+        if self._port is None:
+            raise SerialException('Port must be configured before it can be used.')
+        # The meter is kept when the port is reopened
+        if self.meter is None:
+            self.from_url(self.port)
+        self.is_open = True
+        self.reset_input_buffer()
+
+    def from_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != 'sim':
+            raise SerialException('expected a string in the form "sim://[?option=value[&...]]"')
+        options = urllib.parse.parse_qs(parts.query)
+        try:
+            self.instant = options.pop('instant', ['0'])[-1] == '1'
+            replay = options.pop('replay', [None])[-1]
+            kwargs = {}
+            for name, values in options.items():
+                match name:
+                    case 'recordings':
+                        kwargs[name] = simulator.parse_counts(values[-1])
+                    case 'min_max' | 'peak' | 'measurements' | 'seed':
+                        kwargs[name] = int(values[-1])
+                    case 'latency':
+                        kwargs[name] = simulator.parse_latency(values)
+                    case 'jitter' | 'drop' | 'truncate':
+                        kwargs[name] = float(values[-1])
+                    case 'serial':
+                        kwargs[name] = values[-1]
+                    case _:
+                        raise ValueError('unknown option: %r' % name)
+        except ValueError as err:
+            raise SerialException('invalid sim:// URL %s: %s' % (url, err))
+        self.meter = simulator.ReplayMeter(replay, **kwargs) if replay else simulator.Meter(**kwargs)
+
+    def _reconfigure_port(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+        self.pending = []
+
+    def byte_time(self):
+        # 10 bits per byte on the serial line
+        return 0.0 if self.instant else 10.0 / self._baudrate
+
+    def receive(self):
+        # Move the bytes that have arrived to the input buffer
+        now = time.time()
+        byte_time = self.byte_time()
+        while self.pending:
+            start, data = self.pending[0]
+            if now < start: break
+            count = len(data) if byte_time == 0 else min(len(data), int((now - start) / byte_time) + 1)
+            self.input += data[:count]
+            if count < len(data):
+                self.pending[0] = [start + count * byte_time, data[count:]]
+                break
+            self.pending.pop(0)
+
+    def next_arrival(self, needed):
+        # Time when needed more bytes will have arrived, or the first reply will be complete
+        if not self.pending: return None
+        start, data = self.pending[0]
+        return start + (min(needed, len(data)) - 1) * self.byte_time()
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self.receive()
+        return len(self.input)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        deadline = None if self._timeout is None else time.time() + self._timeout
+        while True:
+            self.receive()
+            if len(self.input) >= size: break
+            arrival = self.next_arrival(size - len(self.input))
+            now = time.time()
+            if arrival is None or (deadline is not None and arrival > deadline):
+                # Nothing more before the timeout
+                if deadline is not None and deadline > now: time.sleep(deadline - now)
+                self.receive()
+                break
+            if arrival > now: time.sleep(arrival - now)
+        data, self.input = self.input[:size], self.input[size:]
+        return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = bytes(data)
+        self.request += data
+        now = time.time()
+        byte_time = self.byte_time()
+        # Command is received once its last byte has been sent
+        sent = now + len(data) * byte_time
+        while b'\r' in self.request:
+            line, self.request = self.request.split(b'\r', 1)
+            delay, reply = self.meter.reply(line.decode(errors='replace'))
+            # The DMM answers one command at a time
+            busy = self.pending[-1][0] + len(self.pending[-1][1]) * byte_time if self.pending else now
+            if reply:
+                self.pending.append([max(sent + delay, busy), reply])
+        return len(data)
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self.receive()
+        self.input = b''
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        self.request = b''
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def _update_break_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return True
+
+    @property
+    def dsr(self):
+        return True
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return True
@@ -0,0 +1,128 @@
+# vim: set fileencoding=utf-8 :
+
+# A recording held in memory column-wise.
+# Columns are NumPy arrays when NumPy is installed, array.array buffers otherwise.
+# NumPy is only imported when a recording is decoded, saved or loaded (batch.load).
+# Slicing a Recording gives a view on the same buffers, nothing is copied.
+
+import array
+import calendar
+import json
+import math
+
+from fluke_28x_dmm_util import batch
+from fluke_28x_dmm_util import decode
+
+# Column name, array typecode
+columns = [('start_ts', 'd'), ('primary', 'd'), ('maximum', 'd'), ('average', 'd'), ('minimum', 'd'),
+           ('duration', 'H'), ('unit', 'H'), ('record_type', 'H'), ('stable', 'H')]
+# Enumerated columns, map used for their codes
+enum_columns = {'unit': 'unit', 'record_type': 'recordtype', 'stable': 'isstableflag'}
+
+
+class Recording:
+
+    def __init__(self, info, data, tables):
+        # info: recording description (name, seq_no, start/end...), data: column name -> buffer,
+        # tables: enumerated column name -> {code: name}
+        self.info = info
+        self.data = data
+        self.tables = tables
+
+    def __len__(self):
+        return len(self.data['start_ts'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, slice):
+            return Recording(self.info, {name: column[key] for name, column in self.data.items()}, self.tables)
+        raise TypeError('Recording indices must be slices or column names')
+
+    def label(self, column, i):
+        # Name of an enumerated value
+        return self.tables[column][int(self.data[column][i])]
+
+    def sample_type(self, i):
+        # Type column of 'get recordings'
+        record_type = self.label('record_type', i)
+        return 'INTERVAL' if record_type == 'INTERVAL' else self.label('stable', i)
+
+    @classmethod
+    def from_blocks(cls, info, blocks, tables):
+        # blocks: qsrr blocks stacked in one bytes-like object
+        if batch.available():
+            return cls.from_columns(info, blocks, tables)
+        return cls.from_samples(info, blocks, tables)
+
+    @classmethod
+    def from_columns(cls, info, blocks, tables):
+        # Blocks decoded at once by NumPy
+        np = batch.load()
+        recording_tables = {name: tables[map_name] for name, map_name in enum_columns.items()}
+        samples = batch.decode_qsrr_blocks(blocks, tables)
+        readings = samples['readings']
+        primary = samples['readings2']['PRIMARY']
+        duration = samples['duration']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average = np.where(duration != 0, readings['AVERAGE']['value'] / duration, np.nan)
+        data = {'start_ts': samples['start_ts'], 'primary': primary['value'],
+                'maximum': readings['MAXIMUM']['value'], 'average': average,
+                'minimum': readings['MINIMUM']['value'], 'duration': duration, 'unit': primary['unit'],
+                'record_type': samples['record_type'], 'stable': samples['stable']}
+        return cls(info, {name: np.ascontiguousarray(data[name]) for name, typecode in columns},
+                   recording_tables)
+
+    @classmethod
+    def from_samples(cls, info, blocks, tables):
+        # Blocks decoded one by one into array buffers, without NumPy
+        recording_tables = {name: tables[map_name] for name, map_name in enum_columns.items()}
+        codes = {name: {value: code for code, value in tables[map_name].items()}
+                 for name, map_name in enum_columns.items()}
+        data = {name: array.array(typecode) for name, typecode in columns}
+        for offset in range(0, len(blocks), decode.QSRR_SIZE):
+            block = blocks[offset:offset + decode.QSRR_SIZE]
+            sample = decode.decode_qsrr(block, tables)
+            readings = sample['readings']
+            primary = sample['readings2']['PRIMARY']
+            duration = sample['duration']
+            # Unrounded start_ts, like the NumPy path
+            sh, sl = decode.words[1].unpack_from(block)
+            data['start_ts'].append(decode.doubles[1].unpack(decode.words[1].pack(sl, sh))[0])
+            data['primary'].append(primary['value'])
+            data['maximum'].append(readings['MAXIMUM']['value'])
+            data['average'].append(readings['AVERAGE']['value'] / duration if duration != 0 else math.nan)
+            data['minimum'].append(readings['MINIMUM']['value'])
+            data['duration'].append(duration)
+            data['unit'].append(codes['unit'][primary['unit']])
+            data['record_type'].append(codes['record_type'][sample['record_type']])
+            data['stable'].append(codes['stable'][sample['stable']])
+        return cls(info, {name: memoryview(column) for name, column in data.items()}, recording_tables)
+
+    def save(self, path):
+        np = batch.load()
+        if np is None:
+            raise ValueError('By app: NumPy is needed for .npz files')
+        tables = {name: {str(code): value for code, value in table.items()} for name, table in self.tables.items()}
+        np.savez(path, info=np.array(json.dumps(self.info)), tables=np.array(json.dumps(tables)),
+                 **{name: np.asarray(self.data[name]) for name, typecode in columns})
+
+    @classmethod
+    def load(cls, path):
+        np = batch.load()
+        if np is None:
+            raise ValueError('By app: NumPy is needed for .npz files')
+        with np.load(path) as npz:
+            info = json.loads(str(npz['info']))
+            tables = {name: {int(code): value for code, value in table.items()}
+                      for name, table in json.loads(str(npz['tables'])).items()}
+            return cls(info, {name: npz[name] for name, typecode in columns}, tables)
+
+
+def recording_info(index, recording):
+    # JSON friendly description of a recording, from qrsi
+    return {'index': index, 'name': recording['name'].decode(), 'seq_no': recording['seq_no'],
+            'start_ts': calendar.timegm(recording['start_ts']), 'end_ts': calendar.timegm(recording['end_ts']),
+            'sample_interval': recording['sample_interval'], 'num_samples': recording['num_samples'],
+            'reading_index': recording['reading_index'], 'prim_function': recording['prim_function'],
+            'unit': recording['unit']}
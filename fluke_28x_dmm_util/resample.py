@@ -0,0 +1,118 @@
+# vim: set fileencoding=utf-8 :
+
+# --resample: samples folded into time buckets as they are downloaded ('get recordings') or taken ('capture'),
+# one output row per bucket. Only the running bucket is kept, memory does not grow with the samples.
+# Buckets are aligned on multiples of the window in epoch seconds: a 1h window starts on the hour (UTC).
+# A bucket ends with the first sample of a later bucket, or of another unit.
+# Recordings: maximum of the MAXIMUM readings, minimum of the MINIMUM readings, and the average weighted by
+# the number of samples of each record (the qsrr duration, #Samples of 'get recordings'). The AVERAGE reading
+# of a record is its average multiplied by its samples: the sum of these readings is divided by the sum of the samples.
+# Live readings: minimum, mean and maximum of the primary values.
+# Samples with an overload (9.99999999e+37) are skipped, as with -o.
+
+import calendar
+import math
+
+from fluke_28x_dmm_util import writers
+
+OVERLOAD = writers.OVERLOAD
+
+# Seconds of the suffixes of a window
+window_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+recording_fields = [('start_time', writers.TIME), ('maximum', writers.FLOAT), ('maximum_unit', writers.STR),
+                    ('average', writers.FLOAT), ('average_unit', writers.STR),
+                    ('minimum', writers.FLOAT), ('minimum_unit', writers.STR),
+                    ('records', writers.INT), ('samples', writers.INT)]
+# #Records: qsrr records in the window, #Samples: their samples, as #Samples of 'get recordings'
+recording_header = ['Start Time', 'Maximum', '', 'Average', '', 'Minimum', '', '#Records', '#Samples']
+live_fields = [('time', writers.TIME), ('readings', writers.INT), ('minimum', writers.FLOAT),
+               ('average', writers.FLOAT), ('maximum', writers.FLOAT), ('unit', writers.STR)]
+
+
+def parse_window(text):
+    # Seconds of a window: 90, 90s, 15m, 1h, 1d
+    try:
+        seconds = float(text[:-1]) * window_units[text[-1]] if text[-1:] in window_units else float(text)
+    except ValueError:
+        seconds = 0.0
+    if not 0 < seconds < math.inf:
+        raise ValueError('By app: Invalid resample window %s' % text)
+    return seconds
+
+
+def overloaded(sample):
+    # Decoded qsrr sample skipped by -o
+    return sample['readings2']['PRIMARY']['value'] == OVERLOAD or \
+        sample['readings']['MAXIMUM']['value'] == OVERLOAD or \
+        sample['readings']['MINIMUM']['value'] == OVERLOAD
+
+
+class Buckets:
+    # The running bucket of a resampling
+
+    def __init__(self, window):
+        self.window = window
+        self.start = None
+        self.key = None
+        self.count = 0
+        self.maximum = -math.inf
+        self.minimum = math.inf
+        self.total = 0.0
+        self.weight = 0.0
+
+    def add(self, ts, key, maximum, minimum, total, weight):
+        # Adds a sample at ts (epoch seconds), key: its units. Returns the previous bucket if this sample
+        # starts a new one, as finish() does, else None
+        start = math.floor(ts / self.window) * self.window
+        finished = None
+        if start != self.start or key != self.key:
+            finished = self.finish()
+            self.start = start
+            self.key = key
+        self.count += 1
+        if maximum > self.maximum: self.maximum = maximum
+        if minimum < self.minimum: self.minimum = minimum
+        self.total += total
+        self.weight += weight
+        return finished
+
+    def finish(self):
+        # (start, key, count, maximum, minimum, average, weight) of the running bucket, None if it is empty.
+        # average is 0 without weight, as the average of a record without samples
+        if self.count == 0: return None
+        bucket = (self.start, self.key, self.count, self.maximum, self.minimum,
+                  self.total / self.weight if self.weight else 0, self.weight)
+        self.count = 0
+        self.maximum = -math.inf
+        self.minimum = math.inf
+        self.total = 0.0
+        self.weight = 0.0
+        return bucket
+
+
+def recording_rows(samples, window):
+    # Output rows of the buckets of decoded qsrr samples, as they come
+    buckets = Buckets(window)
+    for sample in samples:
+        if overloaded(sample): continue
+        readings = sample['readings']
+        finished = buckets.add(calendar.timegm(sample['start_ts']),
+                               (readings['MAXIMUM']['unit'], readings['AVERAGE']['unit'], readings['MINIMUM']['unit']),
+                               readings['MAXIMUM']['value'], readings['MINIMUM']['value'],
+                               readings['AVERAGE']['value'], sample['duration'])
+        if finished is not None:
+            yield recording_row(finished)
+    finished = buckets.finish()
+    if finished is not None:
+        yield recording_row(finished)
+
+
+def recording_row(bucket):
+    start, (maximum_unit, average_unit, minimum_unit), records, maximum, minimum, average, samples = bucket
+    return start, maximum, maximum_unit, average, average_unit, minimum, minimum_unit, records, int(samples)
+
+
+def live_row(bucket):
+    start, unit, count, maximum, minimum, average, weight = bucket
+    return start, count, minimum, average, maximum, unit
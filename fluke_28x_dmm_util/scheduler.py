@@ -0,0 +1,152 @@
+# vim: set fileencoding=utf-8 :
+
+# Scheduling of the commands of the daemon ('serve') on its DMM, which runs one command at a time.
+# Commands wait for the link in a priority queue: live readings (qddb) first, then the other commands,
+# then the bulk traffic of downloads (qsrr, qrsi...).
+# Downloads are run in slices, made of rounds of one pipeline window of samples. A slice ends early when a command
+# of higher priority is waiting, which gets the link: bulk traffic only uses the remaining capacity, and delays
+# a live reading by one round at most.
+# With a live rate, the daemon polls qddb at fixed times (slots), and the time from the slot to the reply is
+# the live latency. A poll that ends after the next slot has missed it, that slot is skipped.
+
+import bisect
+import heapq
+import itertools
+import threading
+import time
+
+from fluke_28x_dmm_util import stats
+
+LIVE = 0
+COMMAND = 1
+BULK = 2
+priority_names = ['live', 'command', 'bulk']
+
+# Commands of downloads
+bulk_verbs = ['qsrr', 'qrsi', 'qsmr', 'qmmsi', 'qpsi']
+# Most samples downloaded in one slice, other downloads get the link between slices
+BULK_SLICE = 64
+
+
+def command_priority(cmd):
+    verb = cmd.split(' ', 1)[0]
+    if verb == 'qddb': return LIVE
+    return BULK if verb in bulk_verbs else COMMAND
+
+
+class PriorityStats:
+
+    def __init__(self):
+        self.commands = 0
+        # Time spent waiting for the link, and using it
+        self.wait_histogram = [0] * (len(stats.latency_buckets) + 1)
+        self.max_wait = 0.0
+        self.seconds = 0.0
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Commands waiting for the link: (priority, arrival order)
+        self.queue = []
+        self.order = itertools.count()
+        self.busy = False
+        self.start = time.time()
+        self.priorities = [PriorityStats() for name in priority_names]
+        self.live_polls = 0
+        self.live_missed = 0
+        self.live_histogram = [0] * (len(stats.latency_buckets) + 1)
+        self.bulk_samples = 0
+        self.bulk_bytes = 0
+        # Counters at the previous status line
+        self.last_status = (time.time(), 0, 0, 0)
+        self.status_max_latency = 0.0
+
+    def acquire(self, priority):
+        with self.condition:
+            entry = (priority, next(self.order))
+            heapq.heappush(self.queue, entry)
+            while self.busy or self.queue[0] != entry:
+                self.condition.wait()
+            heapq.heappop(self.queue)
+            self.busy = True
+
+    def release(self):
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+
+    def waiting(self, priority):
+        # True if a command of higher priority waits for the link
+        with self.condition:
+            return bool(self.queue) and self.queue[0][0] < priority
+
+    def run(self, priority, func):
+        # Result of func, run when the link is free and no command of higher priority is waiting
+        queued = time.perf_counter()
+        self.acquire(priority)
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.release()
+            self.record(priority, start - queued, time.perf_counter() - start)
+
+    def record(self, priority, wait, seconds):
+        with self.condition:
+            counters = self.priorities[priority]
+            counters.commands += 1
+            counters.wait_histogram[bisect.bisect_left(stats.latency_buckets, wait)] += 1
+            counters.max_wait = max(counters.max_wait, wait)
+            counters.seconds += seconds
+
+    def live(self, latency, missed):
+        # A live poll answered latency seconds after its slot, missed: slots skipped because of it
+        with self.condition:
+            self.live_polls += 1
+            self.live_missed += missed
+            self.live_histogram[bisect.bisect_left(stats.latency_buckets, latency)] += 1
+            self.status_max_latency = max(self.status_max_latency, latency)
+
+    def bulk(self, samples, size):
+        with self.condition:
+            self.bulk_samples += samples
+            self.bulk_bytes += size
+
+    def status(self):
+        # One line about the traffic since the previous one, None if there was none
+        with self.condition:
+            now = time.time()
+            last, polls, missed, samples = self.last_status
+            self.last_status = (now, self.live_polls, self.live_missed, self.bulk_samples)
+            max_latency = self.status_max_latency
+            self.status_max_latency = 0.0
+            polls = self.live_polls - polls
+            missed = self.live_missed - missed
+            samples = self.bulk_samples - samples
+        if polls == 0 and samples == 0: return None
+        elapsed = max(now - last, 1e-9)
+        parts = []
+        if polls:
+            parts.append('live %.1f polls/s, max latency %.0f ms, %d missed' % (polls / elapsed, max_latency * 1000,
+                                                                                 missed))
+        parts.append('bulk %.1f samples/s' % (samples / elapsed))
+        return '; '.join(parts)
+
+    def summary(self, sep='\t', file=None):
+        elapsed = time.time() - self.start
+        print('Priority', 'Commands', 'Wait p50 (ms)', 'Wait p99 (ms)', 'Max wait (ms)', 'Link (s)', 'Link use',
+              sep=sep, file=file)
+        for name, counters in zip(priority_names, self.priorities):
+            print(name, counters.commands, stats.histogram_percentile(counters.wait_histogram, 50),
+                  stats.histogram_percentile(counters.wait_histogram, 99), '%.1f' % (counters.max_wait * 1000),
+                  '%.3f' % counters.seconds, '%.1f%%' % (counters.seconds / max(elapsed, 1e-9) * 100),
+                  sep=sep, file=file)
+        print('Live polls', self.live_polls, 'Missed slots', self.live_missed,
+              'Latency p50 (ms)', stats.histogram_percentile(self.live_histogram, 50),
+              'Latency p99 (ms)', stats.histogram_percentile(self.live_histogram, 99), sep=sep, file=file)
+        bulk_seconds = self.priorities[BULK].seconds
+        print('Bulk samples', self.bulk_samples, 'Bytes', self.bulk_bytes,
+              'Samples/s', '%.1f' % (self.bulk_samples / bulk_seconds) if bulk_seconds else '-',
+              sep=sep, file=file)
@@ -0,0 +1,362 @@
+# vim: set fileencoding=utf-8 :
+
+# 'serve': a daemon that keeps the port of one DMM open, with its identity and maps loaded,
+# and runs the commands of local clients received on a Unix domain socket.
+# The CLI uses a running daemon of its port automatically (RemoteClient), several tools can then share one DMM.
+#
+# Protocol: one JSON object per line, each request gets one response line (several for 'blocks'), same id.
+#   {"id": 1, "op": "info", "refresh": false}  -> {"id": 1, "identity": {...}, "maps": {...}}
+#   {"id": 2, "op": "command", "cmd": "qrsi 0"} -> {"id": 2, "reply": "<base64 reply, status included>"}
+#   {"id": 3, "op": "blocks", "reading_index": "2", "num_samples": 100, "first": 0, "window": 8}
+#       -> {"id": 3, "blocks": "<base64 qsrr blocks>"} ... then {"id": 3, "done": true}
+# Errors: {"id": n, "error": "message", "exit": status}, status is the exit status of the same error in the CLI.
+# Identical query commands received while one is running are coalesced: they all get the reply of the first one.
+# Commands are run by priority (scheduler.py): live readings first, downloads in slices with the remaining capacity.
+# With a live rate (--live-rate), qddb is polled at that rate and qddb commands get the reply of the next poll.
+
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+from fluke_28x_dmm_util import decode
+from fluke_28x_dmm_util import scheduler
+from fluke_28x_dmm_util.dmm_util import DmmClient
+
+# Messages of the errors of DmmClient.command_reply, by exit status
+reply_errors = {6: 'Did not receive data from DMM', 7: 'Invalid value', 8: 'Did not receive complete reply from DMM'}
+# Seconds between two status lines about the live and bulk traffic
+report_interval = 10.0
+
+
+def socket_path(port):
+    # Default socket of the daemon of a port
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    name = ''.join(c if c.isalnum() or c in '-.' else '_' for c in port)
+    # Unix socket paths are short
+    if len(name) > 40:
+        name = name[:24] + '_' + hashlib.sha1(port.encode()).hexdigest()[:12]
+    return os.path.join(base, 'fluke_28x_dmm_util_' + name + '.sock')
+
+
+def daemon_running(path):
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def is_query(cmd):
+    # Commands without side effects, that can be coalesced
+    verb = cmd.split(' ', 1)[0]
+    return verb.startswith('q') or verb == 'ID'
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, client, live_rate=None):
+        self.client = client
+        # One command at a time on the port, by priority
+        self.scheduler = scheduler.Scheduler()
+        # Query commands running: cmd -> Future of the response
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        # Live polls per second, and the response of the last one
+        self.live_rate = live_rate
+        self.live_condition = threading.Condition()
+        self.live_response = None
+        self.live_count = 0
+        super().__init__(path, Handler)
+
+    def run(self, func, priority=scheduler.COMMAND):
+        # Response of func run on the DMM, a failed command exits with an error status
+        def guarded():
+            try:
+                return func()
+            except SystemExit as status:
+                code = status.code if isinstance(status.code, int) else 1
+                return {'error': reply_errors.get(code, 'Command failed'), 'exit': code}
+            except Exception as error:
+                return {'error': '%s: %s' % (type(error).__name__, error), 'exit': 1}
+        return self.scheduler.run(priority, guarded)
+
+    def reply(self, cmd):
+        return self.run(lambda: {'reply': base64.b64encode(self.client.command_reply(cmd)).decode()},
+                        scheduler.command_priority(cmd))
+
+    def command(self, cmd):
+        self.requests += 1
+        if cmd == 'qddb' and self.live_rate:
+            response = self.next_live()
+            if response is not None: return response
+        if not is_query(cmd):
+            return self.reply(cmd)
+        with self.pending_lock:
+            future = self.pending.get(cmd)
+            running = future is not None
+            if running:
+                self.coalesced += 1
+            else:
+                future = self.pending[cmd] = concurrent.futures.Future()
+        if running:
+            return future.result()
+        try:
+            response = self.reply(cmd)
+        finally:
+            with self.pending_lock:
+                del self.pending[cmd]
+        future.set_result(response)
+        return response
+
+    def info(self, refresh=False):
+        def load():
+            if refresh:
+                self.client.map_cache = {}
+                self.client.tables = None
+                self.client.map_cache_loaded = True
+            self.client.enum_tables()
+            return {'identity': self.client.identity(), 'maps': self.client.map_cache}
+        return self.run(load)
+
+    def poll_live(self):
+        # Polls qddb in the slots of the live rate, for ever
+        period = 1.0 / self.live_rate
+        slot = time.perf_counter()
+        while True:
+            delay = slot - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+            response = self.reply('qddb')
+            latency = time.perf_counter() - slot
+            missed = int(latency / period)
+            self.scheduler.live(latency, missed)
+            with self.live_condition:
+                self.live_response = response
+                self.live_count += 1
+                self.live_condition.notify_all()
+            slot += (missed + 1) * period
+
+    def next_live(self):
+        # Response of the next live poll, None if it does not come in time
+        with self.live_condition:
+            count = self.live_count
+            if self.live_condition.wait_for(lambda: self.live_count != count,
+                                            2.0 / self.live_rate + self.client.deadline):
+                return self.live_response
+        return None
+
+    def report(self):
+        while True:
+            time.sleep(report_interval)
+            status = self.scheduler.status()
+            if status is not None: print(status, file=sys.stderr, flush=True)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                op = request['op']
+            except (ValueError, KeyError, AttributeError):
+                self.send({'error': 'Invalid request', 'exit': 1})
+                continue
+            match op:
+                case 'command':
+                    response = self.server.command(request['cmd'])
+                case 'info':
+                    response = self.server.info(request.get('refresh', False))
+                case 'blocks':
+                    response = self.blocks(request)
+                case _:
+                    response = {'error': 'Unknown operation %s' % op, 'exit': 1}
+            self.send(dict(response, id=request_id))
+
+    def blocks(self, request):
+        # Sends the blocks slice by slice as they are downloaded, commands of higher priority run between slices
+        client = self.server.client
+        reading_index = request['reading_index']
+        num_samples = request['num_samples']
+        window = max(request.get('window', 1), client.window)
+
+        def download(first):
+            # Rounds of one window, until the end of the slice or until a command of higher priority is waiting
+            saved_window = client.window
+            client.window = window
+            blocks = []
+            try:
+                end = first
+                while end < min(first + scheduler.BULK_SLICE, num_samples):
+                    start, end = end, min(end + window, num_samples)
+                    blocks += client.qsrr_blocks(reading_index, end, start)
+                    if self.server.scheduler.waiting(scheduler.BULK): break
+            finally:
+                client.window = saved_window
+            data = b''.join(blocks)
+            self.server.scheduler.bulk(len(blocks), len(data))
+            return {'blocks': base64.b64encode(data).decode(), 'end': end}
+
+        first = request.get('first', 0)
+        while first < num_samples:
+            response = self.server.run(lambda: download(first), scheduler.BULK)
+            if 'error' in response: return response
+            first = response.pop('end')
+            self.send(dict(response, id=request.get('id')))
+        return {'done': True}
+
+    def send(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+
+def serve(client, path=None, live_rate=None):
+    # Runs the daemon of client's port until interrupted, polling qddb live_rate times per second if given
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Unix domain sockets are not available on this system')
+        sys.exit(12)
+    path = path or socket_path(client.port)
+    if daemon_running(path):
+        print('A daemon is already running on ' + path)
+        sys.exit(12)
+    if os.path.exists(path):
+        # Left by a daemon that did not stop cleanly
+        os.unlink(path)
+    client.open()
+    info = client.identity()
+    client.enum_tables()
+    daemon = Daemon(path, client, live_rate)
+    start = time.time()
+    print('Serving %s %s on %s (port %s)' % (info['model_number'], info['serial_number'], path, client.port),
+          flush=True)
+    if live_rate:
+        threading.Thread(target=daemon.poll_live, name='live', daemon=True).start()
+    threading.Thread(target=daemon.report, name='report', daemon=True).start()
+    # Stopped by Ctrl-C, or by SIGTERM from a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        os.unlink(path)
+        print('%d requests, %d coalesced in %.0fs' % (daemon.requests, daemon.coalesced, time.time() - start),
+              file=sys.stderr)
+        daemon.scheduler.summary(client.sep, sys.stderr)
+
+
+class RemoteClient(DmmClient):
+    # DmmClient running its commands through the daemon of its port
+
+    def __init__(self, port, path, **kwargs):
+        super().__init__(port, **kwargs)
+        self.path = path
+        self.sock = None
+        self.file = None
+        self.request_id = 0
+
+    def open(self):
+        if self.sock is not None: return
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+        except OSError as err:
+            print('Daemon ' + self.path + ' does not respond')
+            print(err)
+            sys.exit(12)
+        self.file = self.sock.makefile('rwb')
+        # Identity and maps are already loaded by the daemon
+        info = self.request({'op': 'info', 'refresh': self.refresh_cache})
+        self.meter_info = info['identity']
+        self.map_cache = info['maps']
+        self.map_cache_loaded = True
+
+    def close(self):
+        if self.sock is not None:
+            self.file.close()
+            self.sock.close()
+            self.sock = None
+
+    def send(self, request):
+        self.open()
+        self.request_id += 1
+        request['id'] = self.request_id
+        self.file.write(json.dumps(request).encode() + b'\n')
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            print('Daemon ' + self.path + ' closed the connection')
+            sys.exit(12)
+        response = json.loads(line)
+        if 'error' in response:
+            print(response['error'])
+            sys.exit(response.get('exit', 1))
+        return response
+
+    def request(self, request):
+        self.send(request)
+        return self.receive()
+
+    def command_reply(self, cmd, deadline=None):
+        # The daemon applies its own deadline. --stats and --trace measure the round trip through the daemon
+        cmd = cmd.rstrip('\r')
+        start = time.perf_counter()
+        data = base64.b64decode(self.request({'op': 'command', 'cmd': cmd})['reply'])
+        if self.stats is not None:
+            verb = cmd.split(' ', 1)[0]
+            self.stats.read(verb, len(data))
+            self.stats.command(verb, time.perf_counter() - start)
+        if self.trace is not None: self.trace.span('meter_command', start, args={'cmd': cmd, 'daemon': self.path})
+        return data
+
+    def sync_time(self):
+        self.meter_command('mp clock,' + str(int(time.time())))
+        return True
+
+    def qsrr_blocks(self, reading_idx, num_samples, first=0):
+        self.send({'op': 'blocks', 'reading_index': reading_idx, 'num_samples': num_samples, 'first': first,
+                   'window': self.window})
+        k = first
+        done = False
+        try:
+            while not done:
+                start = time.perf_counter()
+                response = self.receive()
+                done = response.get('done', False)
+                blocks = base64.b64decode(response.get('blocks', ''))
+                count = len(blocks) // decode.QSRR_SIZE
+                if count and self.stats is not None:
+                    # Each block counts as one qsrr, taking its share of the wait for the slice
+                    self.stats.read('qsrr', len(blocks))
+                    for _ in range(count):
+                        self.stats.command('qsrr', (time.perf_counter() - start) / count)
+                if count and self.trace is not None:
+                    self.trace.span('daemon blocks', start, args={'first': k, 'samples': count})
+                for offset in range(0, len(blocks), decode.QSRR_SIZE):
+                    block = blocks[offset:offset + decode.QSRR_SIZE]
+                    if self.dump is not None:
+                        self.dump.frame('qsrr ' + reading_idx + ',' + str(k), b'0\r#0' + block + b'\r')
+                    k += 1
+                    yield block
+        finally:
+            # The rest of the blocks must be read before the next request, even if they are not used
+            while not done and self.sock is not None:
+                done = self.receive().get('done', False)
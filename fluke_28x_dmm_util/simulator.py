@@ -0,0 +1,286 @@
+# vim: set fileencoding=utf-8 :
+
+# Simulated Fluke 287/289, to test and benchmark without a DMM.
+# Meter answers the DMM commands with the binary layouts expected by decode.py, from synthetic saved items.
+# It is served on a pseudo-terminal:
+#   python -m fluke_28x_dmm_util.simulator [options]    (prints the port name to use with -p)
+# or in the same process through the sim:// URL (see protocol_sim.py):
+#   python -m fluke_28x_dmm_util -p "sim://?recordings=5000,20&latency=0.005" get recordings 1
+# Faults can be injected: latency and jitter per command, dropped bytes and truncated replies.
+# ReplayMeter answers with the replies recorded by 'dump' instead.
+
+import argparse
+import os
+import random
+import struct
+import threading
+import time
+
+from fluke_28x_dmm_util import dump
+
+sample_maps = {
+    'primfunction': ['V_DC', 'V_AC', 'A_DC', 'OHMS'],
+    'secfunction': ['NONE', 'HZ'],
+    'autorange': ['AUTO', 'MANUAL'],
+    'unit': ['NONE', 'VDC', 'VAC', 'ADC', 'OHM'],
+    'bolt': ['OFF', 'ON'],
+    'mode': ['NONE', 'HOLD', 'MIN_MAX_AVG', 'RECORD'],
+    'readingid': ['PRIMARY', 'MAXIMUM', 'AVERAGE', 'MINIMUM', 'LIVE'],
+    'state': ['NORMAL', 'OL'],
+    'attribute': ['NONE', 'SHORT'],
+    'recordtype': ['INPUT', 'INTERVAL'],
+    'isstableflag': ['UNSTABLE', 'STABLE'],
+    'transientstate': ['NON_T', 'RANGE_UP'],
+}
+
+T0 = 1650000000.0
+# num_samples is 16 bits in qrsi
+MAX_SAMPLES = 0xffff
+
+
+def encode_u16(value):
+    return struct.pack('<H', value & 0xffff)
+
+
+def encode_double(value):
+    # Most significant word first, see get_double
+    raw = struct.pack('<d', value)
+    return raw[4:8] + raw[0:4]
+
+
+def encode_reading(reading_id, value, unit, ts, decimals=4):
+    return (encode_u16(reading_id) + encode_double(value) + encode_u16(unit) + encode_u16(0)
+            + encode_u16(decimals) + encode_u16(5) + encode_u16(0) + encode_u16(0) + encode_double(ts))
+
+
+def sample_qsrr(k, t0=T0):
+    start = t0 + k * 10
+    return (encode_double(start) + encode_double(start + 10)
+            + encode_reading(1, 1.5 + k / 7, 1, start) + encode_reading(2, 10.0 * (k + 1), 1, start)
+            + encode_reading(3, 0.5 - k / 3, 1, start)
+            + encode_u16(10) + encode_u16(0) + encode_reading(0, 1.0 + k / 11, 1, start)
+            + encode_u16(k % 2) + encode_u16(1) + encode_u16(0))
+
+
+def sample_qrsi(idx, num_samples=1000, t0=T0):
+    return (encode_u16(10 + idx) + encode_u16(0) + encode_double(t0) + encode_double(t0 + num_samples * 10)
+            + encode_double(10.0) + encode_double(0.05) + encode_u16(idx) + encode_u16(0) + encode_u16(num_samples)
+            + encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(1) + encode_double(5.0)
+            + encode_u16(0) + encode_u16(0) + encode_u16(0) * 4 + encode_u16(3) + encode_u16(0) + encode_u16(1)
+            + encode_reading(0, 1.0, 1, t0) + b'REC%d' % idx)
+
+
+def sample_min_max(idx, t0=T0):
+    return (encode_u16(20 + idx) + encode_u16(0) + encode_double(t0) + encode_double(t0 + 3700)
+            + encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(1) + encode_double(5.0) + encode_u16(0xfffd)
+            + encode_u16(0) + encode_double(t0) + encode_u16(2) + encode_u16(0) + encode_u16(4)
+            + encode_reading(0, 1.0, 1, t0) + encode_reading(1, 2.0, 1, t0) + encode_reading(2, 1.2, 1, t0)
+            + encode_reading(3, 0.1, 1, t0) + b'MM%d' % idx)
+
+
+def sample_qsmr(idx, t0=T0):
+    return (encode_u16(30 + idx) + encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(1)
+            + encode_double(5.0) + encode_u16(0) + encode_u16(0) + encode_u16(0) * 4 + encode_u16(0) + encode_u16(0)
+            + encode_u16(1) + encode_reading(0, 3.3 + idx, 1, t0 + idx) + b'MEAS%d' % idx)
+
+
+def sample_qddb(t0=T0):
+    return (encode_u16(0) + encode_u16(0) + encode_u16(0) + encode_u16(1) + encode_double(5.0) + encode_u16(0)
+            + encode_u16(0) + encode_double(t0) + encode_u16(0) + encode_u16(0) + encode_u16(2)
+            + encode_reading(4, 1.23, 1, t0) + encode_reading(0, 1.23, 1, t0))
+
+
+class Meter:
+
+    def __init__(self, recordings=(20,), min_max=1, peak=1, measurements=3, latency=0.0, jitter=0.0,
+                 drop=0.0, truncate=0.0, seed=None, serial='12345678'):
+        # recordings: number of samples of each recording
+        # latency: seconds before each reply, or {verb: seconds} with an optional 'default' key
+        # jitter: up to this many seconds added to the latency
+        # drop, truncate: probability for a reply to lose one byte, or to be cut (possibly to nothing)
+        # serial: serial number, to tell several simulated DMMs apart
+        self.recordings = [min(n, MAX_SAMPLES) for n in recordings]
+        self.min_max = min_max
+        self.peak = peak
+        self.measurements = measurements
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.truncate = truncate
+        self.random = random.Random(seed)
+        self.identity = ['FLUKE 289', 'V1.16', serial]
+        self.properties = {'company': "'ACME'", 'contact': "'Contact'", 'operator': "'Operator'", 'site': "'Site'",
+                           'aheventTh': '4', 'lang': 'ENGLISH', 'dateFmt': 'MM_DD', 'timeFmt': '24',
+                           'digits': '5', 'beeper': 'ON', 'tempOS': '0', 'numFmt': 'POINT', 'ablto': '0',
+                           'apoffto': '1800'}
+        self.names = ['SAVE', 'LOAD', 'INPUT', 'OUTPUT', 'TEST', 'MOTOR', 'PUMP', 'FAN']
+        self.clock_offset = 0.0
+        self.commands = 0
+        self.bytes_sent = 0
+        self.faults = 0
+
+    def latency_of(self, verb):
+        if isinstance(self.latency, dict):
+            return self.latency.get(verb, self.latency.get('default', 0.0))
+        return self.latency
+
+    def reply(self, cmd):
+        # (delay, bytes sent back) for a command, faults included
+        self.commands += 1
+        verb = cmd.split(' ', 1)[0]
+        data = self.respond(cmd)
+        if self.truncate and self.random.random() < self.truncate:
+            data = data[:self.random.randrange(len(data))]
+            self.faults += 1
+        if self.drop and data and self.random.random() < self.drop:
+            i = self.random.randrange(len(data))
+            data = data[:i] + data[i + 1:]
+            self.faults += 1
+        delay = self.latency_of(verb) + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        self.bytes_sent += len(data)
+        return delay, data
+
+    def respond(self, cmd):
+        verb, _, arg = cmd.partition(' ')
+        try:
+            match verb:
+                case 'ID':
+                    return b'0\r' + ','.join(self.identity).encode() + b'\r'
+                case 'qsls':
+                    return b'0\r%d,%d,%d,%d\r' % (len(self.recordings), self.min_max, self.peak, self.measurements)
+                case 'qemap':
+                    values = sample_maps[arg]
+                    return ('0\r%d,' % len(values) + ','.join('%d,%s' % item for item in enumerate(values))
+                            + '\r').encode()
+                case 'qrsi':
+                    idx = int(arg)
+                    return self.binary(sample_qrsi(idx, self.recordings[idx], self.recording_start(idx)))
+                case 'qsrr':
+                    idx, k = [int(v) for v in arg.split(',')]
+                    if not 0 <= k < self.recordings[idx]: return b'2\r'
+                    return self.binary(sample_qsrr(k, self.recording_start(idx)))
+                case 'qmmsi' | 'qpsi':
+                    idx = int(arg)
+                    if not 0 <= idx < (self.min_max if verb == 'qmmsi' else self.peak): return b'2\r'
+                    return self.binary(sample_min_max(idx))
+                case 'qsmr':
+                    idx = int(arg)
+                    if not 0 <= idx < self.measurements: return b'2\r'
+                    return self.binary(sample_qsmr(idx))
+                case 'qddb':
+                    return self.binary(sample_qddb(time.time() + self.clock_offset))
+                case 'qmp' | 'qmpq':
+                    if arg == 'clock':
+                        return b'0\r%d\r' % int(time.time() + self.clock_offset)
+                    return b'0\r' + self.properties[arg].encode() + b'\r'
+                case 'mp' | 'mpq':
+                    name, _, value = arg.partition(',')
+                    if name == 'clock':
+                        self.clock_offset = int(value) - time.time()
+                    elif name in self.properties:
+                        self.properties[name] = value
+                    else:
+                        return b'1\r'
+                    return b'0\r'
+                case 'qsavname':
+                    return b'0\r' + self.names[int(arg)].encode() + b'\r'
+                case 'savname':
+                    idx, _, name = arg.partition(',')
+                    self.names[int(idx)] = name.strip('"')
+                    return b'0\r'
+        except (KeyError, IndexError, ValueError):
+            return b'2\r'
+        # Unknown command
+        return b'1\r'
+
+    def binary(self, payload):
+        return b'0\r#0' + payload + b'\r'
+
+    def recording_start(self, idx):
+        # One recording per day
+        return T0 + idx * 86400
+
+
+class ReplayMeter(Meter):
+    # Answers with the replies of a file written by 'dump'
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.replies = dict(dump.read_frames(path))
+
+    def respond(self, cmd):
+        return self.replies.get(cmd, b'1\r')
+
+
+def parse_counts(text):
+    return tuple(int(v) for v in text.split(',') if v)
+
+
+def parse_latency(values):
+    # ['0.01', 'qsrr=0.02'] -> {'default': 0.01, 'qsrr': 0.02}
+    latency = {}
+    for value in values:
+        verb, _, seconds = value.rpartition('=')
+        latency[verb or 'default'] = float(seconds)
+    return latency.get('default', 0.0) if list(latency) in ([], ['default']) else latency
+
+
+def serve_fd(meter, fd):
+    # Answer the commands received on fd, until it is closed
+    buffer = b''
+    while True:
+        try:
+            data = os.read(fd, 1024)
+        except OSError:
+            return
+        if not data: return
+        buffer += data
+        while b'\r' in buffer:
+            line, buffer = buffer.split(b'\r', 1)
+            delay, reply = meter.reply(line.decode(errors='replace'))
+            if delay: time.sleep(delay)
+            if reply: os.write(fd, reply)
+
+
+def serve_pty(meter):
+    # Serves meter on a new pseudo-terminal from a background thread, returns the port name
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    threading.Thread(target=serve_fd, args=(meter, master), daemon=True).start()
+    return os.ttyname(slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Fluke 287/289 on a pseudo-terminal')
+    parser.add_argument('--recordings', default='20', help='samples of each recording, e.g. 5000,20 (defaults to 20)')
+    parser.add_argument('--min-max', type=int, default=1, help='number of min/max recordings')
+    parser.add_argument('--peak', type=int, default=1, help='number of peak recordings')
+    parser.add_argument('--measurements', type=int, default=3, help='number of saved measurements')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='seconds before each reply, or VERB=SECONDS for one command (repeatable)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds added to the latency')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability for a reply to lose one byte')
+    parser.add_argument('--truncate', type=float, default=0.0, help='probability for a reply to be cut')
+    parser.add_argument('--seed', type=int, help='random seed, to reproduce the faults')
+    parser.add_argument('--serial', default='12345678', help='serial number (defaults to 12345678)')
+    parser.add_argument('--replay', help="answer with the replies of a file written by 'dump'")
+    args = parser.parse_args()
+    options = dict(latency=parse_latency(args.latency), jitter=args.jitter, drop=args.drop, truncate=args.truncate,
+                   seed=args.seed, serial=args.serial)
+    if args.replay:
+        meter = ReplayMeter(args.replay, **options)
+    else:
+        meter = Meter(parse_counts(args.recordings), args.min_max, args.peak, args.measurements, **options)
+    print(serve_pty(meter), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
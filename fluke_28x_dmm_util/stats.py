@@ -0,0 +1,151 @@
+# vim: set fileencoding=utf-8 :
+
+# Counters of the DMM commands, for --stats and --stats-file.
+# DmmClient.stats is None unless they are asked for, so that they cost nothing otherwise.
+# Per command verb: calls, latency histogram, bytes read, retries and port reopens.
+# The Prometheus file uses the text exposition format, it can be read by the node_exporter textfile collector.
+
+import bisect
+import os
+import time
+
+# Upper bounds of the latency histogram buckets (seconds), the last bucket is +Inf
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+PREFIX = 'fluke_dmm_'
+
+
+class VerbStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(latency_buckets) + 1)
+        self.bytes = 0
+        # Commands sent again: incomplete replies, error status, invalid qsrr blocks
+        self.retries = 0
+        self.reopens = 0
+
+
+class Stats:
+
+    def __init__(self, labels=None):
+        # labels: [name, value] pairs added to the Prometheus samples
+        self.labels = labels or []
+        self.start = time.time()
+        self.verbs = {}
+        self.pipeline_fallbacks = 0
+        self.decode_seconds = 0.0
+        self.decoded_blocks = 0
+
+    def verb(self, verb):
+        try:
+            return self.verbs[verb]
+        except KeyError:
+            stats = self.verbs[verb] = VerbStats()
+            return stats
+
+    def command(self, verb, seconds):
+        # A command that got its reply, retries included
+        stats = self.verb(verb)
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.histogram[bisect.bisect_left(latency_buckets, seconds)] += 1
+
+    def read(self, verb, count):
+        self.verb(verb).bytes += count
+
+    def retry(self, verb):
+        self.verb(verb).retries += 1
+
+    def reopen(self, verb):
+        self.verb(verb).reopens += 1
+
+    def decoded(self, seconds, blocks=1):
+        self.decode_seconds += seconds
+        self.decoded_blocks += blocks
+
+    def summary(self, sep='\t', file=None):
+        elapsed = time.time() - self.start
+        print('Command', 'Calls', 'Retries', 'Reopens', 'Bytes', 'Mean (ms)', 'p50 (ms)', 'p99 (ms)', 'Max (ms)',
+              'Total (s)', sep=sep, file=file)
+        for verb, stats in sorted(self.verbs.items()):
+            mean = '%.1f' % (stats.seconds / stats.calls * 1000) if stats.calls else '-'
+            print(verb, stats.calls, stats.retries, stats.reopens, stats.bytes, mean,
+                  histogram_percentile(stats.histogram, 50), histogram_percentile(stats.histogram, 99),
+                  '%.1f' % (stats.max_seconds * 1000), '%.3f' % stats.seconds, sep=sep, file=file)
+        print('Latency histogram (ms)', *['<=%g' % (bound * 1000) for bound in latency_buckets], '>%g'
+              % (latency_buckets[-1] * 1000), sep=sep, file=file)
+        for verb, stats in sorted(self.verbs.items()):
+            print(verb, *stats.histogram, sep=sep, file=file)
+        commands = sum(stats.seconds for stats in self.verbs.values())
+        print('Elapsed (s)', '%.3f' % elapsed, 'Commands (s)', '%.3f' % commands,
+              'Decoding (s)', '%.3f' % self.decode_seconds, 'Decoded blocks', self.decoded_blocks,
+              'Pipeline fallbacks', self.pipeline_fallbacks, sep=sep, file=file)
+
+    def prometheus(self):
+        return prometheus([self])
+
+    def write_prometheus(self, path):
+        write_prometheus([self], path)
+
+
+def prometheus(stats_list):
+    # Text exposition format, the statistics of several DMMs are told apart by their labels
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append('# HELP %s%s %s' % (PREFIX, name, help_text))
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, metric_type))
+        for suffix, labels, value in samples:
+            label_text = ','.join('%s="%s"' % (k, v) for k, v in labels)
+            lines.append('%s%s%s%s %s' % (PREFIX, name, suffix, '{' + label_text + '}' if label_text else '',
+                                          repr(float(value)) if isinstance(value, float) else value))
+
+    verbs = [(s.labels + [('verb', verb)], stats) for s in stats_list for verb, stats in sorted(s.verbs.items())]
+    histogram = []
+    for labels, stats in verbs:
+        cumulative = 0
+        for bound, count in zip(latency_buckets + [None], stats.histogram):
+            cumulative += count
+            histogram.append(('_bucket', labels + [('le', '+Inf' if bound is None else repr(bound))], cumulative))
+        histogram.append(('_sum', labels, stats.seconds))
+        histogram.append(('_count', labels, stats.calls))
+    metric('command_duration_seconds', 'histogram', 'Time to get the reply of a command, retries included', histogram)
+    metric('command_bytes_read_total', 'counter', 'Bytes read from the DMM',
+           [('', labels, stats.bytes) for labels, stats in verbs])
+    metric('command_retries_total', 'counter', 'Commands sent again',
+           [('', labels, stats.retries) for labels, stats in verbs])
+    metric('port_reopens_total', 'counter', 'Serial port reopened after a failed command',
+           [('', labels, stats.reopens) for labels, stats in verbs])
+    metric('pipeline_fallbacks_total', 'counter', 'Pipelined qsrr downloads switched back to one request at a time',
+           [('', s.labels, s.pipeline_fallbacks) for s in stats_list])
+    metric('decode_seconds_total', 'counter', 'Time spent decoding qsrr blocks',
+           [('', s.labels, s.decode_seconds) for s in stats_list])
+    metric('decoded_blocks_total', 'counter', 'qsrr blocks decoded',
+           [('', s.labels, s.decoded_blocks) for s in stats_list])
+    metric('elapsed_seconds', 'gauge', 'Time since the statistics started',
+           [('', s.labels, time.time() - s.start) for s in stats_list])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(stats_list, path):
+    # Written to a temporary file first, a collector never reads a partial file
+    with open(path + '.tmp', 'w') as f:
+        f.write(prometheus(stats_list))
+    os.replace(path + '.tmp', path)
+
+
+def histogram_percentile(histogram, p):
+    # Upper bound of the bucket holding the percentile, in ms
+    total = sum(histogram)
+    if total == 0: return '-'
+    rank = p / 100.0 * total
+    cumulative = 0
+    for bound, count in zip(latency_buckets, histogram):
+        cumulative += count
+        if cumulative >= rank:
+            return '<=%g' % (bound * 1000)
+    return '>%g' % (latency_buckets[-1] * 1000)
@@ -0,0 +1,203 @@
+# vim: set fileencoding=utf-8 :
+
+# Local store of the recordings downloaded by 'sync'.
+# There is one directory per meter, holding an archive of raw qsrr blocks:
+#   samples.qsrr    blocks of 146 bytes, all the recordings one after the other, in the order they were downloaded
+#   samples.ts      start time of each block (8 bytes double, native order), to search by time without decoding
+#   watermark.json  index of the archive: for each recording its description and segments,
+#                   with the maps needed to decode the blocks and the time of the last sync
+# A recording that grows between two syncs gets a new segment at the end of the archive:
+# segments are [first block in the archive, first sample, count of samples].
+# Recordings are identified by their seq_no and start time, seq_no alone may be reused after the memory is cleared.
+
+import array
+import bisect
+import json
+import mmap
+import os
+import time
+
+from fluke_28x_dmm_util import decode
+
+SAMPLES_FILE = 'samples.qsrr'
+TIMES_FILE = 'samples.ts'
+WATERMARK_FILE = 'watermark.json'
+
+
+def store_dir():
+    base = os.environ.get('XDG_DATA_HOME') or os.environ.get('LOCALAPPDATA') \
+        or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'fluke_28x_dmm_util')
+
+
+def recording_key(entry):
+    return '%d_%d' % (entry['seq_no'], entry['start'])
+
+
+def block_start(block):
+    # start_ts of a qsrr block, without decoding the rest
+    sh, sl = decode.words[1].unpack_from(block)
+    return decode.doubles[1].unpack(decode.words[1].pack(sl, sh))[0]
+
+
+class SampleStore:
+
+    def __init__(self, root, info):
+        # info: meter identity, from DmmClient.identity()
+        name = (info['model_number'] + '_' + info['serial_number']).replace(' ', '_')
+        self.path = os.path.join(root, ''.join(c for c in name if c.isalnum() or c in '_-.'))
+        self.info = info
+        self.watermark = None
+
+    def load_watermark(self):
+        if self.watermark is None:
+            try:
+                with open(os.path.join(self.path, WATERMARK_FILE)) as f:
+                    self.watermark = json.load(f)
+            except OSError:
+                self.watermark = None
+            # Stores without an archive (blocks count) are downloaded again
+            if self.watermark is None or 'blocks' not in self.watermark:
+                self.watermark = {'id': self.info, 'blocks': 0, 'recordings': {}, 'maps': {}}
+        return self.watermark
+
+    def save_watermark(self):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, WATERMARK_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.watermark, f)
+        os.replace(path + '.tmp', path)
+
+    def stored_samples(self, key):
+        recording = self.load_watermark()['recordings'].get(key)
+        return recording['stored_samples'] if recording else 0
+
+    def write_blocks(self, entry, first, blocks):
+        # Blocks of samples first... of a recording. Samples already stored are overwritten in place,
+        # the others are appended to the archive as a new segment
+        watermark = self.load_watermark()
+        key = recording_key(entry)
+        recording = watermark['recordings'].get(key) or {'segments': [], 'stored_samples': 0}
+        count = len(blocks) // decode.QSRR_SIZE
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, SAMPLES_FILE), 'a+b') as samples, \
+                open(os.path.join(self.path, TIMES_FILE), 'a+b') as times:
+            # Whatever follows the last indexed block comes from an interrupted sync
+            samples.truncate(watermark['blocks'] * decode.QSRR_SIZE)
+            times.truncate(watermark['blocks'] * 8)
+        starts = array.array('d', [block_start(blocks[i * decode.QSRR_SIZE:]) for i in range(count)])
+        # Samples already stored
+        replaced = max(min(recording['stored_samples'] - first, count), 0)
+        with open(os.path.join(self.path, SAMPLES_FILE), 'r+b') as samples, \
+                open(os.path.join(self.path, TIMES_FILE), 'r+b') as times:
+            for i in range(replaced):
+                position = segment_position(recording['segments'], first + i)
+                samples.seek(position * decode.QSRR_SIZE)
+                samples.write(blocks[i * decode.QSRR_SIZE:(i + 1) * decode.QSRR_SIZE])
+                times.seek(position * 8)
+                times.write(starts[i:i + 1].tobytes())
+            if replaced < count:
+                if first + replaced != recording['stored_samples']:
+                    raise ValueError('By app: Samples %d to %d are missing in the archive'
+                                     % (recording['stored_samples'] + 1, first + replaced))
+                samples.seek(watermark['blocks'] * decode.QSRR_SIZE)
+                samples.write(blocks[replaced * decode.QSRR_SIZE:count * decode.QSRR_SIZE])
+                times.seek(watermark['blocks'] * 8)
+                times.write(starts[replaced:].tobytes())
+                recording['segments'].append([watermark['blocks'], first + replaced, count - replaced])
+                recording['stored_samples'] += count - replaced
+                watermark['blocks'] += count - replaced
+        recording.update(entry)
+        watermark['recordings'][key] = recording
+
+
+def segment_position(segments, sample):
+    # Position in the archive of a sample of a recording
+    for block, first, count in segments:
+        if first <= sample < first + count:
+            return block + sample - first
+    raise ValueError('By app: Sample %d is not in the archive' % sample)
+
+
+def sync(client, store):
+    # Download what is missing in the store: new recordings, and the end of the ones that have grown.
+    # The last stored sample of a recording is downloaded again, it may have been in progress.
+    # Returns (entry, first sample downloaded, samples downloaded) for each recording downloaded.
+    watermark = store.load_watermark()
+    synced = []
+    for entry in client.catalog()['recordings']:
+        stored = store.stored_samples(recording_key(entry))
+        if stored == entry['num_samples']:
+            continue
+        first = max(min(stored, entry['num_samples']) - 1, 0)
+        blocks = b''.join(client.qsrr_blocks(str(entry['reading_index']), entry['num_samples'], first))
+        store.write_blocks(entry, first, blocks)
+        synced.append((entry, first, entry['num_samples'] - first))
+        # Saved after each recording, an interrupted sync goes on where it stopped
+        watermark['maps'] = client.map_cache
+        watermark['last_sync'] = int(time.time())
+        store.save_watermark()
+    watermark['last_sync'] = int(time.time())
+    store.save_watermark()
+    return synced
+
+
+class Archive:
+    # Read access to a store directory. Files are memory-mapped, samples are decoded only when asked for.
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, WATERMARK_FILE)) as f:
+            self.watermark = json.load(f)
+        self.tables = decode.enum_tables(self.watermark['maps'])
+        self.samples = self.map_file(SAMPLES_FILE)
+        self.blocks = memoryview(self.samples)
+        times = self.map_file(TIMES_FILE)
+        self.times = memoryview(times).cast('d') if times else memoryview(array.array('d'))
+
+    def map_file(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.blocks.release()
+        self.times.release()
+        if isinstance(self.samples, mmap.mmap):
+            self.samples.close()
+
+    def recordings(self):
+        # Stored recordings, ordered by start time
+        return sorted(self.watermark['recordings'].items(), key=lambda item: (item[1]['start'], item[1]['seq_no']))
+
+    def block(self, key, sample):
+        position = segment_position(self.watermark['recordings'][key]['segments'], sample)
+        return self.blocks[position * decode.QSRR_SIZE:(position + 1) * decode.QSRR_SIZE]
+
+    def sample(self, key, sample):
+        return decode.decode_qsrr(self.block(key, sample), self.tables)
+
+    def samples_between(self, key, start=None, end=None):
+        # Decoded samples of a recording with start <= start_ts < end (epoch seconds, None for no limit).
+        # Each segment is searched by bisection on samples.ts
+        for block, first, count in self.watermark['recordings'][key]['segments']:
+            lo = block if start is None else bisect.bisect_left(self.times, start, block, block + count)
+            hi = block + count if end is None else bisect.bisect_left(self.times, end, lo, block + count)
+            for position in range(lo, hi):
+                yield decode.decode_qsrr(self.blocks[position * decode.QSRR_SIZE:(position + 1) * decode.QSRR_SIZE],
+                                         self.tables)
+
+    def query(self, start=None, end=None):
+        # (key, recording, sample) of all the recordings with start <= start_ts < end
+        for key, recording in self.recordings():
+            if end is not None and recording['start'] >= end: continue
+            if start is not None and recording['end'] < start: continue
+            for sample in self.samples_between(key, start, end):
+                yield key, recording, sample
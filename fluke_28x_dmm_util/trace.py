@@ -0,0 +1,67 @@
+# vim: set fileencoding=utf-8 :
+
+# Timeline of a session for --trace, in Chrome Trace Event format (JSON array of events).
+# It can be loaded in Perfetto (ui.perfetto.dev) or chrome://tracing.
+# Events are written as they happen through a buffered file, memory use does not grow with the session.
+# The closing ']' is optional in this format: the trace of an interrupted session can still be loaded.
+# DmmClient.trace is None unless --trace is given, so that tracing costs nothing otherwise.
+
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+
+    def __init__(self, path, process_name='fluke_28x_dmm_util'):
+        self.file = open(path, 'w', buffering=1 << 16)
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.threads = set()
+        # Fleet mode: one thread per DMM
+        self.lock = threading.Lock()
+        self.file.write('[\n')
+        self.metadata('process_name', process_name)
+
+    def now(self):
+        return time.perf_counter()
+
+    def metadata(self, name, value, tid=0):
+        self.write({'name': name, 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': value}})
+
+    def thread_id(self):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.metadata('thread_name', threading.current_thread().name, tid)
+        return tid
+
+    def span(self, name, start, end=None, cat='dmm', args=None):
+        # Complete event from start to end (perf_counter seconds), end defaults to now
+        if end is None: end = time.perf_counter()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': round((start - self.origin) * 1e6, 1),
+                 'dur': round((end - start) * 1e6, 1), 'pid': self.pid, 'tid': self.thread_id()}
+        if args: event['args'] = args
+        self.write(event)
+
+    def instant(self, name, cat='dmm', args=None):
+        event = {'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+                 'ts': round((time.perf_counter() - self.origin) * 1e6, 1), 'pid': self.pid, 'tid': self.thread_id()}
+        if args: event['args'] = args
+        self.write(event)
+
+    def write(self, event):
+        line = json.dumps(event, separators=(',', ':')) + ',\n'
+        with self.lock:
+            # Threads still running at exit may trace after the file is closed
+            if not self.file.closed:
+                self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            if self.file.closed: return
+            # Last event without a trailing comma, to end with a valid JSON array
+            self.file.write(json.dumps({'name': 'end', 'ph': 'i', 's': 'g', 'pid': self.pid, 'tid': 0,
+                                        'ts': round((time.perf_counter() - self.origin) * 1e6, 1)}) + '\n]\n')
+            self.file.close()
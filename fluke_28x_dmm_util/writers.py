@@ -0,0 +1,322 @@
+# vim: set fileencoding=utf-8 :
+
+# Output writers for lists, saved items and recordings.
+# Rows are sent as tables: begin() declares the fields, row() adds values, end() closes the table.
+# Output is buffered and written when a table ends or when enough rows are pending.
+# Formatted timestamps are cached, samples of a recording often share the same second.
+#
+# Binary format: 'FDMMBIN1', then records made of a 1 byte tag, a 32 bits little-endian length and a payload
+#   'T' table: JSON object with kind, context, fields ([name, type] pairs) and the struct format of the rows
+#   'S' string: 16 bits code, then the UTF-8 string. Strings in rows are replaced by these codes
+#   'R' rows: rows of the current table, packed with the struct format
+#   'E' end of the current table
+
+import calendar
+import csv
+import io
+import json
+import math
+import struct
+import sys
+import time
+
+formats = ['tsv', 'csv', 'ndjson', 'binary']
+
+# Field types
+TIME = 'time'
+FLOAT = 'float'
+INT = 'int'
+STR = 'str'
+
+# Value of the readings of an overload
+OVERLOAD = 9.99999999e+37
+
+BINARY_MAGIC = b'FDMMBIN1'
+binary_types = {TIME: 'd', FLOAT: 'd', INT: 'q', STR: 'H'}
+record_header = struct.Struct('<cI')
+string_code = struct.Struct('<H')
+
+# Rows kept before writing
+BUFFER_ROWS = 1000
+
+
+class Writer:
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = []
+        self.time_cache = {}
+        self.kind = None
+        self.fields = None
+        self.context = None
+        # trace.Tracer, writes to out are traced when set
+        self.trace = None
+        # Context added to all the tables (fleet mode: the DMM serial number)
+        self.tags = {}
+        # SharedHeaders of the DMMs writing to the same stream (fleet mode), None to write the headers here
+        self.headers = None
+
+    def format_time(self, ts):
+        # ts is a struct_time or epoch seconds
+        try:
+            return self.time_cache[ts]
+        except KeyError:
+            if len(self.time_cache) > 4096:
+                self.time_cache.clear()
+            struct_time = ts if isinstance(ts, time.struct_time) else time.gmtime(ts)
+            value = self.time_cache[ts] = time.strftime('%Y-%m-%d %H:%M:%S', struct_time)
+            return value
+
+    def begin(self, kind, fields, context=None, title=None, header=None, footer=None, indent=0):
+        # fields: [name, type] pairs. title, header, footer and indent only describe the tab-separated layout:
+        # lines before and after the rows (None for no line), column titles, and empty cells before each row
+        self.kind = kind
+        self.fields = fields
+        self.context = dict(self.tags, **context) if context else dict(self.tags)
+
+    def row(self, values):
+        raise NotImplementedError
+
+    def end(self):
+        self.flush()
+
+    def write(self, data):
+        self.pending.append(data)
+        if len(self.pending) >= BUFFER_ROWS:
+            self.flush()
+
+    def flush(self):
+        start = self.trace.now() if self.trace is not None else 0
+        if self.pending:
+            self.out.write(''.join(self.pending))
+            self.pending = []
+        self.out.flush()
+        if self.trace is not None: self.trace.span('write output', start, cat='output')
+
+    def close(self):
+        # Closed once, it may be closed again at exit
+        if self.out is None: return
+        try:
+            self.flush()
+        finally:
+            self.out = None
+
+
+class SharedHeaders:
+    # Fleet mode, csv: the header lines of the tables of all the DMMs, written once to their shared stream,
+    # so that the rows of all the DMMs make one table per kind. Rows carry the meter column
+
+    def __init__(self, out, lock):
+        self.out = out
+        self.lock = lock
+        # (kind, header line) written
+        self.written = set()
+
+    def write(self, writer, kind, line):
+        # The rows of writer already pending go before the header
+        writer.flush()
+        with self.lock:
+            if (kind, line) in self.written: return
+            self.written.add((kind, line))
+            self.out.write(line)
+            self.out.flush()
+
+
+class TsvWriter(Writer):
+    # Former print() layout, cells separated by sep
+
+    def __init__(self, out, sep='\t'):
+        super().__init__(out)
+        self.sep = sep
+        self.formatters = None
+        self.cells = []
+        self.footer = None
+
+    def begin(self, kind, fields, context=None, title=None, header=None, footer=None, indent=0):
+        super().begin(kind, fields, context)
+        self.formatters = [self.format_time if field_type == TIME else str for name, field_type in fields]
+        self.cells = [''] * indent
+        self.footer = footer
+        if title is not None:
+            self.write(title + '\n')
+        if header is not None:
+            self.write(self.sep.join(header) + '\n')
+
+    def row(self, values):
+        self.write(self.sep.join(self.cells + [f(v) for f, v in zip(self.formatters, values)]) + '\n')
+
+    def end(self):
+        if self.footer is not None:
+            self.write(self.footer + '\n')
+        super().end()
+
+
+class CsvWriter(Writer):
+    # One header line per table, context values as first columns
+
+    def __init__(self, out):
+        super().__init__(out)
+        self.buffer = io.StringIO()
+        self.csv = csv.writer(self.buffer, lineterminator='\n')
+        self.formatters = None
+        self.prefix = None
+        self.tables = 0
+
+    def begin(self, kind, fields, context=None, title=None, header=None, footer=None, indent=0):
+        super().begin(kind, fields, context)
+        self.formatters = [self.format_time if field_type == TIME else None for name, field_type in fields]
+        if self.tables and self.headers is None:
+            self.write('\n')
+        self.tables += 1
+        self.csv.writerow(['kind'] + list(self.context) + [name for name, field_type in fields])
+        self.prefix = [kind] + [self.format_time(v) if isinstance(v, time.struct_time) else v
+                                for v in self.context.values()]
+        if self.headers is not None:
+            # Same header for all the DMMs, their meter column comes first
+            self.headers.write(self, kind, self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            return
+        self.take()
+
+    def row(self, values):
+        self.csv.writerow(self.prefix + [f(v) if f else v for f, v in zip(self.formatters, values)])
+        self.take()
+
+    def take(self):
+        self.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+def json_float(value):
+    # NaN, infinities and overloads have no JSON number: null
+    if value is None or value == OVERLOAD or not math.isfinite(value): return None
+    return value
+
+
+class NdjsonWriter(Writer):
+    # One JSON object per row, with the kind and the context of the table.
+    # Floats without a value (NaN, overloads) are null
+
+    def __init__(self, out):
+        super().__init__(out)
+        self.names = None
+        self.formatters = None
+        self.prefix = None
+
+    def begin(self, kind, fields, context=None, title=None, header=None, footer=None, indent=0):
+        super().begin(kind, fields, context)
+        self.names = [name for name, field_type in fields]
+        self.formatters = [self.format_time if field_type == TIME else json_float if field_type == FLOAT else None
+                           for name, field_type in fields]
+        self.prefix = {'kind': kind}
+        for key, value in self.context.items():
+            self.prefix[key] = self.format_time(value) if isinstance(value, time.struct_time) else value
+
+    def row(self, values):
+        obj = dict(self.prefix)
+        for name, f, v in zip(self.names, self.formatters, values):
+            obj[name] = f(v) if f else v
+        self.write(json.dumps(obj, allow_nan=False) + '\n')
+
+
+class BinaryWriter(Writer):
+
+    def __init__(self, out):
+        super().__init__(out)
+        self.strings = {}
+        self.converters = None
+        self.row_struct = None
+        self.rows = []
+        self.out.write(BINARY_MAGIC)
+
+    def record(self, tag, payload):
+        self.pending.append(record_header.pack(tag, len(payload)) + payload)
+
+    def begin(self, kind, fields, context=None, title=None, header=None, footer=None, indent=0):
+        super().begin(kind, fields, context)
+        self.converters = [self.epoch if field_type == TIME else self.string if field_type == STR else
+                           float if field_type == FLOAT else int for name, field_type in fields]
+        self.row_struct = struct.Struct('<' + ''.join(binary_types[field_type] for name, field_type in fields))
+        context = {key: self.epoch(value) if isinstance(value, time.struct_time) else value
+                   for key, value in self.context.items()}
+        self.record(b'T', json.dumps({'kind': kind, 'context': context, 'fields': fields,
+                                      'format': self.row_struct.format}).encode())
+
+    def epoch(self, ts):
+        return float(calendar.timegm(ts)) if isinstance(ts, time.struct_time) else float(ts)
+
+    def string(self, value):
+        try:
+            return self.strings[value]
+        except KeyError:
+            code = self.strings[value] = len(self.strings)
+            self.record(b'S', string_code.pack(code) + str(value).encode())
+            return code
+
+    def row(self, values):
+        # Strings are recorded before the rows using them
+        self.rows.append(self.row_struct.pack(*[f(v) for f, v in zip(self.converters, values)]))
+        if len(self.rows) >= BUFFER_ROWS:
+            self.flush()
+
+    def end(self):
+        self.flush_rows()
+        self.record(b'E', b'')
+        super().end()
+
+    def flush_rows(self):
+        if self.rows:
+            self.record(b'R', b''.join(self.rows))
+            self.rows = []
+
+    def flush(self):
+        start = self.trace.now() if self.trace is not None else 0
+        self.flush_rows()
+        if self.pending:
+            self.out.write(b''.join(self.pending))
+            self.pending = []
+        self.out.flush()
+        if self.trace is not None: self.trace.span('write output', start, cat='output')
+
+
+def make_writer(output_format, sep='\t', out=None):
+    match output_format:
+        case 'tsv':
+            return TsvWriter(out or sys.stdout, sep)
+        case 'csv':
+            return CsvWriter(out or sys.stdout)
+        case 'ndjson':
+            return NdjsonWriter(out or sys.stdout)
+        case 'binary':
+            return BinaryWriter(out or sys.stdout.buffer)
+    raise ValueError('By app: Unknown output format %s' % output_format)
+
+
+def read_binary(stream):
+    # Tables of a binary output, as (table, rows) pairs. Strings are given back in the rows
+    if stream.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError('By app: Not a binary output file')
+    strings = {}
+    table = None
+    rows = []
+    while True:
+        data = stream.read(record_header.size)
+        if len(data) < record_header.size:
+            return
+        tag, length = record_header.unpack(data)
+        payload = stream.read(length)
+        match tag:
+            case b'T':
+                table = json.loads(payload)
+                rows = []
+            case b'S':
+                strings[string_code.unpack_from(payload)[0]] = payload[string_code.size:].decode()
+            case b'R':
+                row_struct = struct.Struct(table['format'])
+                is_str = [field_type == STR for name, field_type in table['fields']]
+                for values in row_struct.iter_unpack(payload):
+                    rows.append(tuple(strings[v] if s else v for s, v in zip(is_str, values)))
+            case b'E':
+                yield table, rows
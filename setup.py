@@ -24,6 +24,7 @@ setup(
     ],
     packages=["fluke_28x_dmm_util"],
     install_requires=["pyserial"],
+    extras_require={"numpy": ["numpy"]},
 #    entry_points={
 #        "console_scripts": [
 #            "realpython=reader.__main__:main",
@@ -0,0 +1,22 @@
+# vim: set fileencoding=utf-8 :
+
+# Tests run against the simulated DMM (sim:// ports), with the caches, stores and daemon sockets
+# in a temporary directory
+
+import pytest
+
+from fluke_28x_dmm_util import dmm_util
+
+
+@pytest.fixture(autouse=True)
+def isolated_dirs(tmp_path, monkeypatch):
+    for name in ('XDG_CACHE_HOME', 'XDG_DATA_HOME', 'XDG_RUNTIME_DIR'):
+        monkeypatch.setenv(name, str(tmp_path / name.lower()))
+    return tmp_path
+
+
+def sim_client(options='', **kwargs):
+    # Opened DmmClient on a simulated DMM answering at once
+    client = dmm_util.DmmClient('sim://?instant=1' + ('&' + options if options else ''), **kwargs)
+    client.open()
+    return client
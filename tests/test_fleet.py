@@ -0,0 +1,62 @@
+# vim: set fileencoding=utf-8 :
+
+# Fleet mode: one call of the utility on several simulated DMMs, told apart by their serial numbers
+
+import os
+import subprocess
+import sys
+
+PORTS = ['sim://?instant=1&recordings=3&serial=A1', 'sim://?instant=1&recordings=3&serial=B2']
+
+
+def run(*args):
+    command = [sys.executable, '-m', 'fluke_28x_dmm_util']
+    for port in PORTS:
+        command += ['-p', port]
+    return subprocess.run(command + list(args), capture_output=True, text=True, env=os.environ,
+                          cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_csv_headers_once():
+    result = run('-f', 'csv', 'list', 'all')
+    assert result.returncode == 0
+    lines = result.stdout.splitlines()
+    headers = [line for line in lines if line.startswith('kind,')]
+    # One header per kind of table, for the whole fleet
+    assert headers == sorted(set(headers), key=headers.index)
+    assert len(headers) == 3
+    rows = [line for line in lines if not line.startswith('kind,')]
+    assert len(rows) == 12
+    assert {row.split(',')[1] for row in rows} == {'A1', 'B2'}
+
+
+def test_tsv_titles_per_meter():
+    result = run('list', 'recordings')
+    assert result.returncode == 0
+    for serial in ('A1', 'B2'):
+        assert serial + '\tIndex\tName\tType\tStart\tEnd\tDuration\tMeasurements' in result.stdout.splitlines()
+        assert serial + '\t1\tREC0\tRecording\t2022-04-15 05:20:00\t2022-04-15 05:20:30\t00:00:00:30\t3' \
+            in result.stdout.splitlines()
+
+
+def test_usage_before_fan_out():
+    # An invalid command is reported once, before any DMM is used
+    result = run('get')
+    assert result.returncode == 0
+    assert result.stdout.count('Usage:') == 1
+    assert 'A1\t' not in result.stdout and 'B2\t' not in result.stdout
+    assert 'DMMs' not in result.stderr
+
+
+def test_failed_members():
+    # Usage printed by a DMM is a failure of that DMM
+    result = run('set', 'bogus', '1')
+    assert result.returncode == 11
+    assert '2 DMMs, 2 failed' in result.stderr
+    assert result.stderr.count('failed (exit 1)') == 2
+
+
+def test_members_ok():
+    result = run('get', 'names')
+    assert result.returncode == 0
+    assert '2 DMMs, 0 failed' in result.stderr
@@ -0,0 +1,100 @@
+# vim: set fileencoding=utf-8 :
+
+# Reply framing, retries and the pipelined qsrr downloads, with the faults of the simulated DMM:
+# drop loses one byte of a reply, truncate cuts it
+
+import time
+
+import pytest
+
+from fluke_28x_dmm_util import simulator
+from conftest import sim_client
+
+
+def test_read_reply_complete():
+    client = sim_client()
+    client.ser.write(b'ID\r')
+    data, complete = client.read_reply('ID')
+    assert complete
+    assert data == b'0\rFLUKE 289,V1.16,12345678\r'
+
+
+def test_read_reply_binary():
+    client = sim_client()
+    client.ser.write(b'qsrr 0,3\r')
+    data, complete = client.read_reply('qsrr')
+    assert complete
+    assert data == b'0\r#0' + simulator.sample_qsrr(3) + b'\r'
+
+
+def test_read_reply_truncated():
+    client = sim_client('truncate=1&seed=1', timeout=0.01)
+    client.ser.write(b'qsrr 0,0\r')
+    data, complete = client.read_reply('qsrr')
+    assert not complete
+    assert len(data) < len(simulator.sample_qsrr(0)) + 5
+
+
+def test_read_reply_dropped_byte():
+    # A binary reply of the expected size without its final '\r' has lost a byte
+    client = sim_client('drop=1&seed=1', timeout=0.01)
+    client.ser.write(b'qsrr 0,0\r')
+    data, complete = client.read_reply('qsrr')
+    assert not complete
+
+
+def test_read_retry_recovers():
+    client = sim_client('drop=0.3&seed=2', timeout=0.01)
+    meter = client.ser.meter
+    for k in range(20):
+        assert client.qsrr_raw('0', str(k)) == simulator.sample_qsrr(k)
+    assert meter.faults > 0
+    assert client.rtt_estimates['qsrr']['retries'] > 0
+    assert client.rtt_estimates['qsrr']['count'] == 20
+
+
+def test_read_retry_deadline():
+    client = sim_client('truncate=1&seed=1', timeout=0.01)
+    start = time.time()
+    data, complete = client.read_retry('ID', start + 0.3)
+    assert not complete
+    assert time.time() - start < 1
+    assert client.ser.meter.commands > 1
+
+
+def test_command_reply_error_status():
+    client = sim_client('recordings=20')
+    with pytest.raises(SystemExit) as status:
+        client.meter_command('qsrr 0,20')
+    assert status.value.code == 7
+
+
+def test_qsrr_raw_gives_up():
+    # Blocks of the wrong size are retried until the deadline
+    client = sim_client('truncate=1&seed=1', timeout=0.01, deadline=0.3)
+    start = time.time()
+    with pytest.raises(ValueError):
+        client.qsrr_raw('0', '0')
+    assert time.time() - start < 2
+
+
+def test_qsrr_blocks_window():
+    client = sim_client('recordings=50', window=8)
+    blocks = list(client.qsrr_blocks('0', 50))
+    assert blocks == [simulator.sample_qsrr(k) for k in range(50)]
+    assert client.ser.meter.commands == 50
+    assert client.rtt_estimates['qsrr']['retries'] == 0
+
+
+def test_qsrr_blocks_fallback():
+    # A damaged reply stops the pipeline, the remaining samples are read one by one
+    client = sim_client('recordings=50&drop=0.05&seed=3', timeout=0.01, window=8)
+    blocks = list(client.qsrr_blocks('0', 50))
+    assert blocks == [simulator.sample_qsrr(k) for k in range(50)]
+    assert client.ser.meter.faults > 0
+    assert client.rtt_estimates['qsrr']['retries'] > 0
+
+
+def test_qsrr_blocks_first():
+    client = sim_client('recordings=20', window=4)
+    assert list(client.qsrr_blocks('0', 20, 15)) == [simulator.sample_qsrr(k) for k in range(15, 20)]
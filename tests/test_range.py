@@ -0,0 +1,52 @@
+# vim: set fileencoding=utf-8 :
+
+# --from and --to: qsrr_range finds the samples in a time range by bisection.
+# Sample k of a simulated recording starts at T0 + 10 k.
+
+import pytest
+
+from fluke_28x_dmm_util import simulator
+from conftest import sim_client
+
+T0 = simulator.T0
+SAMPLES = 500
+
+
+def expected_range(start, end):
+    starts = [T0 + 10 * k for k in range(SAMPLES)]
+    first = sum(1 for ts in starts if start is not None and ts < start)
+    last = SAMPLES if end is None else max(sum(1 for ts in starts if ts < end), first)
+    return first, last
+
+
+def same_samples(found, expected):
+    # Empty ranges may be given by any first == last
+    return range(*found) == range(*expected)
+
+
+@pytest.mark.parametrize('start, end', [
+    (None, None), (T0, None), (None, T0), (T0 + 5, T0 + 95), (T0 + 10, T0 + 100), (T0 + 1234, T0 + 2000),
+    (T0 - 100, T0 + 50), (T0 + 4985, None), (T0 + 4990, None), (T0 + 6000, None), (None, T0 - 1),
+    (T0 + 300, T0 + 200),
+])
+def test_qsrr_range(start, end):
+    client = sim_client('recordings=%d' % SAMPLES)
+    recording = client.qrsi('0')
+    commands = client.ser.meter.commands
+    assert same_samples(client.qsrr_range('0', recording, start, end), expected_range(start, end))
+    # Regular samples: found from the estimated index in a few qsrr
+    assert client.ser.meter.commands - commands <= 8
+
+
+def test_qsrr_range_irregular():
+    # Samples further apart than announced by qrsi: found by galloping then bisection
+    client = sim_client('recordings=%d' % SAMPLES)
+    recording = dict(client.qrsi('0'), sample_interval=1.0)
+    for start in (T0 + 5, T0 + 2500, T0 + 4990):
+        assert same_samples(client.qsrr_range('0', recording, start, None), expected_range(start, None))
+
+
+def test_qsrr_range_empty_recording():
+    client = sim_client('recordings=0')
+    recording = client.qrsi('0')
+    assert client.qsrr_range('0', recording, T0, T0 + 100) == (0, 0)
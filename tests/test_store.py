@@ -0,0 +1,89 @@
+# vim: set fileencoding=utf-8 :
+
+# sync: incremental downloads into the store, and the catalog kept on disk between calls
+
+from fluke_28x_dmm_util import simulator, store
+from conftest import sim_client
+
+T0 = simulator.T0
+
+
+def reconnect(client):
+    # Next call of the utility: the catalog only comes from the disk cache and the DMM
+    client.catalog_items = None
+    return client
+
+
+def count_commands(meter):
+    # Verbs of the commands the simulated DMM receives from now on
+    verbs = []
+    reply = meter.reply
+
+    def counted(cmd):
+        verbs.append(cmd.split(' ', 1)[0])
+        return reply(cmd)
+    meter.reply = counted
+    return verbs
+
+
+def test_sync_incremental(tmp_path):
+    client = sim_client('recordings=20,5')
+    meter = client.ser.meter
+    sample_store = store.SampleStore(str(tmp_path / 'store'), client.identity())
+
+    synced = store.sync(client, sample_store)
+    assert [(entry['index'], first, count) for entry, first, count in synced] == [(1, 0, 20), (2, 0, 5)]
+
+    # The first recording grows: its last stored sample and the new ones are downloaded
+    meter.recordings[0] = 30
+    commands = count_commands(meter)
+    synced = store.sync(reconnect(client), sample_store)
+    assert [(entry['index'], first, count) for entry, first, count in synced] == [(1, 19, 11)]
+    assert commands.count('qsrr') == 11
+
+    assert store.sync(reconnect(client), sample_store) == []
+
+    watermark = sample_store.load_watermark()
+    key = store.recording_key(client.catalog()['recordings'][0])
+    assert watermark['recordings'][key]['segments'] == [[0, 0, 20], [25, 20, 10]]
+    assert watermark['blocks'] == 35
+
+    with store.Archive(sample_store.path) as archive:
+        assert [bytes(archive.block(key, k)) for k in range(30)] == [simulator.sample_qsrr(k) for k in range(30)]
+        starts = [store.block_start(archive.block(key, k)) for k in range(30)]
+        assert starts == [T0 + 10 * k for k in range(30)]
+        samples = list(archive.samples_between(key, T0 + 185, T0 + 215))
+        assert [sample['start_ts'] for sample in samples] == [archive.sample(key, k)['start_ts'] for k in (19, 20, 21)]
+
+
+def test_sync_interrupted(tmp_path):
+    # Blocks written after the last saved watermark are dropped by the next sync
+    client = sim_client('recordings=10')
+    sample_store = store.SampleStore(str(tmp_path / 'store'), client.identity())
+    store.sync(client, sample_store)
+    with open(tmp_path / 'store' / 'FLUKE_289_12345678' / store.SAMPLES_FILE, 'ab') as samples:
+        samples.write(b'\0' * 100)
+    client.ser.meter.recordings[0] = 12
+    store.sync(reconnect(client), sample_store)
+    key = store.recording_key(client.catalog()['recordings'][0])
+    with store.Archive(sample_store.path) as archive:
+        assert [bytes(archive.block(key, k)) for k in range(12)] == [simulator.sample_qsrr(k) for k in range(12)]
+
+
+def test_catalog_grown_recording():
+    client = sim_client('recordings=20,5')
+    assert [entry['num_samples'] for entry in client.catalog()['recordings']] == [20, 5]
+    client.ser.meter.recordings[0] = 30
+    assert [entry['num_samples'] for entry in reconnect(client).catalog()['recordings']] == [30, 5]
+
+
+def test_catalog_cleared_memory():
+    # Same count and seq_no after the memory is cleared, but other start times
+    client = sim_client('recordings=20,5,5')
+    client.catalog()
+    meter = client.ser.meter
+    meter.recordings = [30, 5, 5]
+    meter.recording_start = lambda idx: T0 + 3600 + idx * 86400
+    entries = reconnect(client).catalog()['recordings']
+    assert [entry['num_samples'] for entry in entries] == [30, 5, 5]
+    assert [entry['start'] for entry in entries] == [T0 + 3600 + idx * 86400 for idx in range(3)]